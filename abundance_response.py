@@ -0,0 +1,157 @@
+################################################################################
+#   Elemental abundance response functions for the ATLAS abundance models.
+#   Replaces the per-call spi.interp2d constructions in model_spec.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.interpolate as spi
+
+# Reminder of the abundance model columns
+# ['Solar', 'Na+', 'Na-',   'Ca+',  'Ca-', 'Fe+', 'Fe-', 'C+',  'C-',  'a/Fe+',
+#  'N+',    'N-',  'as/Fe+','Ti+',  'Ti-', 'Mg+', 'Mg-', 'Si+', 'Si-', 'T+',
+#  'T-',    'Cr+', 'Mn+',   'Ba+',  'Ba-', 'Ni+', 'Co+', 'Eu+', 'Sr+', 'K+',\
+#  'V+',    'Cu+', 'Na+0.6','Na+0.9']
+#
+# Every abundance node used in model_spec (the models themselves, the
+# extensions to +-0.5 and the symmetric K- and Cr- models) is a linear
+# combination of the abundance columns. An element's response at abundance X
+# is then a weighted sum of a few columns where the weights depend only on X,
+# so it can be evaluated at every wavelength with one dot product. For a
+# regular (wl x abundance) grid, interp2d evaluated at the grid wavelengths
+# reduces to a 1-D spline along the abundance axis, which is what is used here.
+
+def extended_nodes(minus, plus, step, edge):
+    '''Returns the abundance nodes and their column combinations for the
+    standard five-node response: the minus and plus models at +-step,
+    linearly extended to +-edge. If minus is None the minus model is the
+    plus model reflected about the solar model.'''
+
+    scale = edge / step
+    if minus is None:
+        minus_row = {0: 2., plus: -1.}
+    else:
+        minus_row = {minus: 1.}
+
+    mextend = {0: 1. - scale}
+    for col, v in minus_row.items():
+        mextend[col] = mextend.get(col, 0.) + scale*v
+
+    nodes = [-edge, -step, 0.0, step, edge]
+    rows = [mextend, minus_row, {0: 1.}, {plus: 1.}, {0: 1. - scale, plus: scale}]
+
+    return nodes, rows
+
+def build_response(nodes, rows, kind = 'linear'):
+    '''Packs a response definition into (nodes, columns, node matrix,
+    spline) where node matrix[i,j] is the weight of columns[j] in node i'''
+
+    cols = []
+    for row in rows:
+        for col in row.keys():
+            if col not in cols:
+                cols.append(col)
+
+    M = np.zeros((len(nodes), len(cols)))
+    for i, row in enumerate(rows):
+        for col, v in row.items():
+            M[i, cols.index(col)] = v
+
+    nodes = np.array(nodes, dtype=float)
+    if kind == 'cubic':
+        spline = spi.make_interp_spline(nodes, np.eye(len(nodes)), k=3)
+    else:
+        spline = None
+
+    return nodes, cols, M, spline
+
+# Na covers a wider range with extra models at +0.6 and +0.9 and is cubic
+Na_nodes = [-0.5, -0.3, 0.0, 0.3, 0.6, 0.9]
+Na_rows = [{0: 1. - 0.5/0.3, 2: 0.5/0.3}, {2: 1.}, {0: 1.}, {1: 1.}, {-2: 1.}, {-1: 1.}]
+
+responses = {
+    'Na': build_response(Na_nodes, Na_rows, kind = 'cubic'),
+    'K':  build_response(*extended_nodes(None, 29, 0.3, 0.5)),
+    'Mg': build_response(*extended_nodes(16, 15, 0.3, 0.5)),
+    'Fe': build_response(*extended_nodes(6, 5, 0.3, 0.5)),
+    'Ca': build_response(*extended_nodes(4, 3, 0.3, 0.5)),
+    'C':  build_response(*extended_nodes(8, 7, 0.15, 0.3)),
+    'Si': build_response(*extended_nodes(18, 17, 0.3, 0.5)),
+    'Ti': build_response(*extended_nodes(14, 13, 0.3, 0.5)),
+    'Cr': build_response(*extended_nodes(None, 21, 0.3, 0.5)),
+    # [Alpha/H] is the combined Ca, C, Mg and Si response over 0 -> 0.3
+    'Alpha_Ca': build_response([0.0, 0.3], [{0: 1.}, {3: 1.}]),
+    'Alpha_C':  build_response([0.0, 0.15, 0.3], [{0: 1.}, {7: 1.}, {0: -1., 7: 2.}]),
+    'Alpha_Mg': build_response([0.0, 0.3], [{0: 1.}, {15: 1.}]),
+    'Alpha_Si': build_response([0.0, 0.3], [{0: 1.}, {17: 1.}]),
+    }
+
+alpha_elements = ['Alpha_Ca', 'Alpha_C', 'Alpha_Mg', 'Alpha_Si']
+
+def node_weights(nodes, x, spline = None):
+    '''Returns the weights of each node for the interpolated value at x.
+    Values outside the nodes are clamped to the end nodes, as interp2d did.'''
+
+    x = min(max(x, nodes[0]), nodes[-1])
+    if spline is not None:
+        return spline(x)
+
+    w = np.zeros(len(nodes))
+    i = min(np.searchsorted(nodes, x, side='right') - 1, len(nodes) - 2)
+    t = (x - nodes[i]) / (nodes[i+1] - nodes[i])
+    w[i] = 1. - t
+    w[i+1] = t
+
+    return w
+
+def response(element, x, c):
+    '''Returns the fractional response of the model to abundance x of element,
+    i.e. the abundance model interpolated to x divided by the solar model.
+    c is the (nwl, ncol) array of interpolated abundance models.'''
+
+    nodes, cols, M, spline = responses[element]
+    coeffs = node_weights(nodes, x, spline).dot(M)
+
+    return c[:,cols].dot(coeffs) / c[:,0]
+
+def node_weights_batch(nodes, x, spline = None):
+    '''Vectorized node_weights() for an array of values x. Returns an
+    (n, nnodes) array.'''
+
+    x = np.clip(np.asarray(x, dtype=float), nodes[0], nodes[-1])
+    if spline is not None:
+        return spline(x)
+
+    w = np.zeros((len(x), len(nodes)))
+    i = np.minimum(np.searchsorted(nodes, x, side='right') - 1, len(nodes) - 2)
+    t = (x - nodes[i]) / (nodes[i+1] - nodes[i])
+    rows = np.arange(len(x))
+    w[rows, i] = 1. - t
+    w[rows, i+1] = t
+
+    return w
+
+def columns(elements):
+    '''Returns the abundance columns needed for the responses of elements,
+    always starting with the solar model (column 0)'''
+
+    cols = [0]
+    for element in elements:
+        for col in responses[element][1]:
+            if col not in cols:
+                cols.append(col)
+
+    return cols
+
+def response_batch(element, x, c, cols):
+    '''Batch version of response() for an array of abundances x. c is the
+    (n, len(cols), nwl) array of interpolated abundance models for the
+    columns cols, which must start with the solar model (see columns()).
+    Returns an (n, nwl) array.'''
+
+    nodes, ecols, M, spline = responses[element]
+    coeffs = node_weights_batch(nodes, x, spline).dot(M)
+    pos = [cols.index(col) for col in ecols]
+
+    return np.einsum('nk,nkl->nl', coeffs, c[:,pos]) / c[:,0]
@@ -0,0 +1,125 @@
+################################################################################
+#   Fused chi-square over all fitted bands.
+#   The observed bands are packed once into padded (nbands, npix) arrays with a
+#   validity mask and inverse variances, and the resampling and pseudo-continuum
+#   of every band are stacked into two sparse matrices. The chisq of one model
+#   or a batch of walkers is then a couple of products and one sum, with no
+#   Python loop over bands.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sps
+
+import mcmc_support as mcsp
+import continuum as contm
+
+def band_weights(band, nwl):
+    '''Returns the indices and weights taking the mean of a passband (slice
+    or index array) of a spectrum with nwl pixels'''
+
+    idx = np.arange(nwl)[band]
+    return idx, np.full(len(idx), 1. / len(idx))
+
+class BandChisq(object):
+    '''Chi-square of models on wlc against the bands (wls, data, err), each
+    normalised by the straight-line pseudo-continuum through its blue and red
+    passbands (linedefs = [bluelow, bluehigh, redlow, redhigh] per band, as
+    contm.LineContinuum). Pixels where the data or error is NaN or the
+    band is outside wlc are masked, which is what np.nansum did per band.
+    Only the band numbers in bands are used (default all), and bands with an
+    empty passband on wlc, which gave NaN everywhere, are dropped.'''
+
+    def __init__(self, wlc, wls, data, err, linedefs, bands = None, kind = 'cubic'):
+        self.wl = wlc
+        nwl = len(wlc)
+
+        if bands is None:
+            bands = range(len(wls))
+
+        used = []
+        for i in bands:
+            cont = contm.LineContinuum(wlc, linedefs[0][i], linedefs[1][i], \
+                    linedefs[2][i], linedefs[3][i], wls[i])
+            if len(np.arange(nwl)[cont.blue]) == 0 or len(np.arange(nwl)[cont.red]) == 0:
+                continue
+            used.append((i, cont))
+        self.bands = [i for i, cont in used]
+
+        nb = len(used)
+        npix = max([len(wls[i]) for i in self.bands]) if nb > 0 else 0
+        self.shape = (nb, npix)
+
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.data = np.zeros(self.shape)
+        self.var = np.ones(self.shape)
+        self.t = np.zeros(self.shape)
+
+        rows, cols, vals = [], [], []
+        crows, ccols, cvals = [], [], []
+        for b, (i, cont) in enumerate(used):
+            npi = len(wls[i])
+            R, outside = mcsp.resampling_matrix(wlc, wls[i], kind = kind)
+            R = R.tocoo()
+            keep = ~outside[R.row]
+            rows.append(R.row[keep] + b*npix)
+            cols.append(R.col[keep])
+            vals.append(R.data[keep])
+
+            for k, band in enumerate((cont.blue, cont.red)):
+                idx, w = band_weights(band, nwl)
+                crows.append(np.full(len(idx), b + k*nb))
+                ccols.append(idx)
+                cvals.append(w)
+
+            d = np.asarray(data[i], dtype=float)
+            e = np.asarray(err[i], dtype=float)
+            good = np.isfinite(d) & np.isfinite(e) & ~outside
+            self.mask[b, :npi] = good
+            self.data[b, :npi] = np.where(good, d, 0.)
+            self.var[b, :npi] = np.where(good, e**2., 1.)
+            self.t[b, :npi] = cont.t
+
+        if nb > 0:
+            self.R = sps.csr_matrix((np.concatenate(vals), \
+                    (np.concatenate(rows), np.concatenate(cols))), shape = (nb*npix, nwl))
+            self.C = sps.csr_matrix((np.concatenate(cvals), \
+                    (np.concatenate(crows), np.concatenate(ccols))), shape = (2*nb, nwl))
+        self.ivar = np.where(self.mask, 1. / self.var, 0.)
+
+    def models(self, mconv):
+        '''Returns the (n, nbands, npix) models normalised by their
+        pseudo-continuum for an (n, nwl) array of broadened models. Padding
+        and pixels outside wlc are 0.'''
+
+        n = mconv.shape[0]
+        nb, npix = self.shape
+        sampled = self.R.dot(mconv.T).T.reshape((n, nb, npix))
+        means = self.C.dot(mconv.T).T
+        blue = means[:, :nb, None]
+        red = means[:, nb:, None]
+
+        return sampled / (blue + (red - blue) * self.t)
+
+    def __call__(self, mconv, f = None):
+        '''Returns the chisq of a broadened model, or of each row of an (n, nwl)
+        array of them. With f the error is inflated by f times the model and
+        the log normalisation term added, as for the SAURON bands.'''
+
+        single = (np.ndim(mconv) == 1)
+        mconv = np.atleast_2d(mconv)
+        if self.shape[0] == 0:
+            chisq = np.zeros(mconv.shape[0])
+            return chisq[0] if single else chisq
+
+        resid = self.data - self.models(mconv)
+        if f is None:
+            chisq = np.einsum('nbp,bp->n', resid**2., self.ivar)
+        else:
+            f2 = (np.ones(mconv.shape[0]) * np.asarray(f)**2.)[:, None, None]
+            errterm = self.var + (self.data - resid)**2. * f2
+            chisq = np.sum(np.where(self.mask, resid**2. / errterm + \
+                    np.log(2.0 * np.pi * errterm), 0.), axis=(1,2))
+
+        return chisq[0] if single else chisq
@@ -0,0 +1,459 @@
+################################################################################
+#   Chain output for the mcmc programs.
+#   ChainWriter keeps one handle open on the chain file and writes the sampler
+#   steps in bulk instead of reopening the file every iteration.
+#   BinaryChainWriter writes the binary chain format: a directory holding
+#       chain.npy    -- (niter, nwalkers, ndim+1) positions and log probability
+#       accepted.npy -- (niter, nwalkers) whether each walker moved at each step
+#       header.json  -- run info (walkers, steps, paramnames, lines, paramdict..)
+#   load_chain memory-maps it. Existing .dat chains can be converted with
+#       python chain_io.py chain1.dat [chain2.dat ...]
+#   write_state / read_state keep a checkpoint of the sampler next to the chain
+#   (state.pkl in a binary chain, <name>.state for a .dat chain) so a run can be
+#   resumed and appended to the same chain. The run info added while sampling
+#   (autocorrelation times, move acceptance) goes in header.json, or in
+#   <name>.header.json beside a .dat chain.
+################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+CHAIN_VERSION = 1
+
+class ChainWriter(object):
+    '''Appends sampler steps to a .dat chain file (one line per walker:
+    walker index, positions, log probability). Steps are buffered in a
+    preallocated array and written every flushevery steps or flushtime
+    seconds, whichever comes first. Only whole steps are written, and
+    checkpoint() / close() also fsync the file. To continue a chain, resume
+    is the mark() of the checkpoint; anything written after it is cut off.
+    update_header() keeps its info in a sidecar file (see info_path).'''
+
+    def __init__(self, fl, nwalkers, ndim, flushevery = 100, flushtime = 60., \
+            resume = None):
+        self.fl = fl
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.flushtime = flushtime
+
+        self.buffer = np.empty((max(int(flushevery), 1), nwalkers, ndim + 1))
+        self.nbuffered = 0
+        self.nwritten = 0
+        self.lastflush = time.time()
+
+        self.linefmt = '%d\t' + ' '.join(['%r'] * ndim) + '\t%r\n'
+        if resume is not None:
+            f = open(fl, 'r+')
+            f.truncate(resume['offset'])
+            f.close()
+            self.nwritten = resume['nsteps']
+        self.info = read_info(fl)
+        self.f = open(fl, 'a')
+
+    @property
+    def nsteps(self):
+        return self.nwritten + self.nbuffered
+
+    def write(self, coords, log_prob):
+        '''Adds one step of the sampler to the buffer'''
+
+        self.buffer[self.nbuffered, :, :-1] = coords
+        self.buffer[self.nbuffered, :, -1] = log_prob
+        self.nbuffered += 1
+
+        if (self.nbuffered == len(self.buffer)) or \
+                (time.time() - self.lastflush > self.flushtime):
+            self.flush()
+
+    def flush(self, sync = False):
+        '''Writes the buffered steps to the chain file'''
+
+        if self.nbuffered > 0:
+            walkers = range(self.nwalkers)
+            lines = []
+            for step in self.buffer[:self.nbuffered].tolist():
+                lines.extend([self.linefmt % tuple([k] + step[k]) for k in walkers])
+            self.f.write(''.join(lines))
+            self.nwritten += self.nbuffered
+            self.nbuffered = 0
+
+        self.f.flush()
+        if sync:
+            os.fsync(self.f.fileno())
+        self.lastflush = time.time()
+
+    def checkpoint(self):
+        '''Flushes the buffer and makes sure it is on disk'''
+        self.flush(sync = True)
+
+    def update_header(self, info):
+        '''Merges info (a dict) into the run info of the chain, which
+        replaces the old info file in one step, so only the newest values
+        are kept'''
+
+        self.info.update(info)
+        write_json(info_path(self.fl), self.info)
+
+    def mark(self):
+        '''Flushes the chain to disk and returns where it ends, for
+        write_state'''
+
+        self.flush(sync = True)
+        return {'nsteps': self.nwritten, 'offset': self.f.tell()}
+
+    def close(self):
+        if not self.f.closed:
+            self.flush(sync = True)
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def is_binary_chain(fl):
+    '''Returns True if fl is a binary chain directory'''
+    return os.path.isdir(fl) and os.path.exists(os.path.join(fl, 'header.json'))
+
+def write_json(path, info):
+    '''Writes info to the JSON file path, replacing the old one in one step'''
+
+    f = open(path + '.tmp', 'w')
+    json.dump(info, f, indent = 1)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def write_header(fl, header):
+    '''Writes header.json for the chain directory fl, replacing the old one
+    in one step'''
+
+    write_json(os.path.join(fl, 'header.json'), header)
+
+def info_path(fl):
+    '''Returns the run info file of the .dat chain fl'''
+    return fl[:-4] + '.header.json'
+
+def read_info(fl):
+    '''Reads the run info of the .dat chain fl (empty if there is none)'''
+
+    if not os.path.exists(info_path(fl)):
+        return {}
+    f = open(info_path(fl), 'r')
+    info = json.load(f)
+    f.close()
+
+    return info
+
+def read_header(fl):
+    f = open(os.path.join(fl, 'header.json'), 'r')
+    header = json.load(f)
+    f.close()
+
+    return header
+
+class BinaryChainWriter(object):
+    '''Writes the sampler steps into a binary chain directory fl (see top of
+    file). The arrays are preallocated for niter steps and memory-mapped, so
+    writing a step is a copy into the map. Every flushevery steps or flushtime
+    seconds the maps are synced and nsteps in the header updated, so a crashed
+    run is readable up to the last flush. initial are the starting positions,
+    used for the acceptance of the first step. To continue an existing chain,
+    resume is the mark() of the checkpoint and the arrays are reopened, with
+    the steps after it overwritten.'''
+
+    def __init__(self, fl, nwalkers, ndim, niter, header = None, initial = None, \
+            flushevery = 100, flushtime = 60., resume = None):
+        self.fl = fl
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.flushevery = max(int(flushevery), 1)
+        self.flushtime = flushtime
+
+        if resume is not None:
+            self.chain = open_memmap(os.path.join(fl, 'chain.npy'), mode = 'r+')
+            self.accepted = open_memmap(os.path.join(fl, 'accepted.npy'), mode = 'r+')
+            self.header = read_header(fl)
+            self.nsteps = resume['nsteps']
+            self.previous = np.array(self.chain[self.nsteps - 1, :, :-1])
+            self.nflushed = self.nsteps
+            self.lastflush = time.time()
+            self.header['nsteps'] = self.nsteps
+            write_header(fl, self.header)
+            return
+
+        if not os.path.exists(fl):
+            os.makedirs(fl)
+
+        self.chain = open_memmap(os.path.join(fl, 'chain.npy'), mode = 'w+', \
+                dtype = np.float64, shape = (niter, nwalkers, ndim + 1))
+        self.accepted = open_memmap(os.path.join(fl, 'accepted.npy'), mode = 'w+', \
+                dtype = np.bool_, shape = (niter, nwalkers))
+
+        self.header = dict(header) if header else {}
+        self.header.setdefault('niter', niter)
+        self.header.update({'version': CHAIN_VERSION, 'nwalkers': nwalkers, \
+                'ndim': ndim, 'nsteps': 0})
+        write_header(fl, self.header)
+
+        if initial is not None:
+            self.previous = np.array(initial, dtype = np.float64)
+        else:
+            self.previous = None
+        self.nsteps = 0
+        self.nflushed = 0
+        self.lastflush = time.time()
+
+    def write(self, coords, log_prob):
+        '''Adds one step of the sampler to the chain'''
+
+        step = self.chain[self.nsteps]
+        step[:, :-1] = coords
+        step[:, -1] = log_prob
+        if self.previous is not None:
+            self.accepted[self.nsteps] = np.any(step[:, :-1] != self.previous, axis = 1)
+        self.previous = step[:, :-1]
+        self.nsteps += 1
+
+        if (self.nsteps - self.nflushed >= self.flushevery) or \
+                (time.time() - self.lastflush > self.flushtime):
+            self.flush()
+
+    def flush(self):
+        '''Syncs the written steps to disk and records them in the header'''
+
+        if self.nsteps > self.nflushed:
+            self.chain.flush()
+            self.accepted.flush()
+            self.header['nsteps'] = self.nsteps
+            write_header(self.fl, self.header)
+            self.nflushed = self.nsteps
+        self.lastflush = time.time()
+
+    def checkpoint(self):
+        self.flush()
+
+    def update_header(self, info):
+        '''Merges info (a dict) into the chain header'''
+
+        self.header.update(info)
+        write_header(self.fl, self.header)
+
+    def mark(self):
+        '''Flushes the chain to disk and returns where it ends, for
+        write_state'''
+
+        self.flush()
+        return {'nsteps': self.nsteps}
+
+    def close(self):
+        if self.chain is not None:
+            self.flush()
+            self.chain = None
+            self.accepted = None
+            self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def state_path(fl):
+    '''Returns the sampler checkpoint file of the chain fl'''
+
+    if fl.endswith('.dat'):
+        return fl[:-4] + '.state'
+    return os.path.join(fl, 'state.pkl')
+
+def write_state(fl, state):
+    '''Writes the sampler checkpoint of the chain fl (a dict with the walker
+    coordinates, log_prob, blobs, random state, the chain mark() and anything
+    needed to restart the run), replacing the old one in one step'''
+
+    path = state_path(fl)
+    f = open(path + '.tmp', 'wb')
+    pickle.dump(state, f, protocol = 2)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(path + '.tmp', path)
+
+def read_state(fl):
+    '''Reads the sampler checkpoint of the chain fl'''
+
+    f = open(state_path(fl), 'rb')
+    state = pickle.load(f)
+    f.close()
+
+    return state
+
+def reopen_chain(fl, state, flushevery = 100):
+    '''Reopens the chain fl to continue it from the checkpoint state (see
+    read_state). Returns the writer.'''
+
+    nwalkers, ndim = np.shape(state['coords'])
+    if fl.endswith('.dat'):
+        return ChainWriter(fl, nwalkers, ndim, flushevery = flushevery, \
+                resume = state['chain'])
+
+    return BinaryChainWriter(fl, nwalkers, ndim, None, flushevery = flushevery, \
+            resume = state['chain'])
+
+def read_steps(fl, nsteps):
+    '''Returns the first nsteps steps of the chain fl (binary or .dat) as an
+    (nsteps, nwalkers, ndim+1) array of positions and log probability'''
+
+    if is_binary_chain(fl):
+        return np.array(np.load(os.path.join(fl, 'chain.npy'), mmap_mode = 'r')[:nsteps])
+
+    header = read_dat_header(fl)
+    nwalkers = header['nwalkers']
+    data = np.array(pd.read_csv(fl, comment = '#', header = None, sep = r'\s+', \
+            nrows = nsteps * nwalkers), dtype = np.float64)
+
+    return data.reshape((nsteps, nwalkers, -1))[:, :, 1:]
+
+def write_dat_header(fl, header):
+    '''Starts the .dat chain fl with the header lines for the run'''
+
+    if os.path.exists(info_path(fl)):
+        os.remove(info_path(fl))
+    f = open(fl, "w")
+    f.write("#NWalk\tNStep\tGal\tFit\n")
+    f.write("#%d\t%d\t%s\t%s\n" % (header['nwalkers'], header['niter'], \
+            header['gal'], header['fit']))
+    f.write("#%s\n" % ('\t'.join(header['paramnames'])))
+    if 'linenames' in header:
+        strparamdict = '    '.join(['%s: %s' % (key, header['paramdict'][key]) \
+                for key in header['paramdict'].keys()])
+        f.write("#%s\n" % ('\t'.join(header['linenames'])))
+        f.write("#%s\n" % (strparamdict))
+        f.write('#'+header['comments']+'\n')
+    f.close()
+
+def open_chain(fl, nwalkers, ndim, niter, header, chainformat = 'npy', \
+        initial = None, flushevery = 100):
+    '''Creates the chain output for a run. fl is the chain name without an
+    extension: chainformat 'npy' writes the binary chain fl.chain, 'dat' the
+    text chain fl.dat. Returns the writer and the chain filename.'''
+
+    header = dict(header)
+    header.update({'nwalkers': nwalkers, 'niter': niter})
+
+    if chainformat == 'dat':
+        fl = fl + '.dat'
+        write_dat_header(fl, header)
+        writer = ChainWriter(fl, nwalkers, ndim, flushevery = flushevery)
+    elif chainformat == 'npy':
+        fl = fl + '.chain'
+        writer = BinaryChainWriter(fl, nwalkers, ndim, niter, header = header, \
+                initial = initial, flushevery = flushevery)
+    else:
+        raise ValueError("Unknown chain format: %s" % (chainformat))
+
+    return writer, fl
+
+def load_chain(fl):
+    '''Memory-maps a binary chain. Returns the header, the (nsteps, nwalkers,
+    ndim+1) chain and the (nsteps, nwalkers) acceptance array, cut to the
+    steps that were written.'''
+
+    header = read_header(fl)
+    nsteps = header['nsteps']
+    chain = np.load(os.path.join(fl, 'chain.npy'), mmap_mode = 'r')[:nsteps]
+    accepted = np.load(os.path.join(fl, 'accepted.npy'), mmap_mode = 'r')[:nsteps]
+
+    return header, chain, accepted
+
+def read_dat_header(fl, linesoverride = False):
+    '''Reads the header of a .dat chain written by do_mcmc into a binary
+    chain header dict'''
+
+    fittype = os.path.basename(fl).split('_')[-1][:-4]
+    lines = (fittype == 'fullindex') or linesoverride
+
+    f = open(fl, 'r')
+    comments = []
+    for line in f:
+        if line[0] != '#':
+            break
+        comments.append(line[1:].strip('\n'))
+    f.close()
+
+    values = comments[1].split()
+    header = {'nwalkers': int(values[0]), 'niter': int(values[1]), \
+            'gal': values[2], 'fit': values[3], 'paramnames': comments[2].split(), \
+            'linenames': [], 'paramdict': {}, 'comments': ''}
+
+    if lines:
+        if len(comments) > 3:
+            header['linenames'] = comments[3].split()
+        if len(comments) > 4:
+            dictline = comments[4].split()
+            for k in range(0, len(dictline)-1, 2):
+                if dictline[k+1] == 'None':
+                    header['paramdict'][dictline[k][:-1]] = None
+                else:
+                    header['paramdict'][dictline[k][:-1]] = float(dictline[k+1])
+        else:
+            for param in header['paramnames']:
+                header['paramdict'][param] = None
+        if len(comments) > 5:
+            header['comments'] = comments[5]
+
+    for key, value in read_info(fl).items():
+        header.setdefault(key, value)
+
+    return header
+
+def convert_dat(fl, outfl = None, linesoverride = False, chunksteps = 1000):
+    '''Converts the .dat chain fl into a binary chain (by default fl with
+    .dat replaced by .chain). Incomplete final steps are dropped.'''
+
+    if outfl is None:
+        outfl = os.path.splitext(fl)[0] + '.chain'
+
+    header = read_dat_header(fl, linesoverride = linesoverride)
+    nwalkers = header['nwalkers']
+    ndim = len(header['paramnames'])
+
+    # Count the data lines so the chain can be preallocated
+    nlines = 0
+    f = open(fl, 'r')
+    for line in f:
+        if line[0] != '#':
+            nlines += 1
+    f.close()
+    nsteps = nlines // nwalkers
+    if nlines % nwalkers != 0:
+        print("FILE HAS INCOMPLETE STEP...REMOVING")
+
+    writer = BinaryChainWriter(outfl, nwalkers, ndim, nsteps, header = header, \
+            flushevery = chunksteps)
+    reader = pd.read_csv(fl, comment = '#', header = None, sep = r'\s+', \
+            chunksize = chunksteps * nwalkers)
+    for chunk in reader:
+        data = np.array(chunk, dtype = np.float64)
+        nchunk = min(len(data) // nwalkers, nsteps - writer.nsteps)
+        data = data[:nchunk * nwalkers].reshape((nchunk, nwalkers, ndim + 2))
+        for step in data:
+            writer.write(step[:, 1:-1], step[:, -1])
+    writer.close()
+
+    print("Converted %s -> %s (%i steps)" % (fl, outfl, nsteps))
+    return outfl
+
+if __name__ == '__main__':
+    for fl in sys.argv[1:]:
+        convert_dat(fl)
@@ -0,0 +1,71 @@
+################################################################################
+#   Pseudo-continuum normalization for the index and full spectrum fits.
+#   The passbands and polynomial projections of each band are worked out once
+#   so removing the continuum in the likelihood is a few dot products, with
+#   no np.where or np.polyfit calls per step.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+def passband(wl, low, high):
+    '''Returns the pixels of wl within [low, high], as a slice when they are
+    contiguous'''
+
+    idx = np.where((wl >= low) & (wl <= high))[0]
+    if len(idx) > 0 and idx[-1] - idx[0] == len(idx) - 1:
+        return slice(idx[0], idx[-1] + 1)
+
+    return idx
+
+class LineContinuum(object):
+    '''Straight line through the mean flux in the blue and red passbands of a
+    spectrum on wl, evaluated at wlout. This is the same continuum as
+    mcmc_support.removeLineSlope (a polyfit through the two points).'''
+
+    def __init__(self, wl, bluelow, bluehigh, redlow, redhigh, wlout):
+        self.blue = passband(wl, bluelow, bluehigh)
+        self.red = passband(wl, redlow, redhigh)
+
+        blueavg = np.mean([bluelow, bluehigh])
+        redavg = np.mean([redlow, redhigh])
+        self.t = (np.asarray(wlout) - blueavg) / (redavg - blueavg)
+
+    def __call__(self, spec):
+        '''Returns the continuum at wlout for a spectrum, or for each row of
+        an (n, nwl) array of spectra'''
+
+        blueval = np.mean(spec[..., self.blue], axis=-1)[..., None]
+        redval = np.mean(spec[..., self.red], axis=-1)[..., None]
+
+        return blueval + (redval - blueval) * self.t
+
+class PolyContinuum(object):
+    '''Least-squares polynomial of the given order through values at wl, the
+    same fit as np.poly1d(np.polyfit(wl, y, order))(wl). The fit is the
+    projection onto the polynomials on wl, precomputed from the QR
+    decomposition of the (rescaled) Vandermonde matrix.'''
+
+    def __init__(self, wl, order):
+        wl = np.asarray(wl, dtype=float)
+        x = (wl - wl.mean()) / (np.ptp(wl) / 2.)
+        self.Q = np.linalg.qr(np.vander(x, order + 1))[0]
+
+    def __call__(self, y):
+        '''Returns the fitted polynomial at wl for y, or for each row of an
+        (n, len(wl)) array'''
+
+        return np.dot(np.dot(y, self.Q), self.Q.T)
+
+def line_continua(wl, linedefs, wlouts, bands):
+    '''Returns a dict of LineContinuum for each band number in bands, with the
+    passbands of linedefs = [bluelow, bluehigh, redlow, redhigh] on wl and
+    evaluated at wlouts[band]'''
+
+    continua = {}
+    for i in bands:
+        continua[i] = LineContinuum(wl, linedefs[0][i], linedefs[1][i], \
+                linedefs[2][i], linedefs[3][i], wlouts[i])
+
+    return continua
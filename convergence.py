@@ -0,0 +1,84 @@
+################################################################################
+#   Convergence monitoring for the mcmc programs.
+#   ConvergenceMonitor estimates the integrated autocorrelation time of each
+#   parameter from the sampler's in-memory chain every few hundred steps
+#   (emcee.autocorr) and reports when the chain is long enough to stop: longer
+#   than ntau autocorrelation times with tau no longer changing.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+
+class ConvergenceMonitor(object):
+    '''Checks the autocorrelation time of a running emcee sampler every
+    `every` steps. The chain counts as converged when it is longer than ntau
+    times the largest tau and every tau changed by less than the fraction
+    tautol since the previous check. The history of the estimates is kept
+    for the chain header (see diagnostics()). stopped records whether the
+    run was ended early because of it.'''
+
+    def __init__(self, paramnames, every = 100, ntau = 50., tautol = 0.01):
+        self.paramnames = list(paramnames)
+        self.every = max(int(every), 1)
+        self.ntau = ntau
+        self.tautol = tautol
+
+        self.iterations = []
+        self.taus = []
+        self.converged = False
+        self.convergedat = None
+        self.stopped = False
+
+    def restore(self, info):
+        '''Continues from the diagnostics() of an earlier part of the run'''
+
+        self.iterations = list(info['iterations'])
+        self.taus = [np.array(tau) for tau in info['tau']]
+        self.converged = info['converged']
+        self.convergedat = info['convergedat']
+
+    def due(self, iteration):
+        '''Returns True if a check is due after iteration steps'''
+        return iteration % self.every == 0
+
+    def check(self, sampler, iteration):
+        '''Estimates tau from the sampler's chain, prints it and returns True
+        once the chain has converged'''
+
+        tau = sampler.get_autocorr_time(tol = 0)
+
+        if len(self.taus) > 0:
+            change = np.abs(self.taus[-1] - tau) / tau
+        else:
+            change = np.full(len(tau), np.inf)
+        self.iterations.append(iteration)
+        self.taus.append(tau)
+
+        print("Autocorrelation times at step %i (%.0f taus, change %.1f%%):" % \
+                (iteration, iteration / np.max(tau), 100. * np.max(change)))
+        print('    ' + '  '.join(['%s: %.1f' % (param, t) for param, t in \
+                zip(self.paramnames, tau)]))
+
+        if np.all(np.isfinite(tau)) and np.all(self.ntau * tau < iteration) and \
+                np.all(change < self.tautol):
+            if not self.converged:
+                self.converged = True
+                self.convergedat = iteration
+                print("Chain converged at step %i" % (iteration))
+
+        return self.converged
+
+    def diagnostics(self):
+        '''Returns a dict of the convergence settings and tau estimates for the
+        chain header'''
+
+        info = {'every': self.every, 'ntau': self.ntau, 'tautol': self.tautol, \
+                'converged': self.converged, 'convergedat': self.convergedat, \
+                'stopped': self.stopped, \
+                'iterations': self.iterations, \
+                'tau': [tau.tolist() for tau in self.taus]}
+        if len(self.taus) > 0:
+            info['taufinal'] = dict(zip(self.paramnames, self.taus[-1].tolist()))
+
+        return info
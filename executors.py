@@ -0,0 +1,251 @@
+################################################################################
+#   Worker pools for the mcmc programs.
+#   make_pool returns the pool the likelihood is spread over, selected by name:
+#       process -- multiprocessing.Pool on this node
+#       thread  -- a thread pool in this process (numpy releases the GIL)
+#       mpi     -- the ranks of an MPI job (mpi4py), spanning nodes. Run with
+#                  mpiexec; rank 0 runs the fits and the other ranks serve()
+#       local   -- the same master/worker protocol as mpi with ranks started
+#                  as local processes, to run and test it on one machine
+#   The mpi and local pools follow the schwimmbad MPIPool interface (map,
+#   is_master, wait, close) and, like multiprocessing.Pool, run an initializer
+#   on every worker, so the workers attach to the model grid the same way.
+################################################################################
+
+from __future__ import print_function
+
+import os
+import atexit
+import traceback
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+EXECUTORS = ['process', 'thread', 'mpi', 'local']
+
+mpipool = None
+
+def mpi_comm():
+    '''Returns MPI.COMM_WORLD, importing mpi4py only when the mpi pool is
+    used'''
+
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        raise ImportError("The mpi executor needs mpi4py")
+
+    return MPI.COMM_WORLD
+
+def is_master(executor = 'mpi'):
+    '''Returns False on the worker ranks of an MPI job'''
+
+    if executor != 'mpi':
+        return True
+    return mpi_comm().Get_rank() == 0
+
+class MPIComm(object):
+    '''Point to point messages between the ranks of an MPI communicator'''
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.workers = list(range(1, comm.Get_size()))
+
+    def send(self, msg, dest):
+        self.comm.send(msg, dest = dest)
+
+    def recv(self):
+        '''Returns (source rank, message) of the next message to this rank'''
+
+        from mpi4py import MPI
+        status = MPI.Status()
+        msg = self.comm.recv(source = MPI.ANY_SOURCE, status = status)
+        return status.Get_source(), msg
+
+class LocalComm(object):
+    '''Stand-in for MPIComm between local processes: each rank reads from its
+    own queue, rank 0 being the master'''
+
+    def __init__(self, queues, rank = 0):
+        self.queues = queues
+        self.rank = rank
+        self.workers = list(range(1, len(queues)))
+
+    def send(self, msg, dest):
+        self.queues[dest].put((self.rank, msg))
+
+    def recv(self):
+        return self.queues[self.rank].get()
+
+def serve(comm = None):
+    '''Worker loop: runs the initializers and tasks sent by the master until
+    it closes the pool. With no comm, this is a worker rank of
+    MPI.COMM_WORLD.'''
+
+    if comm is None:
+        comm = MPIComm(mpi_comm())
+
+    while True:
+        source, msg = comm.recv()
+        if msg[0] == 'stop':
+            break
+
+        try:
+            if msg[0] == 'init':
+                msg[1](*msg[2])
+                continue
+            taskid, func, args = msg[1:]
+            comm.send((taskid, True, [func(arg) for arg in args]), source)
+        except Exception:
+            error = traceback.format_exc()
+            if msg[0] == 'init':
+                print("Worker %i failed to initialize:\n%s" % (comm.rank, error))
+            else:
+                comm.send((taskid, False, error), source)
+
+def serve_local(queues, rank):
+    '''Process target of the ranks of a LocalPool'''
+    serve(LocalComm(queues, rank))
+
+class MasterPool(object):
+    '''Master side of the mpi and local pools. map() hands the tasks out in
+    chunks to whichever worker is free and returns the results in order.
+    Tasks are tagged with the number of the map() call, so a reply left
+    over from an earlier call is never taken for one of this call.'''
+
+    def __init__(self, comm):
+        self.comm = comm
+        self.workers = comm.workers
+        self.size = len(self.workers)
+        self.ncalls = 0
+        if self.size == 0:
+            raise ValueError("The pool needs at least one worker rank")
+
+    def is_master(self):
+        return self.comm.rank == 0
+
+    def wait(self):
+        '''Worker ranks serve tasks until the pool is closed'''
+        if not self.is_master():
+            serve(self.comm)
+
+    def initialize(self, initializer, initargs = ()):
+        '''Runs initializer(*initargs) on every worker before its next task'''
+
+        for worker in self.workers:
+            self.comm.send(('init', initializer, tuple(initargs)), worker)
+
+    def map(self, func, iterable, chunksize = 1):
+        '''Returns [func(task) for task in iterable]. If a task fails, the
+        tasks already handed out are collected before the first error is
+        raised, so no reply is left pending.'''
+
+        tasks = list(iterable)
+        chunks = [tasks[i:i+chunksize] for i in range(0, len(tasks), chunksize)]
+        results = [None] * len(chunks)
+        call = self.ncalls
+        self.ncalls += 1
+
+        idle = list(self.workers)
+        nsent = 0
+        npending = 0
+        error = None
+        while (nsent < len(chunks) and error is None) or npending > 0:
+            while idle and nsent < len(chunks) and error is None:
+                self.comm.send(('task', (call, nsent), func, chunks[nsent]), idle.pop())
+                nsent += 1
+                npending += 1
+
+            source, (taskid, ok, result) = self.comm.recv()
+            if taskid[0] != call:
+                continue
+            idle.append(source)
+            npending -= 1
+            if not ok:
+                if error is None:
+                    error = "Task failed on worker %i:\n%s" % (source, result)
+                continue
+            results[taskid[1]] = result
+
+        if error is not None:
+            raise RuntimeError(error)
+
+        return [result for chunk in results for result in chunk]
+
+    def stop(self):
+        '''Ends the worker loops'''
+
+        for worker in self.workers:
+            self.comm.send(('stop',), worker)
+
+class MPIPool(MasterPool):
+    '''Pool over the ranks of MPI.COMM_WORLD. The worker ranks keep serving
+    between runs, so close() leaves them running and they are stopped when
+    the master exits.'''
+
+    def __init__(self):
+        MasterPool.__init__(self, MPIComm(mpi_comm()))
+        atexit.register(self.stop)
+
+    def close(self):
+        pass
+
+class LocalPool(MasterPool):
+    '''Pool of nranks local processes speaking the mpi protocol'''
+
+    def __init__(self, nranks):
+        ctx = mp.get_context()
+        queues = [ctx.Queue() for i in range(nranks + 1)]
+        self.procs = [ctx.Process(target = serve_local, args = (queues, rank)) \
+                for rank in range(1, nranks + 1)]
+        for proc in self.procs:
+            proc.daemon = True
+            proc.start()
+        MasterPool.__init__(self, LocalComm(queues))
+
+    def close(self):
+        if self.procs:
+            self.stop()
+            for proc in self.procs:
+                proc.join()
+            self.procs = []
+
+def make_pool(executor = 'process', processes = None, initializer = None, \
+        initargs = ()):
+    '''Returns a pool of the given executor (see top of file) with processes
+    workers (the MPI job size for mpi), with initializer(*initargs) run on
+    each worker. The thread pool shares this process, so the initializer is
+    run once here.'''
+    global mpipool
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    if executor == 'process':
+        return mp.Pool(processes = processes, initializer = initializer, \
+                initargs = initargs)
+    elif executor == 'thread':
+        if initializer is not None:
+            initializer(*initargs)
+        return ThreadPool(processes = processes)
+    elif executor == 'mpi':
+        if mpipool is None:
+            mpipool = MPIPool()
+        pool = mpipool
+    elif executor == 'local':
+        pool = LocalPool(processes)
+    else:
+        raise ValueError("Unknown executor: %s (use one of %s)" % (executor, \
+                ', '.join(EXECUTORS)))
+
+    if initializer is not None:
+        pool.initialize(initializer, initargs)
+    print("Using the %s pool with %i workers" % (executor, pool.size))
+
+    return pool
+
+def pool_size(pool):
+    '''Returns the number of workers of a make_pool pool'''
+
+    if hasattr(pool, 'size'):
+        return pool.size
+    return pool._processes
@@ -217,13 +217,19 @@ def calculate_alpha(fl, burnin = -1000, vcjset = None, verbose = False):
     return MLR, MLRDict, paramnames, midvalues, histprint, mlrarr, percentiles, fullMLR
 
 def calculate_alpha_new(fl, burnin = -1000, vcjset = None, verbose = False, limited=False,\
-        linesoverride = False):
+        linesoverride = False, cachetol = None):
     '''
     New version of calculate_alpha that estimates alpha for every MCMC step in
     the posterior distributions specified by burnin. In addition, this function
     incorporates a new estimate for the remnant mass fraction.
+    The MW and best-fit IMF spectra of a step share the same (Z, Age), and
+    repeated steps the same parameters, so the base spectra are cached (see
+    mcfi.set_model_cache; cachetol rounds Z and Age for the lookup).
     '''
 
+    if (mcfi.model_cache is None) or (mcfi.model_cache.tol != cachetol):
+        mcfi.set_model_cache(tol = cachetol)
+
     # Load the MCMC data, parameters, line names
     data, postprob, info, lastdata = mcsp.load_mcmc_file(fl, linesoverride=linesoverride)
     gal = info[2]
@@ -315,6 +321,8 @@ def calculate_alpha_new(fl, burnin = -1000, vcjset = None, verbose = False, limi
     
     percentiles = np.percentile(AlphaArr, [16,50,84], axis = 0)
     print(fl, percentiles)
+    if verbose:
+        print(mcfi.model_cache)
 
     return AlphaArr
 
@@ -19,10 +19,20 @@ import scipy.interpolate as spi
 import warnings
 import sys, os
 import mcmc_support as mcsp
+import model_grid as mg
+import chain_io as mcio
+import convergence as conv
+import sampling as smp
+import executors as exe
+import scheduler as sched
+import prefit as pfit
+import abundance_response as abr
+import continuum as contm
+import band_chisq as bchi
 import prepare_spectra as preps
 import plot_corner as plcr
 from random import uniform
-from multiprocessing import Pool
+from functools import partial
 
 warnings.simplefilter('ignore', np.RankWarning)
 
@@ -52,6 +62,9 @@ chem_names = ['Solar', 'Na+', 'Na-', 'Ca+', 'Ca-', 'Fe+', 'Fe-', 'C+', 'C-', \
                 'Si+', 'Si-', 'T+', 'T-', 'Cr+', 'Mn+', 'Ba+', 'Ba-', 'Ni+', \
                 'Co+', 'Eu+', 'Sr+', 'K+', 'V+', 'Cu+', 'Na+0.6', 'Na+0.9']
 
+#Abundance model columns read by model_spec
+abundi = [0,1,2,-2,-1,29,16,15,6,5,4,3,8,7,18,17,14,13,21]
+
 #Dictionary to help easily access the IMF index
 imfsdict = {}
 for i in range(16):
@@ -59,64 +72,43 @@ for i in range(16):
         imfsdict[(x1_m[i],x1_m[j])] = i*16 + j
 
 vcj = {}
+vcj_args = {}
+lnprob_args = ()
+model_cache = None
+
+# 'interp' interpolates the IMF models bilinearly in (x1, x2), 'snap' uses
+# the nearest IMF model as the original code did
+imfmode = 'interp'
 
-def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=False):
+def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=False, \
+        usecache = True, shared = False, dtype = None, lazy = False):
     '''Loads the SSP models into memory so the mcmc model creation takes a
-    shorter time. Returns a dict with the filenames as the keys'''
+    shorter time. Returns a dict with the filenames as the keys. The models are
+    read from the binary cache (see model_grid.py) when it is fresh.
+
+    If shared, the model grid is memory-mapped read-only from the cache so
+    every Pool worker uses the same copy of the grid. The interpolators are
+    built on views of the grid in either case. dtype = 'float32' halves the
+    memory of the grid; check it with validate_grid_dtype first.
+
+    If lazy, the grid is memory-mapped and the interpolators start empty:
+    load_fit_columns reads the model columns a fit can reach and any other
+    column is read from the cache when first used.'''
     #global vcjfull
     #global base
 
-    vcj = {}
+    grid = mg.load_grid(overwrite_base, usecache = usecache, mmap = shared or lazy, \
+            dtype = dtype)
+    vcj = mg.grid_to_vcj(grid)
 
-    if overwrite_base:
-        base = overwrite_base
-    else:
-        base = os.path.dirname(os.path.realpath(sys.argv[0])) + '/'
-
-    chem_names = ['WL', 'Solar', 'Na+', 'Na-', 'Ca+', 'Ca-', 'Fe+', 'Fe-', \
-            'C+', 'C-', 'a/Fe+', 'N+', 'N-', 'as/Fe+', 'Ti+', 'Ti-',\
-            'Mg+', 'Mg-', 'Si+', 'Si-', 'T+', 'T-', 'Cr+', 'Mn+', 'Ba+', \
-            'Ba-', 'Ni+', 'Co+', 'Eu+', 'Sr+', 'K+','V+', 'Cu+', 'Na+0.6', 'Na+0.9']
-
-    print("PRELOADING SSP MODELS INTO MEMORY")
-    fls = glob(base+'spec/vcj_ssp/*')    
-
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[3][1:])
-        Zsign = mnamespl[4][1]
-        Zval = float(mnamespl[4][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        x = pd.read_csv(fl, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)] = [x[:,1:]]
-
-    print("PRELOADING ABUNDANCE MODELS INTO MEMORY")
-    fls = glob(base+'spec/atlas/*')    
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[2][1:])
-        Zsign = mnamespl[3][1]
-        Zval = float(mnamespl[3][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        if age == 13.0:
-            age = 13.5
-
-        x = pd.read_csv(fl, skiprows=2, names = chem_names, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)].append(x[:,1:])
-
-    vcj["WL"] = x[:,0]
+    # Remembered so Pool workers can attach to the same grid (see init_worker)
+    vcj_args.clear()
+    vcj_args.update({'overwrite_base': overwrite_base, 'sauron': sauron, \
+            'saurononly': saurononly, 'MLR': MLR, 'usecache': usecache, \
+            'shared': shared, 'dtype': dtype, 'lazy': lazy})
     print("FINISHED LOADING MODELS")
 
-    print("Calculating IMF interpolators")
+    print("Calculating grid interpolators")
     wlfull = vcj["WL"]
     if sauron:
         rel = np.where((wlfull > 4000) & (wlfull < 14000))[0]
@@ -126,42 +118,215 @@ def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=Fals
         rel = np.where((wlfull > 20000) & (wlfull < 24000))[0]
     else:
         rel = np.where((wlfull > 8500) & (wlfull < 14000))[0]
+    rel = slice(rel[0], rel[-1] + 1)
     wl = wlfull[rel]
 
-    fullage = np.array([1.0,3.0,5.0,7.0,9.0,11.0,13.5])
-    fullZ = np.array([-1.5, -1.0, -0.5, 0.0, 0.2])
-
-    imf_interp = []
-    for k in range(vcj['3.0_0.0'][0].shape[1]):
-        out = np.meshgrid(fullage,fullZ,wl)
-        grid = (out[0],out[1],out[2])
-        newgrid = np.zeros(out[0].shape)
-        for i,age in enumerate(fullage):
-            for j,z in enumerate(fullZ):
-                #print(vcj["%.1f_%.1f" % (age, z)][0][rel,73].shape)
-                newgrid[j,i,:] = vcj["%.1f_%.1f" % (age, z)][0][rel,k]
-        fulli = spi.RegularGridInterpolator((fullZ,fullage,wl), newgrid)
-        imf_interp.append(fulli)
-    
-    print("Calculating elemental interpolators")
-    ele_interp = []
-    for k in range(vcj['3.0_0.0'][1].shape[1]):
-        out = np.meshgrid(fullage,fullZ,wl)
-        grid = (out[0],out[1],out[2])
-        newgrid = np.zeros(out[0].shape)
-        for i,age in enumerate(fullage):
-            for j,z in enumerate(fullZ):
-                newgrid[j,i,:] = vcj["%.1f_%.1f" % (age, z)][1][rel,k]
-        fulli = spi.RegularGridInterpolator((fullZ,fullage,wl), newgrid)
-        ele_interp.append(fulli)
-    
+    fullage = grid['Age']
+    fullZ = grid['Z']
+
+    cols = [] if lazy else None
+    imf_interp = mg.GridInterpolator(fullZ, fullage, wl, grid['imf'][:,:,:,rel], \
+            cols = cols)
+    ele_interp = mg.GridInterpolator(fullZ, fullage, wl, grid['abund'][:,:,:,rel], \
+            cols = cols)
+
     return vcj, imf_interp, ele_interp
 
+def fit_columns(paramnames, paramdict):
+    '''Returns the IMF and abundance model columns a fit with paramnames free
+    (within the priors) and paramdict can reach'''
+
+    bounds = dict(zip(paramnames, prior_bounds(paramnames)))
+    ranges = {}
+    for param in ['x1', 'x2']:
+        if param in bounds:
+            ranges[param] = bounds[param]
+        elif paramdict.get(param) != None:
+            ranges[param] = (paramdict[param], paramdict[param])
+    if 'x1' not in ranges:
+        ranges['x1'] = (1.3, 1.3)
+
+    # Without x2, model_spec takes x2 = x1 (before a fixed x1 is filled in)
+    if 'x2' not in ranges and 'x1' not in paramnames:
+        ranges['x2'] = (1.3, 1.3)
+    imfcols = mg.imf_reach(x1_m, x2_m, ranges['x1'], ranges.get('x2'))
+    imfcols = np.union1d(imfcols, [imfsdict[(1.3,2.3)]])
+
+    return imfcols, np.array(abundi)
+
+def load_fit_columns(paramnames, paramdict):
+    '''Reads the model columns of the fit into a lazy grid (see preload_vcj)'''
+
+    if not vcj_args.get('lazy'):
+        return
+    imfcols, abundcols = fit_columns(paramnames, paramdict)
+    vcj[1].load(imfcols)
+    vcj[2].load(abundcols)
+    print("Loaded %i of %i IMF and %i of %i abundance model columns" % \
+            (vcj[1].loaded(), len(vcj[1]), vcj[2].loaded(), len(vcj[2])))
+
+def init_worker(args, likeargs = None, cacheargs = None, imf = None):
+    '''Pool initializer. Forked workers already share the parent's models,
+    spawned workers re-attach to the memory-mapped model cache using the
+    arguments preload_vcj was called with. likeargs are the static lnprob
+    arguments (see set_lnprob_args), cacheargs the set_model_cache
+    arguments and imf the imfmode.'''
+    global vcj, imfmode
+
+    if len(vcj) == 0 and args:
+        vcj = preload_vcj(**args)
+        if likeargs is not None:
+            load_fit_columns(likeargs[3], likeargs[4])
+    if likeargs is not None:
+        set_lnprob_args(likeargs)
+    if cacheargs is not None:
+        set_model_cache(**cacheargs)
+    if imf is not None:
+        imfmode = imf
+
+def set_lnprob_args(args):
+    '''Installs the static lnprob arguments (spectra, band definitions, etc)
+    used by lnprob_theta'''
+    global lnprob_args
+
+    lnprob_args = tuple(args)
+
+def set_model_cache(maxbytes = 256*2**20, tol = None):
+    '''Turns on the LRU cache of interpolated base and abundance spectra used
+    by model_spec and model_spec_batch, holding at most maxbytes (0 turns it
+    off). With tol, Z and Age are rounded to multiples of tol and the spectra
+    computed there, so nearby walkers share entries; tol = None leaves the
+    results unchanged but only hits when the very same (Z, Age) comes back,
+    as in repeated evaluations (pre-fit restarts, the M/L post-processing in
+    masstolight.py). Walkers in a chain never repeat a position exactly, so
+    do_mcmc only uses the cache with a tol. Returns the cache.'''
+    global model_cache
+
+    if maxbytes:
+        model_cache = mg.SpectrumCache(maxbytes = maxbytes, tol = tol)
+    else:
+        model_cache = None
+
+    return model_cache
+
+def imf_columns(x1, x2):
+    '''Returns the IMF model columns and their weights for the model at
+    (x1, x2): the four bracketing models with bilinear weights, or with
+    imfmode 'snap' the nearest model. For arrays x1 and x2 the columns and
+    weights are (n, k) arrays.'''
+
+    cols, w = mg.imf_weights(x1_m, x2_m, np.atleast_1d(x1), np.atleast_1d(x2), \
+            snap = (imfmode == 'snap'))
+    if np.ndim(x1) == 0:
+        return cols[0], w[0]
+
+    return cols, w
+
+def model_cache_stats(*args):
+    '''Returns the process id and the model_cache statistics of this process'''
+
+    if model_cache is None:
+        return os.getpid(), None
+    return os.getpid(), model_cache.stats()
+
+def pooled_cache_stats(pool, nprocesses):
+    '''Sums the model_cache statistics of the pool workers. Returns a
+    summary string.'''
+
+    workers = dict(pool.map(model_cache_stats, range(4*nprocesses), chunksize = 1))
+    hits = sum([st['hits'] for st in workers.values() if st])
+    misses = sum([st['misses'] for st in workers.values() if st])
+    evictions = sum([st['evictions'] for st in workers.values() if st])
+
+    return "Spectrum cache (%i workers): %i hits, %i misses (%.1f%% hit rate), "\
+            "%i evictions" % (len(workers), hits, misses, \
+            100. * hits / max(hits + misses, 1), evictions)
+
+def cache_point(Z, Age):
+    '''Returns (Z, Age) rounded for model_cache, kept within the grid'''
+
+    if model_cache is None or not model_cache.tol:
+        return Z, Age
+
+    Z = np.clip(model_cache.quantize(Z), vcj[1].Z[0], vcj[1].Z[-1])
+    Age = np.clip(model_cache.quantize(Age), vcj[1].Age[0], vcj[1].Age[-1])
+    if np.ndim(Z) == 0:
+        return float(Z), float(Age)
+    return Z, Age
+
+def wl_key(wlsel):
+    '''Returns a hashable key for the wavelength selection wlsel'''
+
+    if isinstance(wlsel, slice):
+        return (wlsel.start, wlsel.stop)
+    wlsel = np.asarray(wlsel)
+    return (len(wlsel), hash(wlsel.tobytes()))
+
+def grid_columns(grid, Z, Age, cols, wlsel, weights = None):
+    '''Returns grid(Z, Age, cols) on wlsel as an (ncols, nwl) array, from
+    model_cache when it is on'''
+
+    if model_cache is None:
+        return grid(Z, Age, cols, weights = weights, wlsel = wlsel)
+
+    key = (id(grid), Z, Age, tuple(cols), wl_key(wlsel))
+    values = model_cache.get(key)
+    if values is None:
+        values = model_cache.put(key, grid(Z, Age, cols, weights = weights, \
+                wlsel = wlsel))
+
+    return values
+
+def grid_columns_batch(grid, Z, Age, cols, wlsel, weights = None, select = False):
+    '''Batch grid_columns: grid.batch(Z, Age, cols), an (n, ncols, nwl) array,
+    or with select grid.batch_select with the columns cols[k] for walker k,
+    an (n, ncols, nwl) array. With model_cache on, walkers are looked up one
+    by one (sharing entries with grid_columns) and the missing ones computed
+    together.'''
+
+    if select:
+        compute = grid.batch_select
+    else:
+        compute = grid.batch
+    if model_cache is None:
+        return compute(Z, Age, cols, weights = weights, wlsel = wlsel)
+
+    wlk = wl_key(wlsel)
+    if select:
+        keys = [(id(grid), z, a, tuple(col), wlk) for z, a, col in \
+                zip(Z.tolist(), Age.tolist(), np.asarray(cols).tolist())]
+    else:
+        keys = [(id(grid), z, a, tuple(cols), wlk) for z, a in \
+                zip(Z.tolist(), Age.tolist())]
+
+    found = {}
+    missing = {}
+    for n, key in enumerate(keys):
+        if key in found or key in missing:
+            continue
+        values = model_cache.get(key)
+        if values is None:
+            missing[key] = n
+        else:
+            found[key] = values
+
+    if missing:
+        idx = np.array(sorted(missing.values()))
+        if select:
+            new = compute(Z[idx], Age[idx], np.asarray(cols)[idx], wlsel = wlsel)
+        else:
+            new = compute(Z[idx], Age[idx], cols, wlsel = wlsel)
+        for n, values in zip(idx, new):
+            found[keys[n]] = model_cache.put(keys[n], values)
+
+    return np.array([found[key] for key in keys])
+
 def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False, timing = False, \
-        full = False, MLR=False, fixZ = False):
+        full = False, MLR=False, fixZ = False, plan = None):
     '''Core function which takes the input model parameters, finds the appropriate models,
     and adjusts them for the input abundance ratios. Returns a broadened model spectrum 
-    to be matched with a data spectrum.'''
+    to be matched with a data spectrum. If an evaluation plan is given (see
+    evaluation_plan) only the wavelengths it needs are computed.'''
 
     global vcj
 
@@ -234,13 +399,6 @@ def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False
     #if 'Z' not in paramnames:
     #    Z = 0.0
 
-    if x1 not in x1_m:
-        x1min = np.argmin(np.abs(x1_m - x1))
-        x1 = x1_m[x1min]
-    if x2 not in x2_m:
-        x2min = np.argmin(np.abs(x2_m - x2))
-        x2 = x2_m[x2min]
-
     #Finding the appropriate base model files.
     #fl1, fl2, fl3, fl4, agem, agep, zm, zp, mixage, mixZ = select_model_file(Z, Age)
 
@@ -266,16 +424,21 @@ def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False
     #fullage = np.array([1.0,3.0,5.0,7.0,9.0,11.0,13.5])
     #fullZ = np.array([-1.5, -1.0, -0.5, 0.0, 0.2])
     #abundi = [0,1,2,-2,-1,29,16,15,6,5,4,3]
-
-    abundi = [0,1,2,-2,-1,29,16,15,6,5,4,3,8,7,18,17,14,13,21]
-    imfinterp = vcj[1][imfsdict[(x1,x2)]]
-    mimf = imfinterp((Z,Age,wl))
-    baseinterp = vcj[1][imfsdict[(1.3,2.3)]]
-    basemodel = baseinterp((Z,Age,wl))
+    # The (Z, Age) weights are shared by the IMF and abundance grids
+    Z, Age = cache_point(Z, Age)
+    weights = vcj[1].weights(Z, Age)
+    if plan:
+        wlsel = plan['rows']
+        wl = vcj[1].wl[wlsel]
+    else:
+        wlsel = vcj[1].select(wl)
+    imfcols, imfw = imf_columns(x1, x2)
+    mimf = imfw.dot(grid_columns(vcj[1], Z, Age, imfcols, wlsel, weights = weights))
+    basemodel = grid_columns(vcj[1], Z, Age, [imfsdict[(1.3,2.3)]], wlsel, \
+            weights = weights)[0]
 
     c = np.zeros((len(wl), vcj[0]['3.0_0.0'][1].shape[1]))
-    for k in abundi:
-        c[:,k] = vcj[2][k]((Z,Age,wl))
+    c[:,abundi] = grid_columns(vcj[2], Z, Age, abundi, wlsel, weights = weights).T
 
     if timing:
         t3 = time.time()
@@ -290,27 +453,8 @@ def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False
     if saurononly:
         if 'Alpha' in paramdict.keys():
             alpha_contribution = 0.0
-
-            #Ca
-            interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,3])),\
-                    kind = 'linear')
-            alpha_contribution += interp(wl, alpha) / c[:,0] - 1.
-
-            #C
-            Cextend = (c[:,7]-c[:,0])*(0.3/0.15) + c[:,0]
-            interp = spi.interp2d(wl, [0.0,0.15,0.3], np.stack((c[:,0],c[:,7],Cextend)), \
-                    kind = 'linear')
-            alpha_contribution += interp(wl, alpha) / c[:,0] - 1.
-
-            #Mg
-            interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,15])), \
-                    kind = 'linear')
-            alpha_contribution += interp(wl, alpha) / c[:,0] - 1.
-
-            #Si
-            interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,17])), \
-                    kind = 'linear')
-            alpha_contribution += interp(wl, alpha) / c[:,0] - 1.
+            for element in abr.alpha_elements:
+                alpha_contribution += abr.response(element, alpha, c) - 1.
 
             basemodel = basemodel*(1 + alpha_contribution)
         return wl, mimf, basemodel
@@ -332,75 +476,36 @@ def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False
         #Na adjustment
     ab_contribution = np.ones(c[:,0].shape)
     if 'Na' in paramdict.keys():
-        Naextend = (c[:,2]-c[:,0])*(-0.5/-0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.6,0.9], \
-                np.stack((Naextend,c[:,2],c[:,0],c[:,1],c[:,-2],c[:,-1])), kind = 'cubic')
-        #NaP = interp(wl,Na) / c[:,0] - 1.
-        #ab_contribution += NaP
         if fixZ:
-            ab_contribution *= interp(wl,Z) / c[:,0]
+            ab_contribution *= abr.response('Na', Z, c)
         else:
-            ab_contribution *= interp(wl,Na) / c[:,0]
+            ab_contribution *= abr.response('Na', Na, c)
 
         #K adjustment (assume symmetrical K adjustment)
     if 'K' in paramdict.keys():
-        Kminus = (2. - (c[:,29] / c[:,0]))*c[:,0]
-        Kmextend = (Kminus - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Kpextend = (c[:,29] - c[:,0]) * (0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Kmextend,Kminus,c[:,0],c[:,29],Kpextend)), kind = 'linear')
-        #KP = interp(wl,K) / c[:,0] - 1.
-        #ab_contribution += KP
         if fixZ:
-            ab_contribution *= interp(wl,Z) / c[:,0]
+            ab_contribution *= abr.response('K', Z, c)
         else:
-            ab_contribution *= interp(wl,K) / c[:,0] 
+            ab_contribution *= abr.response('K', K, c)
 
         #Fe Adjustment
     if 'Fe' in paramdict.keys():
-        Femextend = (c[:,6] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Fepextend = (c[:,5] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Femextend,c[:,6], c[:,0],c[:,5],Fepextend)), kind = 'linear')
-        #FeP = interp(wl,Fe) / c[:,0] - 1.
-        #ab_contribution += FeP
         if fixZ:
-            ab_contribution *= interp(wl,Z) / c[:,0]
+            ab_contribution *= abr.response('Fe', Z, c)
         else:
-            ab_contribution *= interp(wl,Fe) / c[:,0]
+            ab_contribution *= abr.response('Fe', Fe, c)
 
         #Ca Adjustment
     if 'Ca' in paramdict.keys():
-        Cmextend = (c[:,4] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Cpextend = (c[:,3] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Cmextend,c[:,4], c[:,0],c[:,3],Cpextend)), kind = 'linear')
-        #CaP = interp(wl,Ca) / c[:,0] - 1.
-        #ab_contribution += CaP
         if fixZ:
-            ab_contribution *= interp(wl,Z) / c[:,0]
+            ab_contribution *= abr.response('Ca', Z, c)
         else:
-            ab_contribution *= interp(wl,Ca) / c[:,0]
+            ab_contribution *= abr.response('Ca', Ca, c)
         
     if 'Alpha' in paramdict.keys():
         alpha_contribution = np.ones(c[:,0].shape)
-
-        #Ca
-        interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,3])), kind = 'linear')
-        alpha_contribution *= interp(wl, alpha) / c[:,0] 
-
-        #C
-        Cextend = (c[:,7]-c[:,0])*(0.3/0.15) + c[:,0]
-        interp = spi.interp2d(wl, [0.0,0.15,0.3], np.stack((c[:,0],c[:,7],Cextend)), kind = 'linear')
-        alpha_contribution *= interp(wl, alpha) / c[:,0]
-
-        #Mg
-        interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,15])), kind = 'linear')
-        alpha_contribution *= interp(wl, alpha) / c[:,0]
-
-        #Si
-        interp = spi.interp2d(wl, [0.0,0.3], np.stack((c[:,0],c[:,17])), kind = 'linear')
-        alpha_contribution *= interp(wl, alpha) / c[:,0]
+        for element in abr.alpha_elements:
+            alpha_contribution *= abr.response(element, alpha, c)
 
         ab_contribution *= alpha_contribution
 
@@ -424,8 +529,118 @@ def model_spec(inputs, paramnames, paramdict, saurononly = False, vcjset = False
 
     return wl, newm, basemodel
 
+def line_included(line_name, paramnames, lineinclude):
+    '''Returns True if the band line_name is used in the chisq'''
+
+    if line_name not in lineinclude:
+        return False
+
+    #line_name = ['FeH','CaI','NaI','KI_a','KI_b', 'KI_1.25', 'AlI']
+    if lineexclude:
+        if 'Na' not in paramnames:
+            if line_name == 'NaI':
+                return False
+        if 'Ca' not in paramnames:
+            if line_name == 'CaI':
+                return False
+        if 'Fe' not in paramnames:
+            if line_name == 'FeH':
+                return False
+        if 'K' not in paramnames:
+            if line_name in ['KI_a','KI_b','KI_1.25']:
+                return False
+
+    return True
+
+def band_windows(linedefsfull, paramnames, lineinclude):
+    '''Returns the (low, high) wavelength ranges, blue passband to red passband,
+    of the bands used in the chisq. If lineinclude is False all bands are
+    used.'''
+
+    linedefs = linedefsfull[0]
+    line_names = linedefsfull[1]
+
+    windows = []
+    for i in range(len(linedefs[0,:])):
+        if (lineinclude is not False) and \
+                (not line_included(line_names[i], paramnames, lineinclude)):
+            continue
+        windows.append((linedefs[0,i], linedefs[5,i]))
+
+    return windows
+
+def evaluation_plan(wl, data, err, linedefsfull, paramnames, paramdict, lineinclude, \
+        veldisp, sauron, saurononly, pad = 10, kind = 'cubic'):
+    '''Works out once which model wavelengths the chisq needs: the windows of
+    the bands in use plus the broadening kernel at the largest allowed
+    veldisp and pad pixels for the resampling. Returns a dict with the
+    indices into the interpolator wavelengths (rows), the broadeners for
+    the WIFIS and SAURON bands, the bands used (bands) and the BandChisq
+    of each, which resamples the broadened models to the data pixels (kind
+    'cubic' or 'linear'), removes the pseudo-continuum and sums the chisq.'''
+
+    wlfull = vcj[0]["WL"]
+    if sauron and not saurononly:
+        rel = np.where((wlfull > 4000) & (wlfull < 14000))[0]
+    elif saurononly:
+        rel = np.where((wlfull > 4000) & (wlfull < 6000))[0]
+    else:
+        rel = np.where((wlfull > 8500) & (wlfull < 14000))[0]
+    wlsel = vcj[1].select(wlfull[rel])
+    wlm = vcj[1].wl[wlsel]
+
+    #Widest kernel the run can ask for. A free veldisp interpolates the
+    #kernels on a grid of mcsp.VDSTEP, one step past the prior.
+    vdstep = None
+    if 'VelDisp' in paramdict.keys():
+        if paramdict['VelDisp'] == None:
+            vdstep = mcsp.VDSTEP
+            vdmax = 390. + vdstep
+        else:
+            vdmax = paramdict['VelDisp']
+    else:
+        vdmax = veldisp
+
+    need = np.zeros(len(wlm), dtype=bool)
+    windows = []
+    windows_s = []
+    if not saurononly:
+        windows = band_windows(linedefsfull, paramnames, lineinclude)
+        sigma_conv, dw = mcsp.convolution_sigma(wlm, vdmax)
+        need |= mcsp.window_mask(wlm, windows, int(4.*sigma_conv/dw + 0.5) + pad + 1)
+    if sauron:
+        windows_s = band_windows(sauron[3], paramnames, False)
+        if not saurononly:
+            vdmax = sauron[4]
+        sigma_conv, dw = mcsp.convolution_sigma(wlm, vdmax, reglims=[4000,6000])
+        need |= mcsp.window_mask(wlm, windows_s, int(4.*sigma_conv/dw + 0.5) + pad + 1)
+    inputs = np.where(need)[0]
+
+    plan = {'rows': np.arange(wlsel.start, wlsel.stop)[inputs], 'broadener': None, \
+            'broadener_s': None, 'bands': [], 'chisq': None, 'chisq_s': None}
+    if not saurononly:
+        plan['broadener'] = mcsp.GaussianBroadener(wlm, windows = windows, \
+                pad = pad, vdstep = vdstep, inputs = inputs)
+        plan['bands'] = [i for i in range(len(linedefsfull[0][0,:])) if \
+                line_included(linedefsfull[1][i], paramnames, lineinclude)]
+        linedefs = linedefsfull[0]
+        plan['chisq'] = bchi.BandChisq(plan['broadener'].wl, wl, data, err, \
+                [linedefs[0,:], linedefs[1,:], linedefs[4,:], linedefs[5,:]], \
+                bands = plan['bands'], kind = kind)
+    if sauron:
+        plan['broadener_s'] = mcsp.GaussianBroadener(wlm, reglims = [4000,6000], \
+                windows = windows_s, pad = pad, vdstep = vdstep if saurononly else None, \
+                inputs = inputs)
+        linedefs_s = sauron[3][0]
+        plan['chisq_s'] = bchi.BandChisq(plan['broadener_s'].wl, sauron[0], sauron[1], \
+                sauron[2], [linedefs_s[0,:], linedefs_s[1,:], linedefs_s[4,:], \
+                linedefs_s[5,:]], kind = kind)
+    print("Evaluating %i of %i model wavelengths" % (len(inputs), len(wlm)))
+
+    return plan
+
 def calc_chisq(params, wl, data, err, veldisp, paramnames, paramdict, lineinclude, \
-        linedefsfull, sauron, saurononly, plot=False, timing = False):
+        linedefsfull, sauron, saurononly, plot=False, timing = False, plan = None):
     ''' Important function that produces the value that essentially
     represents the likelihood of the mcmc equation. Produces the model
     spectrum then returns a normal chisq value.'''
@@ -437,44 +652,51 @@ def calc_chisq(params, wl, data, err, veldisp, paramnames, paramdict, lineinclud
     if timing:
         t1 = time.time()
 
+    #Only the model around the fitted bands is broadened
+    if not plan:
+        windows = band_windows(linedefsfull, paramnames, lineinclude)
+        if sauron:
+            windows_s = band_windows(sauron[3], paramnames, False)
+
     #Creating model spectrum then interpolating it so that it can be easily matched with the data.
     if sauron:
         if saurononly:
             wlm, newm, base = model_spec(params, paramnames, paramdict, \
-                    saurononly = True, timing=timing)
+                    saurononly = True, timing=timing, plan = plan)
         else:
             wlm, newm, base = model_spec(params, paramnames, paramdict, \
-                    full = True, timing=timing)
+                    full = True, timing=timing, plan = plan)
     else:
-        wlm, newm, base = model_spec(params, paramnames, paramdict, timing=timing)
+        wlm, newm, base = model_spec(params, paramnames, paramdict, timing=timing, \
+                plan = plan)
 
     # Convolve model to velocity dispersion
+    if 'VelDisp' in paramdict.keys():
+        if 'VelDisp' in paramnames:
+            whsig = np.where(np.array(paramnames) == 'VelDisp')[0]
+            vd = params[whsig]
+        else:
+            vd = paramdict['VelDisp']
+    else:
+        vd = veldisp
+
     if not saurononly:
-        if 'VelDisp' in paramdict.keys():
-            if 'VelDisp' in paramnames:
-                whsig = np.where(np.array(paramnames) == 'VelDisp')[0]
-                wlc, mconv = mcsp.convolvemodels(wlm, newm, params[whsig])
-            else:
-                wlc, mconv = mcsp.convolvemodels(wlm, newm, paramdict['VelDisp'])
+        if plan:
+            wlc, mconv = plan['broadener'](newm, vd)
         else:
-            wlc, mconv = mcsp.convolvemodels(wlm, newm, veldisp)
+            wlc, mconv = mcsp.convolvemodels(wlm, newm, vd, windows = windows)
 
     if sauron:
-        if saurononly:
-            if 'VelDisp' in paramdict.keys():
-                if 'VelDisp' in paramnames:
-                    whsig = np.where(np.array(paramnames) == 'VelDisp')[0]
-                    wlc_s, mconv_s = mcsp.convolvemodels(wlm, base, params[whsig],\
-                            reglims=[4000,6000])
-                else:
-                    wlc_s, mconv_s = mcsp.convolvemodels(wlm, base, \
-                            paramdict['VelDisp'], reglims=[4000,6000])
-            else:
-                wlc_s, mconv_s = mcsp.convolvemodels(wlm, base, sauron[4], \
-                        reglims=[4000,6000])
+        if saurononly and ('VelDisp' in paramdict.keys()):
+            vd_s = vd
+        else:
+            vd_s = sauron[4]
+
+        if plan:
+            wlc_s, mconv_s = plan['broadener_s'](base, vd_s)
         else:
-            wlc_s, mconv_s = mcsp.convolvemodels(wlm, base, sauron[4],\
-                    reglims=[4000,6000])
+            wlc_s, mconv_s = mcsp.convolvemodels(wlm, base, vd_s, \
+                    reglims=[4000,6000], windows = windows_s)
 
     if 'f' in paramdict.keys():
         if 'f' in paramnames:
@@ -487,6 +709,26 @@ def calc_chisq(params, wl, data, err, veldisp, paramnames, paramdict, lineinclud
         t2 = time.time()
         print("CHISQ T1: ", t2 - t1)
 
+    #All bands at once with the packed data of the plan
+    if plan:
+        chisq = 0
+        if not saurononly:
+            chisq += plan['chisq'](mconv)
+        if sauron:
+            chisq += plan['chisq_s'](mconv_s, f if 'f' in paramdict.keys() else None)
+
+        if plot:
+            models = plan['chisq'].models(np.atleast_2d(mconv))[0]
+            for b, i in enumerate(plan['chisq'].bands):
+                mpl.plot(wl[i], models[b,:len(wl[i])], 'r')
+                mpl.plot(wl[i], data[i], 'b')
+            mpl.show()
+
+        if timing:
+            print("CHISQ T2: ", time.time() - t2)
+
+        return -0.5*chisq
+
     if not saurononly:
         mconvinterp = spi.interp1d(wlc, mconv, kind='cubic', bounds_error=False)
 
@@ -505,25 +747,9 @@ def calc_chisq(params, wl, data, err, veldisp, paramnames, paramdict, lineinclud
 
     if not saurononly:
         for i in range(len(linedefs[0,:])):
-            if line_names[i] not in lineinclude:
-                #print line_name[i]
+            if not line_included(line_names[i], paramnames, lineinclude):
                 continue
 
-            #line_name = ['FeH','CaI','NaI','KI_a','KI_b', 'KI_1.25', 'AlI']
-            if lineexclude:
-                if 'Na' not in paramnames:
-                    if line_names[i] == 'NaI':
-                        continue
-                if 'Ca' not in paramnames:
-                    if line_names[i] == 'CaI':
-                        continue
-                if 'Fe' not in paramnames:
-                    if line_names[i] == 'FeH':
-                        continue
-                if 'K' not in paramnames:
-                    if line_names[i] in ['KI_a','KI_b','KI_1.25']:
-                        continue
-
             #Getting a slice of the model
             wli = wl[i]
 
@@ -639,8 +865,37 @@ def lnprior(theta, paramnames):
     else:
         return -np.inf
 
+def prior_bounds(paramnames):
+    '''Returns the (low, high) limits of lnprior for each parameter, for the
+    bounded pre-fit'''
+
+    bounds = []
+    for param in paramnames:
+        if param == 'Age':
+            bounds.append((1.0, 13.5))
+        elif param == 'Z':
+            bounds.append((-0.25, 0.2))
+        elif param == 'Alpha':
+            bounds.append((0.0, 0.3))
+        elif param in ['x1', 'x2']:
+            bounds.append((0.5, 3.5))
+        elif param == 'Na':
+            bounds.append((-0.5, 0.9))
+        elif param in ['K','Ca','Fe','Mg']:
+            bounds.append((-0.5, 0.5))
+        elif param == 'VelDisp':
+            bounds.append((120., 390.))
+        elif param == 'Vel':
+            bounds.append((0.0001, 0.03))
+        elif param == 'f':
+            bounds.append((np.exp(-10.), np.exp(1.)))
+        else:
+            bounds.append((None, None))
+
+    return bounds
+
 def lnprob(theta, wl, data, err, paramnames, paramdict, lineinclude, linedefs, \
-        veldisp, sauron, saurononly):
+        veldisp, sauron, saurononly, plan = None):
     '''Primary function of the mcmc. Checks priors and returns the likelihood'''
 
     lp = lnprior(theta, paramnames)
@@ -649,31 +904,268 @@ def lnprob(theta, wl, data, err, paramnames, paramdict, lineinclude, linedefs, \
 
     chisqv = calc_chisq(theta, wl, data, err, veldisp, \
             paramnames, paramdict, lineinclude, linedefs, \
-            sauron, saurononly, timing=False)
+            sauron, saurononly, timing=False, plan = plan)
     return lp + chisqv
 
-def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramdict, lineinclude,\
-        threads = 6, restart=False, scale=False, fl=None, sauron=None, \
-        sauron_z=None, sauron_veldisp=None, saurononly=False,comments='No Comment'):
-    '''Main program. Runs the mcmc'''
+def lnprob_theta(theta):
+    '''lnprob using the arguments installed by set_lnprob_args, so the Pool
+    only needs to send theta'''
 
-    if fl == None:
-        print('Please input filename for WIFIS data')
-        return
+    return lnprob(theta, *lnprob_args)
 
-    if sauron.lower() == 'none':
-        sauron = None
+def batch_params(thetas, paramnames, paramdict):
+    '''Returns a dict of the parameter values (as arrays) for every row of
+    thetas, with the defaults and fixed paramdict values filled in the same
+    way as model_spec'''
+
+    n = thetas.shape[0]
+    params = {}
+    for j in range(len(paramnames)):
+        params[paramnames[j]] = thetas[:,j]
+
+    if 'x1' not in paramnames:
+        params['x1'] = np.full(n, 1.3)
+    if 'x2' not in paramnames:
+        params['x2'] = params['x1']
 
-    #Handle parameters and walker initialization
-    paramnames = []
     for key in paramdict.keys():
         if paramdict[key] == None:
-            paramnames.append(key)
+            continue
+        params[key] = np.full(n, paramdict[key])
+
+    return params
+
+def model_spec_batch(thetas, paramnames, paramdict, saurononly = False, \
+        full = False, MLR = False, plan = None):
+    '''Batch version of model_spec for an (nwalkers, ndim) array of
+    parameters. Returns the model wavelengths and (nwalkers, nwl) arrays of
+    the models and base models.'''
+
+    params = batch_params(thetas, paramnames, paramdict)
+    Z, Age = cache_point(params['Z'], params['Age'])
+
+    imfcols, imfw = imf_columns(params['x1'], params['x2'])
+
+    wlfull = vcj[0]["WL"]
+    if full:
+        rel = np.where((wlfull > 4000) & (wlfull < 14000))[0]
+    elif saurononly:
+        rel = np.where((wlfull > 4000) & (wlfull < 6000))[0]
+    elif MLR:
+        rel = np.where((wlfull > 20000) & (wlfull < 24000))[0]
+    else:
+        rel = np.where((wlfull > 8500) & (wlfull < 14000))[0]
+    wl = vcj[0]["WL"][rel]
+
+    weights = vcj[1].weights_batch(Z, Age)
+    if plan:
+        wlsel = plan['rows']
+        wl = vcj[1].wl[wlsel]
+    else:
+        wlsel = vcj[1].select(wl)
+    mimf = np.einsum('nk,nkl->nl', imfw, grid_columns_batch(vcj[1], Z, Age, \
+            imfcols, wlsel, weights = weights, select = True))
+    basemodel = grid_columns_batch(vcj[1], Z, Age, [imfsdict[(1.3,2.3)]], wlsel, \
+            weights = weights)[:,0]
+
     if saurononly:
-        for param in paramnames:
-            if param in ['Ca','Mg','Fe','x1','x2','K']:
-                print("Please remove elemental abundances")
-                return
+        elements = []
+    else:
+        elements = [el for el in ['Na','K','Fe','Ca'] if el in paramdict.keys()]
+    if 'Alpha' in paramdict.keys():
+        elements += abr.alpha_elements
+    cols = abr.columns(elements)
+    c = grid_columns_batch(vcj[2], Z, Age, cols, wlsel, weights = weights)
+
+    if saurononly:
+        if 'Alpha' in paramdict.keys():
+            alpha_contribution = 0.0
+            for element in abr.alpha_elements:
+                alpha_contribution += abr.response_batch(element, params['Alpha'], c, cols) - 1.
+
+            basemodel = basemodel*(1 + alpha_contribution)
+        return wl, mimf, basemodel
+
+    ab_contribution = np.ones(mimf.shape)
+    for element in elements:
+        if element in abr.alpha_elements:
+            ab_contribution *= abr.response_batch(element, params['Alpha'], c, cols)
+        else:
+            ab_contribution *= abr.response_batch(element, params[element], c, cols)
+
+    newm = mimf*ab_contribution
+
+    return wl, newm, basemodel
+
+def calc_chisq_batch(thetas, wl, data, err, veldisp, paramnames, paramdict, \
+        lineinclude, linedefsfull, sauron, saurononly, plan = None):
+    '''Batch version of calc_chisq for an (nwalkers, ndim) array of
+    parameters. Returns an array with -0.5*chisq for each walker.'''
+
+    linedefs = linedefsfull[0]
+    line_names = linedefsfull[1]
+
+    params = batch_params(thetas, paramnames, paramdict)
+
+    #Only the model around the fitted bands is broadened
+    if not plan:
+        windows = band_windows(linedefsfull, paramnames, lineinclude)
+        if sauron:
+            windows_s = band_windows(sauron[3], paramnames, False)
+
+    #Creating model spectra for all walkers at once
+    if sauron:
+        if saurononly:
+            wlm, newm, base = model_spec_batch(thetas, paramnames, paramdict, \
+                    saurononly = True, plan = plan)
+        else:
+            wlm, newm, base = model_spec_batch(thetas, paramnames, paramdict, \
+                    full = True, plan = plan)
+    else:
+        wlm, newm, base = model_spec_batch(thetas, paramnames, paramdict, plan = plan)
+
+    # Convolve models to velocity dispersion
+    if 'VelDisp' in paramdict.keys():
+        vd = params['VelDisp']
+    else:
+        vd = veldisp
+
+    if not saurononly:
+        if plan:
+            wlc, mconv = plan['broadener'](newm, vd)
+        else:
+            wlc, mconv = mcsp.convolvemodels_batch(wlm, newm, vd, windows = windows)
+
+    if sauron:
+        if saurononly and ('VelDisp' in paramdict.keys()):
+            vd_s = vd
+        else:
+            vd_s = sauron[4]
+
+        if plan:
+            wlc_s, mconv_s = plan['broadener_s'](base, vd_s)
+        else:
+            wlc_s, mconv_s = mcsp.convolvemodels_batch(wlm, base, vd_s, \
+                    reglims=[4000,6000], windows = windows_s)
+
+    chisq = np.zeros(thetas.shape[0])
+
+    #All bands and walkers at once with the packed data of the plan
+    if plan:
+        if not saurononly:
+            chisq += plan['chisq'](mconv)
+        if sauron:
+            chisq += plan['chisq_s'](mconv_s, params['f'] if 'f' in paramdict.keys() else None)
+
+        return -0.5*chisq
+
+    if not saurononly:
+        mconvinterp = spi.interp1d(wlc, mconv, kind='cubic', bounds_error=False, axis=1)
+        modelslices = dict([(i, mconvinterp(wl[i])) for i in range(len(wl))])
+
+        linedefs_c = [linedefs[0,:], linedefs[1,:], linedefs[4,:], linedefs[5,:]]
+        continua = contm.line_continua(wlc, linedefs_c, wl, range(len(wl)))
+
+        for i in range(len(linedefs[0,:])):
+            if not line_included(line_names[i], paramnames, lineinclude):
+                continue
+
+            #Normalizing the models by their pseudo-continuum
+            modelslice = modelslices[i] / continua[i](mconv)
+
+            chisq += np.nansum((data[i] - modelslice)**2.0 / err[i]**2.0, axis=1)
+
+    if sauron:
+        mconvinterp_s = spi.interp1d(wlc_s, mconv_s, kind='cubic', bounds_error=False, axis=1)
+        modelslices_s = [mconvinterp_s(wli) for wli in sauron[0]]
+
+        linedefs_s = [sauron[3][0][0,:], sauron[3][0][1,:], sauron[3][0][4,:], sauron[3][0][5,:]]
+        continua_s = contm.line_continua(wlc_s, linedefs_s, sauron[0], \
+                range(len(sauron[0])))
+
+        for i in range(len(sauron[0])):
+            modelslice = modelslices_s[i] / continua_s[i](mconv_s)
+
+            if 'f' in paramdict.keys():
+                errterm = (sauron[2][i] ** 2.0) + modelslice**2.0 * params['f'][:,None]**2.0
+                addterm = np.log(2.0 * np.pi * errterm)
+            else:
+                errterm = sauron[2][i] ** 2.0
+                addterm = 0.0
+
+            chisq += np.nansum(((sauron[1][i] - modelslice)**2.0 / errterm) + addterm, axis=1)
+
+    return -0.5*chisq
+
+def lnprior_batch(thetas, paramnames):
+    '''Batch version of lnprior. Returns 0.0 or -inf for every row of thetas.'''
+
+    good = np.ones(thetas.shape[0], dtype=bool)
+    for j in range(len(paramnames)):
+        theta = thetas[:,j]
+        if paramnames[j] == 'Age':
+            good &= (1.0 <= theta) & (theta <= 13.5)
+        elif paramnames[j] == 'Z':
+            good &= (-0.25 <= theta) & (theta <= 0.2)
+        elif paramnames[j] == 'Alpha':
+            good &= (0.0 <= theta) & (theta <= 0.3)
+        elif paramnames[j] in ['x1', 'x2']:
+            good &= (0.5 <= theta) & (theta <= 3.5)
+        elif paramnames[j] == 'Na':
+            good &= (-0.5 <= theta) & (theta <= 0.9)
+        elif paramnames[j] in ['K','Ca','Fe','Mg']:
+            good &= (-0.5 <= theta) & (theta <= 0.5)
+        elif paramnames[j] == 'VelDisp':
+            good &= (120 <= theta) & (theta <= 390)
+        elif paramnames[j] == 'Vel':
+            good &= (0.0001 <= theta) & (theta <= 0.03)
+        elif paramnames[j] == 'f':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                logf = np.log(theta)
+            good &= (-10. <= logf) & (logf <= 1.)
+
+    return np.where(good, 0.0, -np.inf)
+
+def lnprob_batch(thetas, wl, data, err, paramnames, paramdict, lineinclude, \
+        linedefs, veldisp, sauron, saurononly, plan = None):
+    '''Batch version of lnprob for an (nwalkers, ndim) array of parameters,
+    for use with emcee's vectorize=True'''
+
+    thetas = np.atleast_2d(thetas)
+    lp = lnprior_batch(thetas, paramnames)
+    good = np.isfinite(lp)
+
+    lnp = np.full(thetas.shape[0], -np.inf)
+    if np.any(good):
+        lnp[good] = lp[good] + calc_chisq_batch(thetas[good], wl, data, err, \
+                veldisp, paramnames, paramdict, lineinclude, linedefs, sauron, \
+                saurononly, plan = plan)
+
+    return lnp
+
+def lnprob_chunk(thetas):
+    '''Pool.map helper for chunked_lnprob, using the arguments installed by
+    set_lnprob_args'''
+
+    return lnprob_batch(thetas, *lnprob_args)
+
+def chunked_lnprob(thetas, pool = None, batchsize = 64):
+    '''Evaluates lnprob_batch for all walkers in chunks of batchsize, spread
+    over the pool if one is given'''
+
+    tasks = [thetas[k:k+batchsize] for k in range(0, len(thetas), batchsize)]
+    if pool is None:
+        results = list(map(lnprob_chunk, tasks))
+    else:
+        results = pool.map(lnprob_chunk, tasks)
+
+    return np.concatenate(results)
+
+def fit_data(fl, z, paramdict, scale = False, sauron = None, sauron_z = None):
+    '''Loads the WIFIS spectrum fl at redshift z and, if sauron is given, the
+    SAURON spectrum, split into the fitted bands. Returns wl, data, err, the
+    line definitions and (wl_s, data_s, err_s, sauronlines), or None without
+    SAURON.'''
 
     #Line definitions & other definitions
     #WIFIS Defs
@@ -735,8 +1227,102 @@ def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramdict, lineinclude,\
 
         wl_s, data_s, err_s = preps.splitspec(wl_s, spec_s, sauronlines, \
                 err = noise_s)
-    else:
-        print("No SAURON")
+
+        return wl, data, err, linedefs, (wl_s, data_s, err_s, sauronlines)
+
+    print("No SAURON")
+    return wl, data, err, linedefs, None
+
+def initial_positions(paramnames, nwalkers):
+    '''Returns nwalkers random starting positions spread over the priors'''
+
+    pos = []
+    for i in range(nwalkers):
+        newinit = []
+        for j in range(len(paramnames)):
+            if paramnames[j] == 'Age':
+                newinit.append(np.random.random()*12.5 + 1.0)
+            elif paramnames[j] == 'Z':
+                newinit.append(np.random.random()*0.45 - 0.25)
+                #newinit.append(np.random.random()*0.1 + 0.1)
+            elif paramnames[j] == 'Alpha':
+                newinit.append(np.random.random()*0.3)
+            elif paramnames[j] in ['x1', 'x2']:
+                newinit.append(np.random.choice(x1_m))
+            elif paramnames[j] == 'Na':
+                newinit.append(np.random.random()*1.3 - 0.3)
+            elif paramnames[j] in ['K','Ca','Fe','Mg']:
+                newinit.append(np.random.random()*0.6 - 0.3)
+            elif paramnames[j] == 'VelDisp':
+                newinit.append(np.random.random()*240 + 120)
+            elif paramnames[j] == 'Vel':
+                newinit.append(np.random.random()*0.015 + 0.002)
+            elif paramnames[j] == 'f':
+                #newinit.append(np.random.random()*11 - 10.)
+                newinit.append(np.random.random())
+        pos.append(np.array(newinit))
+
+    return pos
+
+def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramdict, lineinclude,\
+        threads = 6, restart=False, scale=False, fl=None, sauron=None, \
+        sauron_z=None, sauron_veldisp=None, saurononly=False,comments='No Comment',\
+        vectorize=False, batchsize=64, flushevery=100, chainformat='npy', \
+        resample='cubic', cachesize=0, cachetol=None, imf='interp', \
+        checkevery=100, ntau=50., tautol=0.01, autostop=False, prefit=0, \
+        prefitmethod='Nelder-Mead', prefititer=2000, ballsize=0.01, moves='stretch', \
+        ntemps=1, tmax=50., executor='process', chainname=None, resume=None):
+    '''Main program. Runs the mcmc. If vectorize, the walkers are evaluated
+    together by lnprob_batch in chunks of batchsize. The chain is written
+    every flushevery steps, as a binary chain (chainformat='npy') or a .dat
+    file (chainformat='dat'). The models are resampled to the data pixels
+    with 'cubic' or 'linear' interpolation (resample). cachesize (MB) and
+    cachetol turn on the base spectrum cache in each worker (see
+    set_model_cache); it stays off without a cachetol. imf is the imfmode: 'interp' for IMF models
+    interpolated in (x1, x2), 'snap' for the nearest IMF model. Every
+    checkevery steps the autocorrelation times are estimated and recorded
+    in the chain header; with autostop (off by default) the run ends once
+    the chain is longer than ntau times tau and tau changed by less than
+    tautol (see convergence.py). checkevery = 0 turns the monitor off. With prefit > 0,
+    lnprob is first maximized (prefitmethod, at most prefititer steps) from
+    prefit of the random walker positions over the pool, and the walkers
+    start in balls of ballsize times the prior spread around the best
+    solutions (see prefit.py). moves is the proposal mixture, e.g.
+    'de:0.8,desnooker:0.2' (see sampling.make_moves), and ntemps > 1 runs
+    parallel tempering with temperatures up to tmax, of which only the
+    cold chain is written. The likelihood is spread over threads workers
+    of the executor: 'process', 'thread', 'mpi' or 'local' (see
+    executors.py). chainname is the chain path without extension (default
+    a time-stamped name in mcmcresults). The sampler state is checkpointed with the
+    chain every 100 steps; resume is a chain to continue from its checkpoint
+    (see resume_mcmc).'''
+    global imfmode
+
+    runargs = dict(locals())
+    del runargs['resume']
+
+    if fl == None:
+        print('Please input filename for WIFIS data')
+        return
+
+    if sauron.lower() == 'none':
+        sauron = None
+
+    #Handle parameters and walker initialization
+    paramnames = []
+    for key in paramdict.keys():
+        if paramdict[key] == None:
+            paramnames.append(key)
+    if saurononly:
+        for param in paramnames:
+            if param in ['Ca','Mg','Fe','x1','x2','K']:
+                print("Please remove elemental abundances")
+                return
+
+    wl, data, err, linedefs, sauronspec = fit_data(fl, z, paramdict, scale = scale, \
+            sauron = sauron, sauron_z = sauron_z)
+    if sauron != None:
+        wl_s, data_s, err_s, sauronlines = sauronspec
 
     #    if 'Alpha' in paramdict.keys():
     #        paramnames = ['Age','Z','Alpha']
@@ -750,117 +1336,256 @@ def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramdict, lineinclude,\
     print(paramnames)
     print(lineinclude)
 
-    pos = []
-    if not restart:
-        for i in range(nwalkers):
-            newinit = []
-            for j in range(len(paramnames)):
-                if paramnames[j] == 'Age':
-                    newinit.append(np.random.random()*12.5 + 1.0)
-                elif paramnames[j] == 'Z':
-                    newinit.append(np.random.random()*0.45 - 0.25)
-                    #newinit.append(np.random.random()*0.1 + 0.1)
-                elif paramnames[j] == 'Alpha':
-                    newinit.append(np.random.random()*0.3)
-                elif paramnames[j] in ['x1', 'x2']:
-                    newinit.append(np.random.choice(x1_m))
-                elif paramnames[j] == 'Na':
-                    newinit.append(np.random.random()*1.3 - 0.3)
-                elif paramnames[j] in ['K','Ca','Fe','Mg']:
-                    newinit.append(np.random.random()*0.6 - 0.3)
-                elif paramnames[j] == 'VelDisp':
-                    newinit.append(np.random.random()*240 + 120)
-                elif paramnames[j] == 'Vel':
-                    newinit.append(np.random.random()*0.015 + 0.002)
-                elif paramnames[j] == 'f':
-                    #newinit.append(np.random.random()*11 - 10.)
-                    newinit.append(np.random.random())
-            pos.append(np.array(newinit))
+    if not restart and ntemps > 1:
+        # Each temperature gets its own draws, so swaps never duplicate walkers
+        pos = np.array([initial_positions(paramnames, nwalkers) for k in range(ntemps)])
+    elif not restart:
+        pos = initial_positions(paramnames, nwalkers)
     else:
        realdata, postprob, infol, lastdata = mcsp.load_mcmc_file(restart)
        pos = lastdata
 
-    savefl = base + "mcmcresults/"+time.strftime("%Y%m%dT%H%M%S")+\
-            "_%s_fullindex.dat" % (gal)
-    f = open(savefl, "w")
-    strparams = '\t'.join(paramnames)
-    strparamdict = '    '.join(['%s: %s' % (key, paramdict[key]) \
-            for key in paramdict.keys()])
     if sauron:
-        strlines = '\t'.join(lineinclude+list(sauronlines[1]))
+        linenames = lineinclude+list(sauronlines[1])
     else:
-        strlines = '\t'.join(lineinclude)
-    f.write("#NWalk\tNStep\tGal\tFit\n")
-    f.write("#%d\t%d\t%s\tFullIndex\n" % (nwalkers, n_iter,gal))
-    f.write("#%s\n" % (strparams))
-    f.write("#%s\n" % (strlines))
-    f.write("#%s\n" % (strparamdict))
-    f.write('#'+comments+'\n')
-    f.close()
-
-    pool = Pool(processes=16)
-
+        linenames = lineinclude
+    header = {'gal': gal, 'fit': 'FullIndex', 'paramnames': paramnames, \
+            'linenames': linenames, 'paramdict': paramdict, 'comments': comments}
     #sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = \
     #        (wl, data, err, gal, paramnames, lineinclude, linedefs), \
     #        threads=threads)
     if not sauron:
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = \
-                (wl, data, err, paramnames, paramdict, lineinclude, linedefs, \
-                veldisp, False, saurononly), pool=pool)
+        sauronargs = False
+    else:
+        sauronargs = [wl_s, data_s, err_s, sauronlines, sauron_veldisp]
+
+    # Only the model wavelengths the bands need are evaluated
+    plan = evaluation_plan(wl, data, err, linedefs, paramnames, paramdict, lineinclude, \
+            veldisp, sauronargs, saurononly, kind = resample)
+    args = (wl, data, err, paramnames, paramdict, lineinclude, linedefs, veldisp, \
+            sauronargs, saurononly, plan)
+
+    # The likelihood arguments are installed once per worker, so only the
+    # walker positions are sent with each task
+    set_lnprob_args(args)
+    load_fit_columns(paramnames, paramdict)
+    if cachesize and not cachetol:
+        print("The spectrum cache only hits with a cachetol, leaving it off")
+        cachesize = 0
+    cacheargs = {'maxbytes': int(cachesize*2**20), 'tol': cachetol}
+    imfmode = imf
+    pool = exe.make_pool(executor, processes = threads, initializer = init_worker, \
+            initargs = (dict(vcj_args), args, cacheargs, imf))
+
+    if vectorize:
+        # All walkers are evaluated together, split into chunks over the pool
+        lnprob_fn = partial(chunked_lnprob, pool = pool, batchsize = batchsize)
+        samplerargs = {'vectorize': True}
+    else:
+        lnprob_fn = lnprob_theta
+        samplerargs = {'pool': pool}
+    if ntemps > 1:
+        sampler = smp.TemperedSampler(nwalkers, ndim, lnprob_fn, \
+                smp.temperature_ladder(ntemps, tmax), moves = moves, **samplerargs)
+        movelist = sampler.moves[0]
+    else:
+        movelist = smp.make_moves(moves)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob_fn, moves = movelist, \
+                **samplerargs)
+    if checkevery:
+        monitor = conv.ConvergenceMonitor(paramnames, every = checkevery, \
+                ntau = ntau, tautol = tautol)
+    else:
+        monitor = None
+
+    # Start the walkers near the posterior mode instead of over the priors
+    if prefit and not restart and not resume:
+        draws = np.array(pos).reshape(-1, ndim)
+        solutions, lnps = pfit.optimize(lnprob_theta, draws[:prefit], \
+                bounds = prior_bounds(paramnames), pool = pool, \
+                method = prefitmethod, maxiter = prefititer)
+        balls = [pfit.walker_ball(solutions, lnps, nwalkers, np.ptp(draws, axis=0), \
+                partial(lnprior, paramnames = paramnames), ballsize = ballsize) \
+                for k in range(max(ntemps, 1))]
+        pos = np.array(balls) if ntemps > 1 else balls[0]
+        header['prefit'] = {'nstarts': len(solutions), 'method': prefitmethod, \
+                'lnprob': lnps.tolist(), \
+                'best': dict(zip(paramnames, solutions[0].tolist()))}
+
+    start = 0
+    if resume:
+        writer, pos, start = smp.resume_state(resume, sampler, monitor = monitor, \
+                flushevery = flushevery, moves = movelist)
     else:
-        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = \
-                (wl, data, err, paramnames, paramdict, lineinclude, linedefs, veldisp, \
-                [wl_s, data_s, err_s, sauronlines, sauron_veldisp], saurononly), pool=pool)
+        if chainname:
+            savefl = chainname
+        else:
+            savefl = base + "mcmcresults/"+time.strftime("%Y%m%dT%H%M%S")+\
+                    "_%s_fullindex" % (gal)
+        cold = pos[0] if np.ndim(pos) == 3 else pos
+        writer, savefl = mcio.open_chain(savefl, nwalkers, ndim, n_iter, header, \
+                chainformat = chainformat, initial = cold, flushevery = flushevery)
+        print("Writing chain to %s" % (savefl))
     print("Starting MCMC...")
 
-    t1 = time.time() 
-    for i, result in enumerate(sampler.sample(pos, iterations=n_iter)):
-        #position = result[0]
-        position = result.coords
-        f = open(savefl, "a")
-        for k in range(position.shape[0]):    
-            #f.write("%d\t%s\t%s\n" % (k, " ".join(map(str, position[k])), result[1][k]))
-            f.write("%d\t%s\t%s\n" % (k, " ".join(map(str, position[k])), result.log_prob[k]))
-        f.close()
-
-        if (i+1) % 100 == 0:
-            ct = time.time() - t1
-            pfinished = (i+1.)*100. / float(n_iter)
-            print(ct / 60., " Minutes")
-            print(pfinished, "% Finished")
-            print(((ct / (pfinished/100.)) - ct) / 60., "Minutes left")
-            print(((ct / (pfinished/100.)) - ct) / 3600., "Hours left")
-            print()
+    smp.run_chain(sampler, pos, writer, n_iter, start = start, monitor = monitor, \
+            autostop = autostop, runargs = runargs, moves = movelist)
+
+    if cachesize:
+        print(pooled_cache_stats(pool, exe.pool_size(pool)))
+    pool.close()
 
     return sampler
 
-if __name__ == '__main__':
-    #Preload the model files so the mcmc runs rapidly (<0.03s per iteration)
-    vcj = preload_vcj(sauron=True, saurononly=False) 
+def run_finished(state):
+    '''Returns True if the run of the checkpoint state ran all its steps or
+    stopped after converging'''
+
+    autocorr = state.get('autocorr') or {}
+    return state['iteration'] >= state['niter'] or bool(autocorr.get('stopped'))
+
+def resume_mcmc(fl, **kwargs):
+    '''Continues the run of the chain fl from its last checkpoint, appending
+    to the same chain. The run is restarted with the do_mcmc arguments saved
+    in the checkpoint, updated with kwargs, which cannot change the shape of
+    the chain (n_iter, nwalkers, ntemps, chainformat or paramdict).'''
+
+    state = mcio.read_state(fl)
+    if run_finished(state):
+        print("%s already finished" % (fl))
+        return None
+
+    runargs = smp.resume_args(state, kwargs, smp.RESUME_FIXED + ['paramdict'])
+
+    return do_mcmc(resume = fl, **runargs)
+
+def run_inputs(inputs, threads = 16, chainname = None, **kwargs):
+    '''Runs do_mcmc for one block of an inputs file (see
+    mcmc_support.load_mcmc_inputs), with the chain chainname. If that chain
+    has a checkpoint the run is continued from it instead. A block with
+    'autostop 1' ends once the chain has converged (see do_mcmc). Returns
+    the sampler, the chain name if its run had already finished, or None if
+    do_mcmc refused the inputs.'''
+
+    if 'autostop' in inputs:
+        kwargs['autostop'] = inputs['autostop'] == 1
+
+    if chainname:
+        for ext in ['.chain', '.dat']:
+            if os.path.exists(mcio.state_path(chainname + ext)):
+                if run_finished(mcio.read_state(chainname + ext)):
+                    print("%s already finished" % (chainname + ext))
+                    return chainname + ext
+                return resume_mcmc(chainname + ext, threads = threads, **kwargs)
+
+    return do_mcmc(inputs['target'], inputs['workers'], inputs['steps'], \
+            inputs['targetz'], inputs['targetsigma'], inputs['paramdict'], \
+            inputs['lineinclude'], threads = threads, fl = inputs['fl'], \
+            sauron = inputs['sfl'], sauron_z = inputs['sz'], \
+            sauron_veldisp = inputs['ssigma'], saurononly = inputs['saurononly'], \
+            comments = inputs['comments'], chainname = chainname, **kwargs)
+
+def validate_grid_dtype(inputs, dtype = 'float32', ndraws = 200, seed = 1, \
+        resample = 'cubic', imf = 'interp', tol = 0.1):
+    '''Compares lnprob on the dtype model grid with the float64 grid for one
+    block of an inputs file, at ndraws random positions drawn as the walkers
+    are. Prints and returns the largest relative and absolute differences of
+    lnprob; the check fails if the absolute difference is above tol or the
+    two grids disagree on which draws are finite.'''
+    global vcj, imfmode, model_cache
+
+    sauron = inputs['sfl']
+    if str(sauron).lower() == 'none':
+        sauron = None
+    paramdict = inputs['paramdict']
+    paramnames = [key for key in paramdict.keys() if paramdict[key] == None]
 
-    #Load the inputs for each MCMC run
+    wl, data, err, linedefs, sauronspec = fit_data(inputs['fl'], inputs['targetz'], \
+            paramdict, sauron = sauron, sauron_z = inputs['sz'])
+    if sauronspec is None:
+        sauronargs = False
+    else:
+        sauronargs = list(sauronspec) + [inputs['ssigma']]
+
+    np.random.seed(seed)
+    thetas = np.array(initial_positions(paramnames, ndraws))
+
+    # Each grid is evaluated without the spectrum cache
+    oldvcj, oldargs, oldcache, oldimf = vcj, dict(vcj_args), model_cache, imfmode
+    set_model_cache(0)
+    imfmode = imf
+    loadargs = dict(vcj_args)
+    lnps = {}
+    for dt in ['float64', dtype]:
+        loadargs['dtype'] = dt
+        vcj = preload_vcj(**loadargs)
+        load_fit_columns(paramnames, paramdict)
+        plan = evaluation_plan(wl, data, err, linedefs, paramnames, paramdict, \
+                inputs['lineinclude'], inputs['targetsigma'], sauronargs, \
+                inputs['saurononly'], kind = resample)
+        lnps[dt] = lnprob_batch(thetas, wl, data, err, paramnames, paramdict, \
+                inputs['lineinclude'], linedefs, inputs['targetsigma'], sauronargs, \
+                inputs['saurononly'], plan)
+
+    vcj, model_cache, imfmode = oldvcj, oldcache, oldimf
+    vcj_args.clear()
+    vcj_args.update(oldargs)
+
+    ref, new = lnps['float64'], lnps[dtype]
+    good = np.isfinite(ref) & np.isfinite(new)
+    nmismatch = np.sum(np.isfinite(ref) != np.isfinite(new))
+    diff = np.abs(new[good] - ref[good])
+    rel = diff / np.abs(ref[good])
+    maxrel = np.max(rel) if len(rel) else 0.
+    maxabs = np.max(diff) if len(diff) else 0.
+
+    ok = (nmismatch == 0) and (maxabs <= tol)
+    print("%s grid vs float64 on %i draws (%i finite): max relative lnprob error %.3g, " \
+            "max absolute %.3g, %i finite mismatches -- %s" % (np.dtype(dtype).name, \
+            ndraws, np.sum(good), maxrel, maxabs, nmismatch, 'OK' if ok else 'FAILED'))
+
+    return maxrel, maxabs, ok
+
+if __name__ == '__main__':
+    #Preload the model files so the mcmc runs rapidly (<0.03s per iteration).
+    #MCMC_GRID_DTYPE=float32 keeps the grid in single precision (half the
+    #memory); check it first with: python mcmc_fullindex.py validate inputsfile
+    griddtype = os.environ.get('MCMC_GRID_DTYPE', 'float64')
+    #Only the model columns each fit can reach are read into memory, unless
+    #MCMC_LAZY_GRID=0 (see preload_vcj)
+    lazygrid = os.environ.get('MCMC_LAZY_GRID', '1') != '0'
+    vcj = preload_vcj(sauron=True, saurononly=False, shared=True, dtype=griddtype, \
+            lazy=lazygrid)
+
+    #The pool is set by MCMC_EXECUTOR (process, thread, mpi or local). Under
+    #MPI (mpiexec -n N python mcmc_fullindex.py) rank 0 runs the fits and the
+    #other ranks evaluate the likelihood.
+    executor = os.environ.get('MCMC_EXECUTOR', 'process')
+    if not exe.is_master(executor):
+        exe.serve()
+        sys.exit()
+
+    #Compare lnprob on a float32 grid with float64 for each block of an inputs
+    #file: python mcmc_fullindex.py validate inputsfile [ndraws]
+    if len(sys.argv) > 2 and sys.argv[1] == 'validate':
+        ndraws = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+        checkdtype = griddtype if griddtype != 'float64' else 'float32'
+        results = [validate_grid_dtype(inputs, dtype = checkdtype, ndraws = ndraws) \
+                for inputs in mcsp.load_mcmc_inputs(sys.argv[2]) if inputs.get('skip', 0) != 1]
+        sys.exit(0 if all([res[2] for res in results]) else 1)
+
+    #Continue preempted runs: python mcmc_fullindex.py resume chain1 [chain2 ...]
+    if len(sys.argv) > 2 and sys.argv[1] == 'resume':
+        for chainfl in sys.argv[2:]:
+            resume_mcmc(chainfl, executor = executor)
+        sys.exit()
+
+    #Run the fits of the inputs file, as many at once as fit on the node
+    #(see scheduler.py). Fits already done are skipped when run again.
     #inputfl = 'inputs/20210326_PaperPaBTest.txt'
     #inputfl = 'inputs/20210324_Paper.txt'
     #inputfl = 'inputs/20210613_Paper.txt'
     inputfl = 'inputs/20210614_OtherIMFPaper.txt'
-    mcmcinputs = mcsp.load_mcmc_inputs(inputfl)
-
-    #Run the MCMC for each set of inputs
-    #mcmcinputs = mcmcinputs[:1]
-    for i in range(len(mcmcinputs)):
-        try:
-            #print(mcmcinputs[i]['skip'], type(mcmcinputs[i]['skip']))
-            if mcmcinputs[i]['skip'] == 1:
-                print("Skipping: ",i)
-                continue
-        except:
-            print("No skip parameter, not skipping")
-        print(mcmcinputs[i])
-        sampler = do_mcmc(mcmcinputs[i]['target'], mcmcinputs[i]['workers'],\
-            mcmcinputs[i]['steps'],mcmcinputs[i]['targetz'],\
-            mcmcinputs[i]['targetsigma'],mcmcinputs[i]['paramdict'],\
-            mcmcinputs[i]['lineinclude'],threads = 16, fl = mcmcinputs[i]['fl']\
-            ,sauron=mcmcinputs[i]['sfl'],sauron_z = mcmcinputs[i]['sz'],\
-            sauron_veldisp=mcmcinputs[i]['ssigma'],\
-            saurononly=mcmcinputs[i]['saurononly'],\
-            comments = mcmcinputs[i]['comments']) 
+    jobs = sched.Scheduler(inputfl, run_inputs, base + 'mcmcresults/', jobcores = 16, \
+            fork = (executor != 'mpi'), runargs = {'executor': executor})
+    jobs.run()
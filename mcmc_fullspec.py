@@ -9,7 +9,7 @@ from astropy.io import fits
 from sys import exit
 from glob import glob
 from random import uniform
-from multiprocessing import Pool
+from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -21,6 +21,14 @@ import scipy.interpolate as spi
 import warnings
 import sys, os
 import mcmc_support as mcsp
+import model_grid as mg
+import chain_io as mcio
+import convergence as conv
+import sampling as smp
+import executors as exe
+import prefit as pfit
+import abundance_response as abr
+import continuum as contm
 import plot_corner as plcr
 import prepare_spectra as preps
 
@@ -61,64 +69,38 @@ for i in range(16):
         imfsdict[(x1_m[i],x1_m[j])] = i*16 + j
 
 vcj = {}
+vcj_args = {}
+lnprob_args = ()
 
-def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=False):
+# 'interp' interpolates the IMF models bilinearly in (x1, x2), 'snap' uses
+# the nearest IMF model as the original code did
+imfmode = 'interp'
+
+def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=False, \
+        usecache = True, shared = False, dtype = None):
     '''Loads the SSP models into memory so the mcmc model creation takes a
-    shorter time. Returns a dict with the filenames as the keys'''
+    shorter time. Returns a dict with the filenames as the keys. The models are
+    read from the binary cache (see model_grid.py) when it is fresh.
+
+    If shared, the model grid is memory-mapped read-only from the cache so
+    every Pool worker uses the same copy of the grid. The interpolators are
+    built on views of the grid in either case. dtype = 'float32' halves the
+    memory of the grid (see mcmc_fullindex.validate_grid_dtype).'''
     #global vcjfull
     #global base
 
-    vcj = {}
+    grid = mg.load_grid(overwrite_base, usecache = usecache, mmap = shared, \
+            dtype = dtype)
+    vcj = mg.grid_to_vcj(grid)
 
-    if overwrite_base:
-        base = overwrite_base
-    else:
-        base = os.path.dirname(os.path.realpath(sys.argv[0])) + '/'
-
-    chem_names = ['WL', 'Solar', 'Na+', 'Na-', 'Ca+', 'Ca-', 'Fe+', 'Fe-', \
-            'C+', 'C-', 'a/Fe+', 'N+', 'N-', 'as/Fe+', 'Ti+', 'Ti-',\
-            'Mg+', 'Mg-', 'Si+', 'Si-', 'T+', 'T-', 'Cr+', 'Mn+', 'Ba+', \
-            'Ba-', 'Ni+', 'Co+', 'Eu+', 'Sr+', 'K+','V+', 'Cu+', 'Na+0.6', 'Na+0.9']
-
-    print("PRELOADING SSP MODELS INTO MEMORY")
-    fls = glob(base+'spec/vcj_ssp/*')    
-
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[3][1:])
-        Zsign = mnamespl[4][1]
-        Zval = float(mnamespl[4][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        x = pd.read_csv(fl, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)] = [x[:,1:]]
-
-    print("PRELOADING ABUNDANCE MODELS INTO MEMORY")
-    fls = glob(base+'spec/atlas/*')    
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[2][1:])
-        Zsign = mnamespl[3][1]
-        Zval = float(mnamespl[3][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        if age == 13.0:
-            age = 13.5
-
-        x = pd.read_csv(fl, skiprows=2, names = chem_names, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)].append(x[:,1:])
-
-    vcj["WL"] = x[:,0]
+    # Remembered so Pool workers can attach to the same grid (see init_worker)
+    vcj_args.clear()
+    vcj_args.update({'overwrite_base': overwrite_base, 'sauron': sauron, \
+            'saurononly': saurononly, 'MLR': MLR, 'usecache': usecache, \
+            'shared': shared, 'dtype': dtype})
     print("FINISHED LOADING MODELS")
 
-    print("Calculating IMF interpolators")
+    print("Calculating grid interpolators")
     wlfull = vcj["WL"]
     if sauron:
         rel = np.where((wlfull > 4000) & (wlfull < 14000))[0]
@@ -128,37 +110,38 @@ def preload_vcj(overwrite_base = False, sauron=False, saurononly=False, MLR=Fals
         rel = np.where((wlfull > 20000) & (wlfull < 24000))[0]
     else:
         rel = np.where((wlfull > 8500) & (wlfull < 14000))[0]
+    rel = slice(rel[0], rel[-1] + 1)
     wl = wlfull[rel]
 
-    fullage = np.array([1.0,3.0,5.0,7.0,9.0,11.0,13.5])
-    fullZ = np.array([-1.5, -1.0, -0.5, 0.0, 0.2])
+    fullage = grid['Age']
+    fullZ = grid['Z']
+
+    imf_interp = mg.GridInterpolator(fullZ, fullage, wl, grid['imf'][:,:,:,rel])
+    ele_interp = mg.GridInterpolator(fullZ, fullage, wl, grid['abund'][:,:,:,rel])
 
-    imf_interp = []
-    for k in range(vcj['3.0_0.0'][0].shape[1]):
-        out = np.meshgrid(fullage,fullZ,wl)
-        grid = (out[0],out[1],out[2])
-        newgrid = np.zeros(out[0].shape)
-        for i,age in enumerate(fullage):
-            for j,z in enumerate(fullZ):
-                #print(vcj["%.1f_%.1f" % (age, z)][0][rel,73].shape)
-                newgrid[j,i,:] = vcj["%.1f_%.1f" % (age, z)][0][rel,k]
-        fulli = spi.RegularGridInterpolator((fullZ,fullage,wl), newgrid)
-        imf_interp.append(fulli)
-    
-    print("Calculating elemental interpolators")
-    ele_interp = []
-    for k in range(vcj['3.0_0.0'][1].shape[1]):
-        out = np.meshgrid(fullage,fullZ,wl)
-        grid = (out[0],out[1],out[2])
-        newgrid = np.zeros(out[0].shape)
-        for i,age in enumerate(fullage):
-            for j,z in enumerate(fullZ):
-                newgrid[j,i,:] = vcj["%.1f_%.1f" % (age, z)][1][rel,k]
-        fulli = spi.RegularGridInterpolator((fullZ,fullage,wl), newgrid)
-        ele_interp.append(fulli)
-    
     return vcj, imf_interp, ele_interp
 
+def init_worker(args, likeargs = None, imf = None):
+    '''Pool initializer. Forked workers already share the parent's models,
+    spawned workers re-attach to the memory-mapped model cache using the
+    arguments preload_vcj was called with. likeargs are the static lnprob
+    arguments (see set_lnprob_args) and imf the imfmode.'''
+    global vcj, imfmode
+
+    if len(vcj) == 0 and args:
+        vcj = preload_vcj(**args)
+    if likeargs is not None:
+        set_lnprob_args(likeargs)
+    if imf is not None:
+        imfmode = imf
+
+def set_lnprob_args(args):
+    '''Installs the static lnprob arguments (spectra, band definitions, etc)
+    used by lnprob_theta'''
+    global lnprob_args
+
+    lnprob_args = tuple(args)
+
 def select_model_file(Z, Age):
     '''Selects the model file for a given Age and [Z/H]. If the requested values
     are between two models it returns two filenames for each model set.'''
@@ -284,13 +267,6 @@ def model_spec(inputs, paramnames, vcjset = False, timing = False, full = False)
     if 'x2' not in paramnames:
         x2 = 2.3
 
-    if x1 not in x1_m:
-        x1min = np.argmin(np.abs(x1_m - x1))
-        x1 = x1_m[x1min]
-    if x2 not in x2_m:
-        x2min = np.argmin(np.abs(x2_m - x2))
-        x2 = x2_m[x2min]
-
     #Finding the appropriate base model files.
     fl1, fl2, fl3, fl4, agem, agep, zm, zp, mixage, mixZ = select_model_file(Z, Age)
 
@@ -307,14 +283,15 @@ def model_spec(inputs, paramnames, vcjset = False, timing = False, full = False)
     wl = vcj[0]["WL"][rel]
 
     abundi = [0,1,2,-2,-1,29,16,15,6,5,4,3,8,7,18,17,14,13,21]
-    imfinterp = vcj[1][imfsdict[(x1,x2)]]
-    mimf = imfinterp((Z,Age,wl))
-    baseinterp = vcj[1][imfsdict[(1.3,2.3)]]
-    basemodel = baseinterp((Z,Age,wl))
+    # The (Z, Age) weights are shared by the IMF and abundance grids
+    weights = vcj[1].weights(Z, Age)
+    wlsel = vcj[1].select(wl)
+    imfcols, imfw = mg.imf_weights(x1_m, x2_m, [x1], [x2], snap = (imfmode == 'snap'))
+    mimf = imfw[0].dot(vcj[1](Z, Age, imfcols[0], weights = weights, wlsel = wlsel))
+    basemodel = vcj[1](Z, Age, [imfsdict[(1.3,2.3)]], weights = weights, wlsel = wlsel)[0]
 
     c = np.zeros((len(wl), vcj[0]['3.0_0.0'][1].shape[1]))
-    for k in abundi:
-        c[:,k] = vcj[2][k]((Z,Age,wl))
+    c[:,abundi] = vcj[2](Z, Age, abundi, weights = weights, wlsel = wlsel).T
         
     # If the Age of Z is inbetween models then this will average the respective models to produce 
     # one that is closer to what is expected.
@@ -346,104 +323,39 @@ def model_spec(inputs, paramnames, vcjset = False, timing = False, full = False)
     #ab_contribution = 0.0
     ab_contribution = np.ones(c[:,0].shape)
     if 'Na' in paramnames:
-        Naextend = (c[:,2]-c[:,0])*(-0.5/-0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.6,0.9], \
-                np.stack((Naextend,c[:,2],c[:,0],c[:,1],c[:,-2],c[:,-1])), kind = 'cubic')
-        #NaP = interp(wl,Na) / c[:,0] - 1.
-        #ab_contribution += NaP
-        NaP = interp(wl,Na) / c[:,0]
-        ab_contribution *= NaP
+        ab_contribution *= abr.response('Na', Na, c)
 
     #K adjustment (assume symmetrical K adjustment)
     if 'K' in paramnames:
-        Kminus = (2. - (c[:,29] / c[:,0]))*c[:,0]
-        Kmextend = (Kminus - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Kpextend = (c[:,29] - c[:,0]) * (0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Kmextend,Kminus,c[:,0],c[:,29],Kpextend)), kind = 'linear')
-        #KP = interp(wl,K) / c[:,0] - 1.
-        #ab_contribution += KP
-        KP = interp(wl,K) / c[:,0]
-        ab_contribution *= KP
+        ab_contribution *= abr.response('K', K, c)
 
     #Mg adjustment
     if 'Mg' in paramnames:
-        mextend = (c[:,16] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        pextend = (c[:,15] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((mextend,c[:,16], c[:,0],c[:,15],pextend)), kind = 'linear')
-        #MgP = interp(wl,Mg) / c[:,0] - 1.
-        #ab_contribution += MgP
-        MgP = interp(wl,Mg) / c[:,0]
-        ab_contribution *= MgP
+        ab_contribution *= abr.response('Mg', Mg, c)
 
     #Fe Adjustment
     if 'Fe' in paramnames:
-        Femextend = (c[:,6] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Fepextend = (c[:,5] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Femextend,c[:,6], c[:,0],c[:,5],Fepextend)), kind = 'linear')
-        #FeP = interp(wl,Fe) / c[:,0] - 1.
-        #ab_contribution += FeP
-        FeP = interp(wl,Fe) / c[:,0]
-        ab_contribution *= FeP
+        ab_contribution *= abr.response('Fe', Fe, c)
 
     #Ca Adjustment
     if 'Ca' in paramnames:
-        Cmextend = (c[:,4] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        Cpextend = (c[:,3] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((Cmextend,c[:,4], c[:,0],c[:,3],Cpextend)), kind = 'linear')
-        #CaP = interp(wl,Ca) / c[:,0] - 1.
-        #ab_contribution += CaP
-        CaP = interp(wl,Ca) / c[:,0] 
-        ab_contribution *= CaP
+        ab_contribution *= abr.response('Ca', Ca, c)
 
     #C Adjustment
     if 'C' in paramnames:
-        mextend = (c[:,8] - c[:,0])*(-0.3/-0.15) + c[:,0]
-        pextend = (c[:,7] - c[:,0])*(0.3/0.15) + c[:,0]
-        interp = spi.interp2d(wl, [-0.3,-0.15,0.0,0.15,0.3], \
-                np.stack((mextend,c[:,8], c[:,0],c[:,7],pextend)), kind = 'linear')
-        #Abval = interp(wl,Carbon) / c[:,0] - 1.
-        #ab_contribution += Abval
-        Abval = interp(wl,Carbon) / c[:,0] 
-        ab_contribution *= Abval
-#    abundi = [0,1,2,-2,-1,29,16,15,6,5,4,3,8,7]
+        ab_contribution *= abr.response('C', Carbon, c)
 
     #Si Adjustment
     if 'Si' in paramnames:
-        mextend = (c[:,18] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        pextend = (c[:,17] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((mextend,c[:,18], c[:,0],c[:,17],pextend)), kind = 'linear')
-        #Abval = interp(wl,Si) / c[:,0] - 1.
-        #ab_contribution += Abval
-        Abval = interp(wl,Si) / c[:,0]
-        ab_contribution *= Abval
+        ab_contribution *= abr.response('Si', Si, c)
 
     #Ti Adjustment
     if 'Ti' in paramnames:
-        mextend = (c[:,14] - c[:,0])*(-0.5/-0.3) + c[:,0]
-        pextend = (c[:,13] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((mextend,c[:,14], c[:,0],c[:,13],pextend)), kind = 'linear')
-        #Abval = interp(wl,Ti) / c[:,0] - 1.
-        #ab_contribution += Abval
-        Abval = interp(wl,Ti) / c[:,0]
-        ab_contribution *= Abval
+        ab_contribution *= abr.response('Ti', Ti, c)
 
     #Cr Adjustment
     if 'Cr' in paramnames:
-        Crminus = (2. - (c[:,21] / c[:,0]))*c[:,0]
-        mextend = (Crminus - c[:,0])*(-0.5/-0.3) + c[:,0]
-        pextend = (c[:,21] - c[:,0])*(0.5/0.3) + c[:,0]
-        interp = spi.interp2d(wl, [-0.5,-0.3,0.0,0.3,0.5], \
-                np.stack((mextend,Crminus, c[:,0],c[:,21],pextend)), kind = 'linear')
-        #Abval = interp(wl,Cr) / c[:,0] - 1.
-        #ab_contribution += Abval
-        Abval = interp(wl,Cr) / c[:,0]
-        ab_contribution += Abval
+        ab_contribution += abr.response('Cr', Cr, c)
 
     #model_ratio = mimf / basemodel
     model_ratio = basemodel / mimf
@@ -461,11 +373,58 @@ def model_spec(inputs, paramnames, vcjset = False, timing = False, full = False)
 
     return wl, newm
 
+def model_windows(linedefs):
+    '''Returns the (low, high) wavelength ranges of the model that are
+    broadened: the fitted regions and the index passbands'''
+
+    linelow, linehigh, bluelow, bluehigh, redlow, redhigh, \
+            mlow, mhigh, morder = linedefs[0]
+
+    return list(zip(mlow, mhigh)) + list(zip(bluelow, redhigh))
+
+def region_continua(wlc, wl, data, linedefs):
+    '''Returns the continuum for each fitted region: for morder == 1 the
+    LineContinuum of the model through the index passbands and the data
+    already divided by its own, otherwise the PolyContinuum of order morder
+    fitted to the model/data ratio. These only depend on the data, so do_mcmc
+    builds them once (see fit_regions) and passes them to lnprob.'''
+
+    linelow, linehigh, bluelow, bluehigh, redlow, redhigh, \
+            mlow, mhigh, morder = linedefs[0]
+    line_name = linedefs[1]
+    index_name = linedefs[2]
+
+    regions = []
+    for i in range(len(mlow)):
+        wli = wl[i]
+        if morder[i] == 1:
+            k = np.where(np.array(index_name) == line_name[i])[0][0]
+            cont = contm.LineContinuum(wlc, bluelow[k], bluehigh[k], \
+                    redlow[k], redhigh[k], wli)
+            datacont = contm.LineContinuum(wli, bluelow[k], bluehigh[k], \
+                    redlow[k], redhigh[k], wli)
+            regions.append((cont, data[i] / datacont(data[i])))
+        else:
+            regions.append((contm.PolyContinuum(wli, morder[i]), None))
+
+    return regions
+
+def fit_regions(wl, data, linedefs):
+    '''region_continua on the broadened model wavelengths used by
+    calc_chisq. Needs the models to be loaded.'''
+
+    wlfull = vcj[0]["WL"]
+    wlm = wlfull[np.where((wlfull > 8500) & (wlfull < 14000))[0]]
+    wlc = mcsp.get_broadener(wlm, False, model_windows(linedefs)).wl
+
+    return region_continua(wlc, wl, data, linedefs)
+
 def calc_chisq(params, wl, data, err, paramnames,\
-        linedefs, veldisp, plot=False, timing = False):
+        linedefs, veldisp, plot=False, timing = False, regions = None):
     ''' Important function that produces the value that essentially
     represents the likelihood of the mcmc equation. Produces the model
-    spectrum then returns a normal chisq value.'''
+    spectrum then returns a normal chisq value. regions are the continua
+    of fit_regions, built here if not given.'''
     #timing=True
 
     linelow, linehigh, bluelow, bluehigh, redlow, redhigh, \
@@ -479,12 +438,16 @@ def calc_chisq(params, wl, data, err, paramnames,\
     #Creating model spectrum then interpolating it so that it can be easily matched with the data.
     wlm, newm = model_spec(params, paramnames, timing=timing)
 
+    # Only the model around the fitted regions and index passbands is broadened
+    windows = model_windows(linedefs)
+
     # Convolve model to previously determined velocity dispersion (we don't fit dispersion in this code).
     if 'VelDisp' in paramnames:
         whsig = np.where(np.array(paramnames) == 'VelDisp')[0]
-        wlc, mconv = mcsp.convolvemodels(wlm, newm, params[whsig])
+        wlc, mconv = mcsp.convolvemodels(wlm, newm, params[whsig], windows = windows, \
+                vdstep = mcsp.VDSTEP)
     else:
-        wlc, mconv = mcsp.convolvemodels(wlm, newm, veldisp)
+        wlc, mconv = mcsp.convolvemodels(wlm, newm, veldisp, windows = windows)
 
     if 'f' in paramnames:
         whf = np.where(np.array(paramnames) == 'f')[0][0]
@@ -494,7 +457,10 @@ def calc_chisq(params, wl, data, err, paramnames,\
         t2 = time.time()
         print("CHISQ T1: ", t2 - t1)
 
-    mconvinterp = spi.interp1d(wlc, mconv, kind='cubic', bounds_error=False)
+    # Sparse resampling to the data pixels, set up on the first call
+    modelslices = mcsp.get_resampler(wlc, wl)(mconv)
+    if regions is None:
+        regions = region_continua(wlc, wl, data, linedefs)
 
     if timing:
         t3 = time.time()
@@ -508,34 +474,14 @@ def calc_chisq(params, wl, data, err, paramnames,\
         dataslice = data[i]
         errslice = err[i]
 
-        modelslice = mconvinterp(wli)
+        modelslice = modelslices[i]
 
+        cont, normdata = regions[i]
         if morder[i] == 1:
-            k = np.where(np.array(index_name) == line_name[i])[0][0]
-            linedefs = [bluelow,bluehigh,redlow,redhigh]
-            polyfit_model = mcsp.removeLineSlope(wlc, mconv, linedefs, k)
-            cont = polyfit_model(wli)
-
-            #bluepass = np.where((wlc >= bluelow[k]) & (wlc <= bluehigh[k]))[0]
-            #redpass = np.where((wlc >= redlow[k]) & (wlc <= redhigh[k]))[0]
-
-            #Cacluating center value of the blue and red bandpasses
-            #blueavg = np.mean([bluelow[k],bluehigh[k]])
-            #redavg = np.mean([redlow[k],redhigh[k]])
-
-            #blueval = np.mean(mconv[bluepass])
-            #redval = np.mean(mconv[redpass])
-
-            #pf = np.polyfit([blueavg, redavg], [blueval,redval], 1)
-            #polyfit = np.poly1d(pf)
-
-            polyfit_data = mcsp.removeLineSlope(wli,dataslice,linedefs,k)
-            dataslice = dataslice / polyfit_data(wli)
+            dataslice = normdata
+            cont = cont(mconv)
         else:
-            mdratio = modelslice / dataslice
-            pf = np.polyfit(wli, mdratio, morder[i])
-            polyfit = np.poly1d(pf)
-            cont = polyfit(wli)
+            cont = cont(modelslice / dataslice)
 
         modelslice = modelslice / cont
 
@@ -601,7 +547,34 @@ def lnprior(theta, paramnames):
     else:
         return -np.inf
 
-def lnprob(theta, wl, data, err, paramnames, linedefs, veldisp):
+def prior_bounds(paramnames):
+    '''Returns the (low, high) limits of lnprior for each parameter, for the
+    bounded pre-fit'''
+
+    bounds = []
+    for param in paramnames:
+        if param == 'Age':
+            bounds.append((1.0, 13.5))
+        elif param == 'Z':
+            bounds.append((-0.25, 0.2))
+        elif param in ['x1', 'x2']:
+            bounds.append((0.5, 3.5))
+        elif param == 'Na':
+            bounds.append((-0.5, 0.9))
+        elif param in ['K','Ca','Fe','Mg','Si','Ti','Cr']:
+            bounds.append((-0.5, 0.5))
+        elif param == 'C':
+            bounds.append((-0.3, 0.3))
+        elif param == 'VelDisp':
+            bounds.append((120., 390.))
+        elif param == 'f':
+            bounds.append((np.exp(-10.), np.exp(1.)))
+        else:
+            bounds.append((None, None))
+
+    return bounds
+
+def lnprob(theta, wl, data, err, paramnames, linedefs, veldisp, regions = None):
     '''Primary function of the mcmc. Checks priors and returns the likelihood'''
 
     lp = lnprior(theta, paramnames)
@@ -609,12 +582,61 @@ def lnprob(theta, wl, data, err, paramnames, linedefs, veldisp):
         return -np.inf
 
     chisqv = calc_chisq(theta, wl, data, err, \
-            paramnames, linedefs, veldisp, timing=False)
+            paramnames, linedefs, veldisp, timing=False, regions = regions)
     return lp + chisqv
 
+def lnprob_theta(theta):
+    '''lnprob using the arguments installed by set_lnprob_args, so the Pool
+    only needs to send theta'''
+
+    return lnprob(theta, *lnprob_args)
+
+def initial_positions(paramnames, nwalkers):
+    '''Returns nwalkers random starting positions spread over the priors'''
+
+    pos = []
+    for i in range(nwalkers):
+        newinit = []
+        for j in range(len(paramnames)):
+            if paramnames[j] == 'Age':
+                newinit.append(np.random.random()*12.5 + 1.0)
+            elif paramnames[j] == 'Z':
+                newinit.append(np.random.random()*0.45 - 0.25)
+            elif paramnames[j] in ['x1', 'x2']:
+                newinit.append(np.random.choice(x1_m))
+            elif paramnames[j] == 'Na':
+                #newinit.append(np.random.random()*1.3 - 0.3)
+                newinit.append(np.random.random()*0.9 - 0.3)
+            elif paramnames[j] == 'C':
+                newinit.append(np.random.random()*0.3 - 0.15)
+            elif paramnames[j] in ['K','Ca','Fe','Mg','Si','Ti','Cr']:
+                newinit.append(np.random.random()*0.6 - 0.3)
+            elif paramnames[j] == 'VelDisp':
+                vdisp = np.random.random()*240 + 130
+                newinit.append(vdisp)
+            elif paramnames[j] == 'f':
+                newinit.append(np.random.random())
+        pos.append(np.array(newinit))
+
+    return pos
+
 def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramnames, threads = 6, fl = None,\
-        restart=False, scale=False):
-    '''Main program. Runs the mcmc'''
+        restart=False, scale=False, flushevery=100, chainformat='npy', imf='interp', \
+        checkevery=100, ntau=50., tautol=0.01, autostop=False, prefit=0, \
+        prefitmethod='Nelder-Mead', prefititer=2000, ballsize=0.01, moves='stretch', \
+        ntemps=1, tmax=50., executor='process', resume=None):
+    '''Main program. Runs the mcmc. The chain is written every flushevery
+    steps, as a binary chain (chainformat='npy') or a .dat file
+    (chainformat='dat'). imf is the imfmode: 'interp' for IMF models
+    interpolated in (x1, x2), 'snap' for the nearest IMF model. The
+    convergence monitor (checkevery, ntau, tautol, autostop) works as in
+    mcmc_fullindex.do_mcmc, as do the pre-fit (prefit, prefitmethod,
+    prefititer, ballsize), the moves and parallel tempering (moves, ntemps,
+    tmax), the executor, checkpoints and resume (see resume_mcmc).'''
+    global imfmode
+
+    runargs = dict(locals())
+    del runargs['resume']
 
     #Line definitions & other definitions
     #mlow = [9700,10550,11340,11550,12350,12665]
@@ -662,74 +684,94 @@ def do_mcmc(gal, nwalkers, n_iter, z, veldisp, paramnames, threads = 6, fl = Non
     ndim = len(paramnames)
     print("Input fit parameters: ", paramnames)
 
-    pos = []
-    if not restart:
-        for i in range(nwalkers):
-            newinit = []
-            for j in range(len(paramnames)):
-                if paramnames[j] == 'Age':
-                    newinit.append(np.random.random()*12.5 + 1.0)
-                elif paramnames[j] == 'Z':
-                    newinit.append(np.random.random()*0.45 - 0.25)
-                elif paramnames[j] in ['x1', 'x2']:
-                    newinit.append(np.random.choice(x1_m))
-                elif paramnames[j] == 'Na':
-                    #newinit.append(np.random.random()*1.3 - 0.3)
-                    newinit.append(np.random.random()*0.9 - 0.3)
-                elif paramnames[j] == 'C':
-                    newinit.append(np.random.random()*0.3 - 0.15)
-                elif paramnames[j] in ['K','Ca','Fe','Mg','Si','Ti','Cr']:
-                    newinit.append(np.random.random()*0.6 - 0.3)
-                elif paramnames[j] == 'VelDisp':
-                    vdisp = np.random.random()*240 + 130
-                    newinit.append(vdisp)
-                elif paramnames[j] == 'f':
-                    newinit.append(np.random.random())
-            pos.append(np.array(newinit))
+    if not restart and ntemps > 1:
+        # Each temperature gets its own draws, so swaps never duplicate walkers
+        pos = np.array([initial_positions(paramnames, nwalkers) for k in range(ntemps)])
+    elif not restart:
+        pos = initial_positions(paramnames, nwalkers)
     else:
        realdata, postprob, infol, lastdata = mcsp.load_mcmc_file(restart)
        pos = lastdata
 
-    savefl = base + "mcmcresults/"+time.strftime("%Y%m%dT%H%M%S")+"_%s_fullfit.dat" % (gal)
-    f = open(savefl, "w")
-    strparams = '\t'.join(paramnames)
-    #strlines = '\t'.join(lineinclude)
-    f.write("#NWalk\tNStep\tGal\tFit\n")
-    f.write("#%d\t%d\t%s\tFullSpec\n" % (nwalkers, n_iter,gal))
-    f.write("#%s\n" % (strparams))
-    #f.write("#%s\n" % (strlines))
-    f.close()
-
+    header = {'gal': gal, 'fit': 'FullSpec', 'paramnames': paramnames}
+    savefl = base + "mcmcresults/"+time.strftime("%Y%m%dT%H%M%S")+"_%s_fullfit" % (gal)
+    # The likelihood arguments are installed once per worker, so only the
+    # walker positions are sent with each task
+    args = (wl, data, err, paramnames, linedefs, veldisp, \
+            fit_regions(wl, data, linedefs))
+    set_lnprob_args(args)
+    imfmode = imf
+    pool = exe.make_pool(executor, processes = threads, initializer = init_worker, \
+            initargs = (dict(vcj_args), args, imf))
+    if ntemps > 1:
+        sampler = smp.TemperedSampler(nwalkers, ndim, lnprob_theta, \
+                smp.temperature_ladder(ntemps, tmax), moves = moves, pool = pool)
+        movelist = sampler.moves[0]
+    else:
+        movelist = smp.make_moves(moves)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob_theta, moves = movelist, \
+                pool = pool)
+    if checkevery:
+        monitor = conv.ConvergenceMonitor(paramnames, every = checkevery, \
+                ntau = ntau, tautol = tautol)
+    else:
+        monitor = None
+
+    # Start the walkers near the posterior mode instead of over the priors
+    if prefit and not restart and not resume:
+        draws = np.array(pos).reshape(-1, ndim)
+        solutions, lnps = pfit.optimize(lnprob_theta, draws[:prefit], \
+                bounds = prior_bounds(paramnames), pool = pool, \
+                method = prefitmethod, maxiter = prefititer)
+        balls = [pfit.walker_ball(solutions, lnps, nwalkers, np.ptp(draws, axis=0), \
+                partial(lnprior, paramnames = paramnames), ballsize = ballsize) \
+                for k in range(max(ntemps, 1))]
+        pos = np.array(balls) if ntemps > 1 else balls[0]
+        header['prefit'] = {'nstarts': len(solutions), 'method': prefitmethod, \
+                'lnprob': lnps.tolist(), \
+                'best': dict(zip(paramnames, solutions[0].tolist()))}
+
+    start = 0
+    if resume:
+        writer, pos, start = smp.resume_state(resume, sampler, monitor = monitor, \
+                flushevery = flushevery, moves = movelist)
+    else:
+        cold = pos[0] if np.ndim(pos) == 3 else pos
+        writer, savefl = mcio.open_chain(savefl, nwalkers, ndim, n_iter, header, \
+                chainformat = chainformat, initial = cold, flushevery = flushevery)
+        print("Writing chain to %s" % (savefl))
     print("Starting MCMC...")
-    pool = Pool(processes=threads)
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = \
-            (wl, data, err, paramnames, linedefs, veldisp), pool=pool)
-
-    t1 = time.time() 
-    for i, result in enumerate(sampler.sample(pos, iterations=n_iter)):
-        #position = result[0]
-        position = result.coords
-        f = open(savefl, "a")
-        for k in range(position.shape[0]):    
-            #f.write("%d\t%s\t%s\n" % (k, " ".join(map(str, position[k])), result[1][k]))
-            f.write("%d\t%s\t%s\n" % (k, " ".join(map(str, position[k])), result.log_prob[k]))
-        f.close()
-
-        if (i+1) % 100 == 0:
-            ct = time.time() - t1
-            pfinished = (i+1.)*100. / float(n_iter)
-            print(ct / 60., " Minutes")
-            print(pfinished, "% Finished")
-            print(((ct / (pfinished/100.)) - ct) / 60., "Minutes left")
-            print(((ct / (pfinished/100.)) - ct) / 3600., "Hours left")
-            print()
+
+    smp.run_chain(sampler, pos, writer, n_iter, start = start, monitor = monitor, \
+            autostop = autostop, runargs = runargs, moves = movelist)
+    pool.close()
 
     return sampler
 
+def resume_mcmc(fl, **kwargs):
+    '''Continues the run of the chain fl from its last checkpoint, appending
+    to the same chain. The run is restarted with the do_mcmc arguments saved
+    in the checkpoint, updated with kwargs, which cannot change the shape of
+    the chain (n_iter, nwalkers, ntemps, chainformat or paramnames).'''
+
+    runargs = smp.resume_args(mcio.read_state(fl), kwargs, \
+            smp.RESUME_FIXED + ['paramnames'])
+
+    return do_mcmc(resume = fl, **runargs)
+
 if __name__ == '__main__':
-    vcj = preload_vcj() #Preload the model files so the mcmc runs rapidly (<0.03s per iteration)
+    #Preload the model files so the mcmc runs rapidly (<0.03s per iteration).
+    #MCMC_GRID_DTYPE=float32 keeps the grid in single precision.
+    vcj = preload_vcj(shared=True, dtype=os.environ.get('MCMC_GRID_DTYPE', 'float64'))
+
+    #The pool is set by MCMC_EXECUTOR, as in mcmc_fullindex.py
+    executor = os.environ.get('MCMC_EXECUTOR', 'process')
+    if not exe.is_master(executor):
+        exe.serve()
+        sys.exit()
     
     #params = ['Age','Z','x1','x2','Ca','Na','Fe','K','Mg','C','Ti','Cr','Si']
     params = ['Age','Z','x1','x2','Ca','Na','Fe','K','Mg','C','Ti','Si']
     fl_R1 = '/data2/wifis_reduction/elliot/M85/20171229/science/processed/M85_combined_cube_1_telluricreduced_20200528_R1.fits'
-    sampler = do_mcmc('M85', 512, 10000, 0.00230, 157, params, threads = 16, fl = fl_R1)
+    sampler = do_mcmc('M85', 512, 10000, 0.00230, 157, params, threads = 16, fl = fl_R1, \
+            executor = executor)
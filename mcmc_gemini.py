@@ -6,6 +6,7 @@ import pandas as pd
 import emcee
 import time
 import matplotlib.pyplot as mpl
+import chain_io as mcio
 
 # MCMC Parameters
 # Metallicity: -1.5 < [Z/H] < 0.2 steps of 0.1?
@@ -380,21 +381,18 @@ def do_mcmc(gal, nwalkers, n_iter, smallfit = False, threads = 6):
     print "Starting MCMC..."
 
     t1 = time.time() 
-    for i, result in enumerate(sampler.sample(pos, iterations=n_iter)):
-        position = result[0]
-        f = open(savefl, "a")
-        for k in range(position.shape[0]):    
-            f.write("%d\t%s\t%s\n" % (k, " ".join(map(str, position[k])), result[1][k]))
-        f.close()
-
-        if (i+1) % 10 == 0:
-            ct = time.time() - t1
-            pfinished = (i+1.)*100. / float(n_iter)
-            print ct / 60., " Minutes"
-            print pfinished, "% Finished"
-            print ((ct / (pfinished/100.)) - ct) / 60., "Minutes left"
-            print ((ct / (pfinished/100.)) - ct) / 3600., "Hours left"
-            print 
+    with mcio.ChainWriter(savefl, nwalkers, ndim) as writer:
+        for i, result in enumerate(sampler.sample(pos, iterations=n_iter)):
+            writer.write(result[0], result[1])
+
+            if (i+1) % 10 == 0:
+                ct = time.time() - t1
+                pfinished = (i+1.)*100. / float(n_iter)
+                print ct / 60., " Minutes"
+                print pfinished, "% Finished"
+                print ((ct / (pfinished/100.)) - ct) / 60., "Minutes left"
+                print ((ct / (pfinished/100.)) - ct) / 3600., "Hours left"
+                print 
     
     #sampler.run_mcmc(pos, 5000)
 
@@ -11,6 +11,10 @@ import pandas as pd
 import plot_corner as pc
 import imf_mass as imf
 import scipy.ndimage
+import scipy.sparse as sps
+from collections import OrderedDict
+import chain_io as mcio
+import model_grid as mg
 
 from matplotlib import rc
 rc('font',**{'family':'sans-serif','sans-serif':['Helvetica']})
@@ -50,7 +54,11 @@ def load_mcmc_file(fl, linesoverride=False):
     and the run info.
     
     Inputs:
-        fl -- The mcmc chain data file.'''
+        fl -- The mcmc chain data file, either a .dat file or a binary
+              chain directory (see chain_io.py).'''
+
+    if mcio.is_binary_chain(fl):
+        return load_mcmc_chain(fl, linesoverride = linesoverride)
 
     fittype = fl.split('_')[-1][:-4]
 
@@ -109,7 +117,8 @@ def load_mcmc_file(fl, linesoverride=False):
     #Get line count to diagnose
     lc = extralines
     for line in f:
-        lc += 1
+        if line[0] != '#':
+            lc += 1
     f.close()
 
     #Get MCMC run info
@@ -119,7 +128,46 @@ def load_mcmc_file(fl, linesoverride=False):
     niter = int(values[1])
     gal = values[2]
 
-    #Parse paramnames and assign ploting text and limits
+    names = ["Worker"] + list(paramnames) + ["ChiSq"]
+
+    #N lines should be nworkers*niter
+    n_lines = nworkers*niter
+    if lc < nworkers:
+        print("FILE DOES NOT HAVE ONE STEP...RETURNING")
+        return
+    elif lc % nworkers != 0:
+        print("FILE HAS INCOMPLETE STEP...REMOVING")
+        n_steps = int(lc / nworkers)
+        initdata = pd.read_csv(fl, comment='#', header = None, \
+                names=names, sep=r'\s+')
+        #initdata = np.loadtxt(fl)
+        data = np.array(initdata)
+        data = data[:n_steps*nworkers,:]
+    elif lc != n_lines:
+        print("FILE NOT COMPLETE")
+        initdata = pd.read_csv(fl, comment='#', header = None, \
+                names=names, sep=r'\s+')
+        data = np.array(initdata)
+        #data = np.loadtxt(fl)
+        n_steps = int(data.shape[0]/nworkers)
+    else:
+        initdata = pd.read_csv(fl, comment='#', header = None, \
+                names=names, sep=r'\s+')
+        data = np.array(initdata)
+        #data = np.loadtxt(fl)
+        n_steps = niter
+
+    folddata = data.reshape((n_steps, nworkers,len(names)))
+    postprob = folddata[:,:,-1]
+    realdata = folddata[:,:,1:-1]
+
+    return arrange_chain(realdata, postprob, nworkers, niter, gal, paramnames, \
+            linenames, lines, paramdict)
+
+def param_labels(paramnames):
+    '''Returns the plotting names and the high and low limits for each
+    parameter in paramnames'''
+
     names = []
     high = []
     low = []
@@ -169,39 +217,20 @@ def load_mcmc_file(fl, linesoverride=False):
             high.append(0.3)
             low.append(0.0)
 
-    names.insert(0,"Worker")
-    names.insert(len(names), "ChiSq")
+    return names, high, low
+
+def arrange_chain(realdata, postprob, nworkers, niter, gal, paramnames, \
+        linenames, lines, paramdict):
+    '''Puts the (nsteps, nworkers, nparams) walker positions into the
+    standard parameter order and assembles the run info for load_mcmc_file.
+    Returns [realdata, postprob, infol, lastdata].'''
+
+    #Parse paramnames and assign ploting text and limits
+    names, high, low = param_labels(paramnames)
     print("Params: ", paramnames)
     if lines:
         print("Lines: ", linenames)
 
-    #N lines should be nworkers*niter
-    n_lines = nworkers*niter
-    if lc < nworkers:
-        print("FILE DOES NOT HAVE ONE STEP...RETURNING")
-        return
-    elif lc % nworkers != 0:
-        print("FILE HAS INCOMPLETE STEP...REMOVING")
-        n_steps = int(lc / nworkers)
-        initdata = pd.read_csv(fl, comment='#', header = None, \
-                names=names, delim_whitespace=True)
-        #initdata = np.loadtxt(fl)
-        data = np.array(initdata)
-        data = data[:n_steps*nworkers,:]
-    elif lc != n_lines:
-        print("FILE NOT COMPLETE")
-        initdata = pd.read_csv(fl, comment='#', header = None, \
-                names=names, delim_whitespace=True)
-        data = np.array(initdata)
-        #data = np.loadtxt(fl)
-        n_steps = int(data.shape[0]/nworkers)
-    else:
-        initdata = pd.read_csv(fl, comment='#', header = None, \
-                names=names, delim_whitespace=True)
-        data = np.array(initdata)
-        #data = np.loadtxt(fl)
-        n_steps = niter
-
     paramorder = np.array(['Age','Z','Alpha','x1','x2','Na','K','Ca',\
             'Fe','Mg','Si','C','Ti','Cr','Vel','VelDisp','f'])
     rearrange = []
@@ -218,7 +247,6 @@ def load_mcmc_file(fl, linesoverride=False):
     high = np.array(high)[rearrange]
     low = np.array(low)[rearrange]
 
-    names = names[1:-1]
     for k,name in enumerate(names):
         if name == 'x1':
             names[k] = r'\textbf{$x_{1}$}'
@@ -229,16 +257,60 @@ def load_mcmc_file(fl, linesoverride=False):
 
     infol = [nworkers, niter, gal, names, high, low, paramnames, linenames, lines, paramdict]
 
-    folddata = data.reshape((n_steps, nworkers,len(names)+2))
-    postprob = folddata[:,:,-1]
-    realdata = folddata[:,:,1:-1]
-    realdata = realdata[:,:,rearrange]
+    if (len(rearrange) != realdata.shape[2]) or \
+            np.any(rearrange != np.arange(len(rearrange))):
+        realdata = realdata[:,:,rearrange]
     lastdata = realdata[-1,:,:]
     print("DATASHAPE: ", realdata.shape)
 
     return [realdata, postprob, infol, lastdata]
 
-def convolvemodels(wlfull, datafull, veldisp, reglims = False):
+def load_mcmc_chain(fl, linesoverride = False):
+    '''Loads a binary chain (see chain_io.py) in the same form as
+    load_mcmc_file. The positions and probabilities are memory-mapped.'''
+
+    header, chain, accepted = mcio.load_chain(fl)
+
+    nworkers = header['nwalkers']
+    if header['nsteps'] < 1:
+        print("FILE DOES NOT HAVE ONE STEP...RETURNING")
+        return
+    elif header.get('autocorr', {}).get('stopped'):
+        print("Stopped after convergence at step %i" % (header['nsteps']))
+    elif header['nsteps'] != header['niter']:
+        print("FILE NOT COMPLETE")
+
+    lines = (header['fit'] == 'FullIndex') or linesoverride
+    print(header['paramdict'])
+
+    return arrange_chain(chain[:,:,:-1], chain[:,:,-1], nworkers, header['niter'], \
+            header['gal'], header['paramnames'], header['linenames'], lines, \
+            header['paramdict'])
+
+def convolvemodels(wlfull, datafull, veldisp, reglims = False, windows = None, \
+        vdstep = None):
+    '''Broadens the model datafull to veldisp. If windows, a list of (low, high)
+    wavelength ranges, is given only the model around those ranges is
+    returned, using a cached GaussianBroadener (see get_broadener) with
+    kernels on a vdstep grid if given.'''
+
+    if windows is not None:
+        return get_broadener(wlfull, reglims, windows, vdstep)(datafull, veldisp)
+
+    sigma_conv, dw = convolution_sigma(wlfull, veldisp, reglims)
+
+    #convolvex = np.arange(-5*sigma_conv,5*sigma_conv, 2.0)
+    #gaussplot = gauss_nat(convolvex, [sigma_conv,0.])
+
+    #out = np.convolve(datafull, gaussplot, mode='same')
+    out = scipy.ndimage.gaussian_filter(datafull, sigma_conv / dw)
+
+    return wlfull, out
+
+def convolution_sigma(wlfull, veldisp, reglims = False):
+    '''Returns the width (in Angstrom) of the gaussian that broadens the models
+    to veldisp and the model wavelength step in the region used by
+    convolvemodels. veldisp may be an array.'''
 
     if reglims:
         reg = (wlfull >= reglims[0]) & (wlfull <= reglims[1])
@@ -251,7 +323,6 @@ def convolvemodels(wlfull, datafull, veldisp, reglims = False):
     
     wl = wlfull[reg]
     dw = wl[1]-wl[0]
-    data = datafull[reg]
 
     c = 299792.458
 
@@ -263,14 +334,306 @@ def convolvemodels(wlfull, datafull, veldisp, reglims = False):
     sigma_gal = np.abs((m_center / (veldisp/c + 1.)) - m_center)
     sigma_conv = np.sqrt(sigma_gal**2. - m_sigma**2.)
 
-    #convolvex = np.arange(-5*sigma_conv,5*sigma_conv, 2.0)
-    #gaussplot = gauss_nat(convolvex, [sigma_conv,0.])
+    return sigma_conv, dw
 
-    #out = np.convolve(datafull, gaussplot, mode='same')
-    out = scipy.ndimage.gaussian_filter(datafull, sigma_conv / dw)
+def convolvemodels_batch(wlfull, models, veldisp, reglims = False, windows = None, \
+        vdstep = None):
+    '''Batch version of convolvemodels for an (n, nwl) array of models.
+    veldisp is either one dispersion for all models or one per model.'''
+
+    if windows is not None:
+        return get_broadener(wlfull, reglims, windows, vdstep)(models, veldisp)
+
+    sigma_conv, dw = convolution_sigma(wlfull, np.asarray(veldisp, dtype=float), reglims)
+    sigma_pix = np.ravel(sigma_conv / dw)
+
+    if len(sigma_pix) == 1 or np.all(sigma_pix == sigma_pix[0]):
+        out = scipy.ndimage.gaussian_filter1d(models, sigma_pix[0], axis=1)
+    else:
+        out = np.empty(models.shape)
+        for k in range(models.shape[0]):
+            out[k] = scipy.ndimage.gaussian_filter1d(models[k], sigma_pix[k])
 
     return wlfull, out
 
+def gaussian_weights(sigma, truncate = 4.0):
+    '''Returns the pixel offsets and normalized weights of the kernel used by
+    scipy.ndimage.gaussian_filter1d for each sigma (in pixels). For an array
+    of sigmas the weights are an (n, noffsets) array, zero beyond each
+    kernel's own radius.'''
+
+    sigma = np.atleast_1d(np.asarray(sigma, dtype=float))
+    radius = (truncate * sigma + 0.5).astype(int)
+    x = np.arange(-radius.max(), radius.max()+1)
+
+    weights = np.exp(-0.5 / sigma[:,None]**2. * x[None,:]**2.)
+    weights[np.abs(x)[None,:] > radius[:,None]] = 0.
+    weights = weights / weights.sum(axis=1)[:,None]
+
+    return x, weights
+
+def reflect_index(cols, n):
+    '''Maps pixel indices beyond the edges of a length n array back into it
+    the way ndimage's 'reflect' mode does (d c b a | a b c d | d c b a)'''
+
+    cols = np.where(cols < 0, -cols - 1, cols)
+    cols = np.where(cols >= n, 2*n - cols - 1, cols)
+
+    return cols
+
+def gaussian_matrix(n, rows, sigma, truncate = 4.0):
+    '''Returns the sparse (len(rows), n) matrix that applies
+    scipy.ndimage.gaussian_filter1d(x, sigma) (mode 'reflect') to a length n
+    array x, keeping only the output pixels in rows'''
+
+    x, weights = gaussian_weights(sigma, truncate)
+    cols = reflect_index(rows[:,None] + x[None,:], n)
+    indptr = np.arange(len(rows)+1) * len(x)
+
+    return sps.csr_matrix((np.tile(weights[0], len(rows)), cols.ravel(), indptr), \
+            shape = (len(rows), n))
+
+def window_mask(wl, windows, pad = 0):
+    '''Returns a mask of the wavelengths wl within the (low, high) windows,
+    widened by pad pixels on either side'''
+
+    sel = np.zeros(len(wl), dtype=bool)
+    for low, high in windows:
+        sel |= (wl >= low) & (wl <= high)
+    if pad > 0:
+        sel = np.convolve(sel, np.ones(2*pad + 1), mode='same') > 0
+
+    return sel
+
+class GaussianBroadener(object):
+    '''Broadens models to a velocity dispersion the same way as convolvemodels,
+    but only for the pixels within pad pixels of the (low, high) wavelength
+    windows. The broadening for each veldisp is a sparse matrix that is cached,
+    so a fixed veldisp is only built once. If vdstep is given the matrices are
+    cached on a veldisp grid with that spacing and interpolated linearly, which
+    is what a free veldisp needs. At most maxkernels matrices are kept, the
+    least recently used are dropped first.
+
+    If inputs (sorted indices into wlfull) is given, the models passed in only
+    hold those wavelengths, which must cover the kernels around the windows.'''
+
+    def __init__(self, wlfull, reglims = False, windows = None, pad = 10, \
+            vdstep = None, maxkernels = 256, inputs = None):
+        self.wlfull = wlfull
+        self.reglims = reglims
+        self.vdstep = vdstep
+        self.maxkernels = maxkernels
+        self.kernels = OrderedDict()
+
+        if inputs is None:
+            self.inverse = None
+        else:
+            self.inverse = np.full(len(wlfull), -1)
+            self.inverse[inputs] = np.arange(len(inputs))
+
+        if windows is None:
+            self.rows = np.arange(len(wlfull))
+        else:
+            self.rows = np.where(window_mask(wlfull, windows, pad))[0]
+        self.wl = wlfull[self.rows]
+
+    def exact_matrix(self, veldisp):
+        K = self.kernels.get(veldisp)
+        if K is not None:
+            self.kernels.move_to_end(veldisp)
+            return K
+
+        sigma_conv, dw = convolution_sigma(self.wlfull, veldisp, self.reglims)
+        K = gaussian_matrix(len(self.wlfull), self.rows, sigma_conv / dw)
+        if self.inverse is not None:
+            K.sum_duplicates()
+            nnz = K.nnz
+            K = K[:, self.inverse >= 0]
+            if K.nnz != nnz:
+                raise ValueError("Model wavelengths do not cover the "\
+                        "broadening kernel for veldisp %.1f" % (veldisp))
+        self.kernels[veldisp] = K
+        while len(self.kernels) > self.maxkernels:
+            self.kernels.popitem(last = False)
+
+        return K
+
+    def grid_weights(self, veldisp):
+        '''Returns the veldisp grid nodes and weights whose matrices are
+        combined for veldisp'''
+
+        veldisp = float(veldisp)
+        if (self.vdstep is None) or (veldisp in self.kernels):
+            return [veldisp], [1.]
+
+        v0 = np.floor(veldisp / self.vdstep) * self.vdstep
+        t = (veldisp - v0) / self.vdstep
+        if t == 0:
+            return [v0], [1.]
+
+        return [v0, v0 + self.vdstep], [1. - t, t]
+
+    def matrix(self, veldisp):
+        '''Returns the broadening matrix for veldisp'''
+
+        nodes, weights = self.grid_weights(veldisp)
+        K = weights[0] * self.exact_matrix(nodes[0])
+        for v, w in zip(nodes[1:], weights[1:]):
+            K = K + w * self.exact_matrix(v)
+
+        return K
+
+    def dot(self, veldisp, models):
+        '''The broadening matrix for veldisp times models (nwl or (nwl, n)),
+        without forming the interpolated matrix'''
+
+        nodes, weights = self.grid_weights(veldisp)
+        out = self.exact_matrix(nodes[0]).dot(models)
+        if weights[0] != 1.:
+            out *= weights[0]
+        for v, w in zip(nodes[1:], weights[1:]):
+            out += w * self.exact_matrix(v).dot(models)
+
+        return out
+
+    def __call__(self, models, veldisp):
+        '''Returns the wavelengths and the broadened model(s). models is a
+        single model or an (n, nwl) array, veldisp one dispersion or one per
+        model.'''
+
+        if np.ndim(models) == 1:
+            return self.wl, self.dot(np.ravel(veldisp)[0], models)
+
+        veldisp = np.ravel(veldisp)
+        if len(veldisp) == 1 or np.all(veldisp == veldisp[0]):
+            return self.wl, self.dot(veldisp[0], models.T).T
+
+        if self.vdstep is not None:
+            out = np.empty((models.shape[0], len(self.rows)))
+            for k in range(models.shape[0]):
+                out[k] = self.dot(veldisp[k], models[k])
+            return self.wl, out
+
+        #One kernel per model, applied to the neighbourhood of each pixel
+        sigma_conv, dw = convolution_sigma(self.wlfull, veldisp, self.reglims)
+        x, weights = gaussian_weights(sigma_conv / dw)
+        cols = reflect_index(self.rows[:,None] + x[None,:], len(self.wlfull))
+        if self.inverse is not None:
+            cols = self.inverse[cols]
+            if np.any(cols < 0):
+                raise ValueError("Model wavelengths do not cover the "\
+                        "broadening kernel for veldisp %.1f" % (np.max(veldisp)))
+
+        return self.wl, np.einsum('nrk,nk->nr', models[:,cols], weights)
+
+broadeners = {}
+
+# Spacing (km/s) of the broadening kernels for a free veldisp
+VDSTEP = 1.
+
+def get_broadener(wlfull, reglims, windows, vdstep = None):
+    '''Returns the GaussianBroadener for the model wavelengths and windows,
+    creating it the first time'''
+
+    if reglims:
+        reglims = tuple(reglims)
+    key = (len(wlfull), float(wlfull[0]), float(wlfull[-1]), reglims, \
+            tuple([(float(low), float(high)) for low, high in windows]), vdstep)
+    if key not in broadeners:
+        broadeners[key] = GaussianBroadener(wlfull, reglims = reglims, \
+                windows = windows, vdstep = vdstep)
+
+    return broadeners[key]
+
+def resampling_matrix(wlc, wlout, kind = 'cubic', tol = 1e-12, block = 512):
+    '''Returns the sparse (len(wlout), len(wlc)) matrix that samples a model
+    on wlc at wlout, the same as spi.interp1d(wlc, model, kind=kind)(wlout),
+    and the mask of wlout outside wlc (which interp1d fills with NaN). The
+    cubic spline weights below tol are dropped; they fall off by ~4x per
+    model pixel so only a few dozen per row remain.'''
+
+    n = len(wlc)
+    outside = (wlout < wlc[0]) | (wlout > wlc[-1])
+    x = np.clip(wlout, wlc[0], wlc[-1])
+
+    if kind == 'linear':
+        i = np.clip(np.searchsorted(wlc, x, side='right') - 1, 0, n-2)
+        t = (x - wlc[i]) / (wlc[i+1] - wlc[i])
+        rows = np.arange(len(x))
+        R = sps.csr_matrix((np.concatenate((1. - t, t)), \
+                (np.concatenate((rows, rows)), np.concatenate((i, i+1)))), \
+                shape = (len(x), n))
+    elif kind == 'cubic':
+        #The spline of each unit vector gives the weights of that model pixel
+        blocks = []
+        for j0 in range(0, n, block):
+            nb = min(block, n - j0)
+            unit = np.zeros((n, nb))
+            unit[j0 + np.arange(nb), np.arange(nb)] = 1.
+            Rb = spi.make_interp_spline(wlc, unit, k=3)(x)
+            Rb[np.abs(Rb) < tol] = 0.
+            blocks.append(sps.csr_matrix(Rb))
+        R = sps.hstack(blocks, format='csr')
+    else:
+        raise ValueError("Unknown resampling kind: %s" % (kind))
+
+    return R, outside
+
+class Resampler(object):
+    '''Samples models on wlc at the data wavelengths of each band in wls with
+    precomputed sparse matrices (see resampling_matrix). If stacked, all
+    bands are one matrix and one product.'''
+
+    def __init__(self, wlc, wls, kind = 'cubic', stacked = True):
+        self.wl = wlc
+        self.stacked = stacked
+
+        matrices = []
+        outside = []
+        for wli in wls:
+            R, out = resampling_matrix(wlc, wli, kind = kind)
+            matrices.append(R)
+            outside.append(out)
+
+        ends = np.cumsum([len(wli) for wli in wls])
+        self.bounds = list(zip(np.concatenate(([0], ends[:-1])), ends))
+        if stacked:
+            self.matrices = [sps.vstack(matrices, format='csr')]
+            self.outside = [np.concatenate(outside)]
+        else:
+            self.matrices = matrices
+            self.outside = outside
+
+    def __call__(self, models):
+        '''Returns the list of model(s) sampled at each band's wavelengths.
+        models is a single model or an (n, nwl) array.'''
+
+        out = []
+        for R, outside in zip(self.matrices, self.outside):
+            if np.ndim(models) == 1:
+                sampled = R.dot(models)
+            else:
+                sampled = R.dot(models.T).T
+            sampled[..., outside] = np.nan
+            out.append(sampled)
+
+        if self.stacked:
+            return [out[0][..., a:b] for a, b in self.bounds]
+        return out
+
+resamplers = {}
+
+def get_resampler(wlc, wls, kind = 'cubic'):
+    '''Returns the Resampler from wlc to the band wavelengths wls, creating it
+    the first time'''
+
+    key = (len(wlc), float(wlc[0]), float(wlc[-1]), kind, \
+            tuple([(len(wli), float(wli[0]), float(wli[-1])) for wli in wls]))
+    if key not in resamplers:
+        resamplers[key] = Resampler(wlc, wls, kind = kind)
+
+    return resamplers[key]
+
 def removeLineSlope(wlc, mconv, linedefs, i):
     bluelow,bluehigh,redlow,redhigh = linedefs
 
@@ -420,55 +783,12 @@ def measure_line(wl, spec, i, errors = False, contcorrect=False):
 
 def preload_vcj(overwrite_base = False):
     '''Loads the SSP models into memory so the mcmc model creation takes a
-    shorter time. Returns a dict with the filenames as the keys'''
-
-    if overwrite_base:
-        base = overwrite_base
-    else:
-        base = os.path.dirname(os.path.realpath(sys.argv[0])) + '/'
-
-    chem_names = ['WL', 'Solar', 'Na+', 'Na-', 'Ca+', 'Ca-', 'Fe+', 'Fe-', \
-            'C+', 'C-', 'a/Fe+', 'N+', 'N-', 'as/Fe+', 'Ti+', 'Ti-',\
-            'Mg+', 'Mg-', 'Si+', 'Si-', 'T+', 'T-', 'Cr+', 'Mn+', 'Ba+', \
-            'Ba-', 'Ni+', 'Co+', 'Eu+', 'Sr+', 'K+','V+', 'Cu+', 'Na+0.6', 'Na+0.9']
-
-    print("PRELOADING SSP MODELS INTO MEMORY")
-    fls = glob(base+'spec/vcj_ssp/*')    
-
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[3][1:])
-        Zsign = mnamespl[4][1]
-        Zval = float(mnamespl[4][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        x = pd.read_csv(fl, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)] = [x[:,1:]]
-
-    print("PRELOADING ABUNDANCE MODELS INTO MEMORY")
-    fls = glob(base+'spec/atlas/*')    
-    for fl in fls:
-        #print fl
-        flspl = fl.split('/')[-1]
-
-        mnamespl = flspl.split('_')
-        age = float(mnamespl[2][1:])
-        Zsign = mnamespl[3][1]
-        Zval = float(mnamespl[3][2:5])
-        if Zsign == "m":
-            Zval = -1.0 * Zval
-        if age == 13.0:
-            age = 13.5
-
-        x = pd.read_csv(fl, skiprows=2, names = chem_names, delim_whitespace = True, header=None)
-        x = np.array(x)
-        vcj["%.1f_%.1f" % (age, Zval)].append(x[:,1:])
-
-    vcj["WL"] = x[:,0]
+    shorter time. Returns a dict with the filenames as the keys. The models
+    come from the stacked model grid (see model_grid.py), read from the
+    binary cache when it is fresh, and the entries are views into it.'''
 
+    grid = mg.load_grid(overwrite_base)
+    vcj = mg.grid_to_vcj(grid)
     print("FINISHED LOADING MODELS")
 
     return vcj
@@ -529,6 +849,12 @@ def load_mcmc_inputs(fl):
             inputset['comments'] = ' '.join(line_split[1:])
         elif key == 'skip':
             inputset['skip'] = int(line_split[1])
+        elif key == 'cores':
+            inputset['cores'] = int(line_split[1])
+        elif key == 'memory':
+            inputset['memory'] = float(line_split[1])
+        elif key == 'autostop':
+            inputset['autostop'] = int(line_split[1])
         
     inputs.append(inputset)
 
@@ -0,0 +1,765 @@
+################################################################################
+#   Loading and caching of Prof Charlie Conroy's VCJ SSP and ATLAS abundance
+#   model grids used by the mcmc fitting programs.
+################################################################################
+
+from __future__ import print_function
+
+import numpy as np
+import pandas as pd
+import hashlib
+import json
+import shutil
+import time
+import threading
+import itertools
+import sys, os
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+from glob import glob
+from collections import OrderedDict
+from numpy.lib.format import open_memmap
+
+# Bump when the layout of the cached arrays changes so old caches are rebuilt
+CACHE_VERSION = 1
+
+# Largest relative error allowed when storing the grid in a compact dtype
+COMPACT_RTOL = 1e-6
+
+chem_names = ['WL', 'Solar', 'Na+', 'Na-', 'Ca+', 'Ca-', 'Fe+', 'Fe-', \
+        'C+', 'C-', 'a/Fe+', 'N+', 'N-', 'as/Fe+', 'Ti+', 'Ti-',\
+        'Mg+', 'Mg-', 'Si+', 'Si-', 'T+', 'T-', 'Cr+', 'Mn+', 'Ba+', \
+        'Ba-', 'Ni+', 'Co+', 'Eu+', 'Sr+', 'K+','V+', 'Cu+', 'Na+0.6', 'Na+0.9']
+
+def get_base(overwrite_base = False):
+    '''Returns the base path containing the spec/ model directories'''
+
+    if overwrite_base:
+        return overwrite_base
+    return os.path.dirname(os.path.realpath(sys.argv[0])) + '/'
+
+def parse_ssp_name(fl):
+    '''Returns the (age, Z) of a vcj_ssp model file from its filename'''
+
+    mnamespl = fl.split('/')[-1].split('_')
+    age = float(mnamespl[3][1:])
+    Zval = float(mnamespl[4][2:5])
+    if mnamespl[4][1] == "m":
+        Zval = -1.0 * Zval
+
+    return age, Zval
+
+def parse_atlas_name(fl):
+    '''Returns the (age, Z) of an atlas abundance model file from its filename'''
+
+    mnamespl = fl.split('/')[-1].split('_')
+    age = float(mnamespl[2][1:])
+    Zval = float(mnamespl[3][2:5])
+    if mnamespl[3][1] == "m":
+        Zval = -1.0 * Zval
+    if age == 13.0:
+        age = 13.5
+
+    return age, Zval
+
+def model_files(base):
+    '''Returns the sorted lists of vcj_ssp and atlas model files under base'''
+
+    ssp_fls = sorted(glob(base+'spec/vcj_ssp/*'))
+    atlas_fls = sorted(glob(base+'spec/atlas/*'))
+
+    return ssp_fls, atlas_fls
+
+def read_ssp_file(fl):
+    '''Parses one vcj_ssp file. Returns the full array, first column is WL'''
+
+    x = pd.read_csv(fl, sep=r'\s+', header=None, engine='c', dtype=np.float64, \
+            na_filter=False)
+    return x.to_numpy()
+
+def read_atlas_file(fl):
+    '''Parses one atlas abundance file. Returns the full array, first column
+    is WL'''
+
+    x = pd.read_csv(fl, skiprows=2, names = chem_names, sep=r'\s+', header=None, \
+            engine='c', dtype=np.float64, na_filter=False)
+    return x.to_numpy()
+
+def read_model_file(task):
+    '''Pool helper for parse_models: parses the (kind, key, fl) task and
+    returns (kind, key, array)'''
+
+    kind, key, fl = task
+    if kind == 'imf':
+        return kind, key, read_ssp_file(fl)
+    return kind, key, read_atlas_file(fl)
+
+def file_sha1(fl, blocksize = 2**20):
+    '''Returns the sha1 hex digest of the contents of fl'''
+
+    h = hashlib.sha1()
+    with open(fl, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+
+    return h.hexdigest()
+
+def source_manifest(fls, hashes = True):
+    '''Returns a list of [name, size, mtime, sha1] entries describing the model
+    source files. The sha1 is left as None if hashes is False.'''
+
+    sources = []
+    for fl in fls:
+        st = os.stat(fl)
+        sha = file_sha1(fl) if hashes else None
+        sources.append([fl.split('/')[-1], st.st_size, st.st_mtime_ns, sha])
+
+    return sources
+
+def sources_digest(sources):
+    '''Combines the per-file content hashes into one key for the model set'''
+
+    h = hashlib.sha1()
+    for name, size, mtime, sha in sources:
+        h.update(name.encode())
+        h.update(sha.encode())
+
+    return h.hexdigest()
+
+def cache_path(base, cachedir = None):
+    if cachedir:
+        return cachedir.rstrip('/') + '/'
+    return base + 'spec/vcj_cache/'
+
+def read_manifest(cachedir):
+    try:
+        with open(cachedir + 'manifest.json', 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def check_cache(base, cachedir = None):
+    '''Checks whether the binary cache is fresh for the model files under base.
+    Files whose size and mtime match the manifest are trusted without being
+    re-read; otherwise they are re-hashed and compared against the stored
+    content hash (e.g. after the model set is copied to a new node). Returns
+    the manifest if the cache can be used, otherwise None.'''
+
+    cachedir = cache_path(base, cachedir)
+    manifest = read_manifest(cachedir)
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return None
+
+    ssp_fls, atlas_fls = model_files(base)
+    fls = ssp_fls + atlas_fls
+    stored = manifest['sources']
+    if [s[0] for s in stored] != [fl.split('/')[-1] for fl in fls]:
+        return None
+
+    current = source_manifest(fls, hashes = False)
+    restamped = False
+    for i, fl in enumerate(fls):
+        if current[i][1:3] == stored[i][1:3]:
+            current[i][3] = stored[i][3]
+            continue
+        current[i][3] = file_sha1(fl)
+        if current[i][3] != stored[i][3]:
+            return None
+        restamped = True
+
+    if restamped:
+        # Contents unchanged, only the timestamps -- refresh the fast path
+        manifest['sources'] = current
+        try:
+            write_manifest(cachedir, manifest)
+        except (IOError, OSError):
+            pass
+
+    return manifest
+
+def write_manifest(cachedir, manifest):
+    tmp = cachedir + 'manifest.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, cachedir + 'manifest.json')
+
+def parse_models(base, workers = None, executor = 'process'):
+    '''Parses the raw vcj_ssp and atlas text files. Returns the model grid as
+    a dict with the wavelength array, the Z and Age axes, and the IMF and
+    abundance grids shaped (nZ, nAge, ncol, nwl). The files are parsed by
+    workers processes (executor = 'process') or threads ('thread'), default
+    one per core, and copied into the grid as they are done.'''
+
+    ssp_fls, atlas_fls = model_files(base)
+    if len(ssp_fls) == 0 or len(atlas_fls) == 0:
+        raise IOError("No model files found in %sspec/" % (base))
+
+    ssp = dict([(parse_ssp_name(fl), fl) for fl in ssp_fls])
+    atlas = dict([(parse_atlas_name(fl), fl) for fl in atlas_fls])
+    nodes = [key for key in atlas.keys() if key in ssp]
+    fullage = np.array(sorted(set([key[0] for key in nodes])))
+    fullZ = np.array(sorted(set([key[1] for key in nodes])))
+    if len(nodes) != len(fullage)*len(fullZ):
+        raise ValueError("Model files do not form a complete Age x Z grid")
+
+    # The first node sets the wavelengths and the number of columns
+    first = [read_model_file(('imf', nodes[0], ssp[nodes[0]])), \
+            read_model_file(('abund', nodes[0], atlas[nodes[0]]))]
+    wl = first[1][2][:,0]
+    imf = np.empty((len(fullZ), len(fullage), first[0][2].shape[1] - 1, len(wl)))
+    abund = np.empty((len(fullZ), len(fullage), first[1][2].shape[1] - 1, len(wl)))
+    grids = {'imf': imf, 'abund': abund}
+
+    tasks = [('imf', key, ssp[key]) for key in nodes[1:]] + \
+            [('abund', key, atlas[key]) for key in nodes[1:]]
+    if workers is None:
+        workers = os.cpu_count()
+    workers = max(min(int(workers), len(tasks)), 1)
+
+    print("PRELOADING %i SSP AND ABUNDANCE MODELS INTO MEMORY (%i %s workers)" % \
+            (len(tasks) + 2, workers, executor))
+    if executor == 'thread':
+        pool = ThreadPool(workers)
+    elif executor == 'process':
+        pool = mp.Pool(workers)
+    else:
+        raise ValueError("Unknown executor: %s" % (executor))
+
+    try:
+        for kind, (age, z), x in itertools.chain(first, \
+                pool.imap_unordered(read_model_file, tasks)):
+            if x.shape != (len(wl), grids[kind].shape[2] + 1):
+                raise ValueError("Model file for Age %.2f Z %.2f has shape %s" % \
+                        (age, z, x.shape))
+            grids[kind][np.searchsorted(fullZ, z), np.searchsorted(fullage, age)] = \
+                    x[:,1:].T
+    finally:
+        pool.terminate()
+
+    return {'WL': wl, 'Z': fullZ, 'Age': fullage, 'imf': imf, 'abund': abund}
+
+def write_cache(grid, base, cachedir = None):
+    '''Writes the parsed model grid and its source manifest to the binary
+    cache. The new cache is written beside the old one and swapped in so an
+    interrupted write never leaves a half-written cache behind.'''
+
+    cachedir = cache_path(base, cachedir)
+    ssp_fls, atlas_fls = model_files(base)
+    sources = source_manifest(ssp_fls + atlas_fls)
+
+    tmpdir = cachedir.rstrip('/') + '.tmp%d/' % (os.getpid())
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for key in ['WL', 'Z', 'Age', 'imf', 'abund']:
+        np.save(tmpdir + key + '.npy', np.ascontiguousarray(grid[key]))
+
+    manifest = {'version': CACHE_VERSION, 'digest': sources_digest(sources),\
+            'created': time.strftime("%Y%m%dT%H%M%S"), 'sources': sources,\
+            'imfshape': list(grid['imf'].shape), \
+            'abundshape': list(grid['abund'].shape)}
+    write_manifest(tmpdir, manifest)
+
+    if os.path.exists(cachedir):
+        olddir = cachedir.rstrip('/') + '.old%d' % (os.getpid())
+        os.rename(cachedir, olddir)
+        os.rename(tmpdir, cachedir)
+        shutil.rmtree(olddir)
+    else:
+        os.rename(tmpdir, cachedir)
+
+    return manifest
+
+def read_cache(cachedir, mmap = False, dtype = None):
+    '''Loads the cached model grid arrays. If mmap, the arrays are memory-mapped
+    read-only so every process that opens the cache shares one copy of the
+    grid through the page cache. With dtype (e.g. 'float32') the model
+    arrays are read from compact copies of that type, made on first use
+    (see write_compact).'''
+
+    grid = {}
+    for key in ['WL', 'Z', 'Age', 'imf', 'abund']:
+        fl = cachedir + key + '.npy'
+        if dtype and key in ['imf', 'abund'] and np.dtype(dtype) != np.float64:
+            fl = compact_path(cachedir, key, dtype)
+            if not os.path.exists(fl):
+                write_compact(cachedir, key, dtype)
+        grid[key] = np.load(fl, mmap_mode = 'r' if mmap else None)
+
+    return grid
+
+def compact_path(cachedir, key, dtype):
+    return cachedir + '%s.%s.npy' % (key, np.dtype(dtype).name)
+
+def check_compact(values, compact):
+    '''Raises a ValueError if converting values to compact lost more than
+    COMPACT_RTOL relative precision (including overflow or underflow).
+    Returns the largest relative error.'''
+
+    values = np.asarray(values)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        err = np.abs(compact.astype(np.float64) - values) / np.abs(values)
+    err[values == 0] = 0.
+    maxerr = np.max(err) if err.size else 0.
+    if not np.isfinite(maxerr) or maxerr > COMPACT_RTOL:
+        raise ValueError("The model grid does not fit in %s (relative error %g)" % \
+                (compact.dtype, maxerr))
+
+    return maxerr
+
+def write_compact(cachedir, key, dtype):
+    '''Writes a copy of the cached grid array key in dtype, checked against
+    COMPACT_RTOL (see check_compact). The copy sits beside the float64 array
+    and goes when the cache is rebuilt.'''
+
+    values = np.load(cachedir + key + '.npy', mmap_mode = 'r')
+    fl = compact_path(cachedir, key, dtype)
+    tmp = fl[:-4] + '.tmp%d.npy' % (os.getpid())
+    out = open_memmap(tmp, mode = 'w+', dtype = dtype, shape = values.shape)
+    maxerr = 0.
+    for j in range(values.shape[0]):
+        out[j] = values[j]
+        maxerr = max(maxerr, check_compact(values[j], out[j]))
+    out.flush()
+    del out
+    os.replace(tmp, fl)
+    print("Wrote %s grid %s (max relative error %.2g)" % (np.dtype(dtype).name, \
+            fl, maxerr))
+
+def compact_grid(grid, dtype):
+    '''Returns the grid with the model arrays converted to dtype in memory,
+    checked as in write_compact'''
+
+    grid = dict(grid)
+    for key in ['imf', 'abund']:
+        compact = grid[key].astype(dtype)
+        check_compact(grid[key], compact)
+        grid[key] = compact
+
+    return grid
+
+def compile_models(overwrite_base = False, cachedir = None, workers = None):
+    '''Parses the model text files with workers processes and writes the
+    binary cache. Returns the parsed grid.'''
+
+    base = get_base(overwrite_base)
+    t1 = time.time()
+    grid = parse_models(base, workers = workers)
+    manifest = write_cache(grid, base, cachedir)
+    print("Wrote model cache %s (%s) in %.1fs" % (cache_path(base, cachedir), \
+            manifest['digest'][:12], time.time() - t1))
+
+    return grid
+
+def load_grid(overwrite_base = False, cachedir = None, usecache = True, mmap = False, \
+        workers = None, dtype = None):
+    '''Returns the model grid, from the binary cache if it is fresh. Otherwise
+    the text files are parsed (by workers processes, see parse_models) and,
+    if usecache, the cache is (re)built. If mmap, the grid arrays are
+    memory-mapped from the cache (see read_cache). dtype = 'float32' stores
+    the model arrays in single precision, half the memory of float64.'''
+
+    compact = dtype and np.dtype(dtype) != np.float64
+    base = get_base(overwrite_base)
+    if not usecache:
+        grid = parse_models(base, workers = workers)
+        return compact_grid(grid, dtype) if compact else grid
+
+    if check_cache(base, cachedir) is not None:
+        print("LOADING MODELS FROM CACHE")
+        return read_cache(cache_path(base, cachedir), mmap = mmap, dtype = dtype)
+
+    print("Model cache missing or stale, parsing model files")
+    grid = parse_models(base, workers = workers)
+    try:
+        write_cache(grid, base, cachedir)
+    except (IOError, OSError) as e:
+        print("Could not write model cache: ", e)
+        return compact_grid(grid, dtype) if compact else grid
+
+    if mmap or compact:
+        # Swap the parsed arrays for the shared, memory-mapped ones
+        grid = read_cache(cache_path(base, cachedir), mmap = mmap, dtype = dtype)
+
+    return grid
+
+def grid_to_vcj(grid):
+    '''Returns the model dict used by the fitting programs: "age_Z" keys with
+    [imf models, abundance models] (each nwl x ncol) and the "WL" array. The
+    entries are views into the grid arrays, not copies.'''
+
+    vcj = {}
+    for i, age in enumerate(grid['Age']):
+        for j, z in enumerate(grid['Z']):
+            vcj["%.1f_%.1f" % (age, z)] = [grid['imf'][j,i].T, grid['abund'][j,i].T]
+    vcj["WL"] = grid['WL']
+
+    return vcj
+
+def bracket(axis, x, name = ''):
+    '''Returns the index of the lower grid node bracketing x and the
+    fractional distance to the next node'''
+
+    if not (axis[0] <= x <= axis[-1]):
+        raise ValueError("%s = %s is outside the model grid (%s to %s)" % \
+                (name, x, axis[0], axis[-1]))
+    i = min(np.searchsorted(axis, x, side='right') - 1, len(axis) - 2)
+    t = (x - axis[i]) / (axis[i+1] - axis[i])
+
+    return i, t
+
+def bracket_batch(axis, x, name = ''):
+    '''Vectorized bracket() for an array of values x'''
+
+    x = np.asarray(x, dtype=float)
+    if np.any((x < axis[0]) | (x > axis[-1])):
+        raise ValueError("%s values are outside the model grid (%s to %s)" % \
+                (name, axis[0], axis[-1]))
+    i = np.minimum(np.searchsorted(axis, x, side='right') - 1, len(axis) - 2)
+    t = (x - axis[i]) / (axis[i+1] - axis[i])
+
+    return i, t
+
+def imf_weights(x1_axis, x2_axis, x1, x2, snap = False):
+    '''Returns the IMF model columns (n, 4) and their bilinear weights (n, 4)
+    for arrays of IMF slopes x1 and x2, where the model for (x1_axis[i],
+    x2_axis[j]) is column i*len(x2_axis) + j. Values outside the axes are
+    clamped to the end models. With snap only the nearest model is used,
+    as (n, 1) arrays with weight 1.'''
+
+    x1 = np.asarray(x1, dtype=float)
+    x2 = np.asarray(x2, dtype=float)
+    n2 = len(x2_axis)
+
+    if snap:
+        i1 = np.argmin(np.abs(x1_axis[None,:] - x1[:,None]), axis=1)
+        i2 = np.argmin(np.abs(x2_axis[None,:] - x2[:,None]), axis=1)
+        return (i1*n2 + i2)[:,None], np.ones((len(x1), 1))
+
+    i1, t1 = bracket_batch(x1_axis, np.clip(x1, x1_axis[0], x1_axis[-1]), 'x1')
+    i2, t2 = bracket_batch(x2_axis, np.clip(x2, x2_axis[0], x2_axis[-1]), 'x2')
+    cols = np.stack([i1*n2 + i2, i1*n2 + i2 + 1, (i1 + 1)*n2 + i2, \
+            (i1 + 1)*n2 + i2 + 1], axis=1)
+    w = np.stack([(1. - t1)*(1. - t2), (1. - t1)*t2, t1*(1. - t2), t1*t2], axis=1)
+
+    return cols, w
+
+def axis_span(axis, low, high):
+    '''Returns the indices of axis that bracket (as bracket_batch) or are
+    nearest to any value in [low, high], clamped to the axis as imf_weights
+    does'''
+
+    low = np.clip(low, axis[0], axis[-1])
+    high = np.clip(high, axis[0], axis[-1])
+    i0 = min(np.searchsorted(axis, low, 'right') - 1, len(axis) - 2)
+    i1 = min(np.searchsorted(axis, high, 'right') - 1, len(axis) - 2) + 1
+
+    return np.arange(i0, i1 + 1)
+
+def imf_reach(x1_axis, x2_axis, x1range, x2range = None):
+    '''Returns the IMF model columns imf_weights can use for x1 in x1range
+    (low, high) and x2 in x2range, or for x2 = x1 if x2range is None (the
+    axes must then be the same).'''
+
+    n2 = len(x2_axis)
+    i1 = axis_span(x1_axis, *x1range)
+    if x2range is None:
+        return np.array([i*n2 + j for i in i1 for j in i1 if abs(i - j) <= 1])
+    i2 = axis_span(x2_axis, *x2range)
+
+    return (i1[:,None]*n2 + i2[None,:]).ravel()
+
+def take(values, cols, wlsel):
+    '''Returns values[:,:,cols,wlsel] of a (nZ, nAge, ncol, nwl) grid section,
+    where wlsel is a slice or an array of wavelength indices'''
+
+    if cols is None:
+        return values[:,:,:,wlsel]
+    if isinstance(wlsel, slice) or np.ndim(cols) == 0:
+        return values[:,:,cols,wlsel]
+
+    return values[:,:,np.asarray(cols)[:,None],np.asarray(wlsel)[None,:]]
+
+class GridInterpolator(object):
+    '''Bilinear (Z, Age) interpolation of a stacked model grid shaped
+    (nZ, nAge, ncol, nwl). The (Z, Age) bracket and weights are found once and
+    any subset of columns is returned as one weighted sum over the four
+    bracketing models, which is equivalent to a linear RegularGridInterpolator
+    over (Z, Age, wl) evaluated at the grid wavelengths. The sums are done in
+    the dtype of the grid.
+
+    With cols, the grid is lazy: only those columns of values (best a
+    memory-mapped cache array) are read into memory, and any other column is
+    read the first time it is asked for (see load()).'''
+
+    def __init__(self, Z, Age, wl, values, cols = None):
+        self.Z = np.asarray(Z, dtype=float)
+        self.Age = np.asarray(Age, dtype=float)
+        self.wl = np.asarray(wl)
+        self.ncol = values.shape[2]
+        self.values = values
+        self.source = None
+        self.colmap = None
+        if cols is not None:
+            self.source = values
+            self.values = np.empty(values.shape[:2] + (0,) + values.shape[3:], \
+                    dtype = values.dtype)
+            self.colmap = np.full(self.ncol, -1, dtype=int)
+            self.lazy = (self.values, self.colmap)
+            self.lock = threading.Lock()
+            self.load(cols)
+
+    def __len__(self):
+        return self.ncol
+
+    def loaded(self):
+        '''Returns the number of columns held in memory'''
+
+        if self.colmap is None:
+            return self.ncol
+        return self.values.shape[2]
+
+    def load(self, cols):
+        '''Reads the columns cols (None for all) of a lazy grid into memory if
+        they are not yet. Returns the array holding them and the positions of
+        cols in it. Once every column is needed the grid reads them all from
+        the source.'''
+
+        if self.colmap is None:
+            return self.values, cols
+        if cols is None:
+            cols = np.arange(self.ncol)
+        cols = np.asarray(cols, dtype=int) % self.ncol
+
+        # The array and column map are swapped together, so another thread
+        # always sees a matching pair
+        values, colmap = self.lazy
+        local = colmap[cols]
+        if np.all(local >= 0):
+            return values, local
+
+        with self.lock:
+            values, colmap = self.lazy
+            new = np.unique(cols[colmap[cols] < 0])
+            if len(new) + values.shape[2] == self.ncol:
+                values, colmap = self.source, np.arange(self.ncol)
+            elif len(new):
+                colmap = colmap.copy()
+                colmap[new] = values.shape[2] + np.arange(len(new))
+                values = np.concatenate([values, np.array(self.source[:,:,new])], \
+                        axis = 2)
+            self.lazy = (values, colmap)
+            self.values, self.colmap = values, colmap
+
+        return values, colmap[cols]
+
+    def weights(self, Z, Age):
+        '''Returns the lower bracketing (Z, Age) indices and the 2x2 bilinear
+        weights. Raises a ValueError outside the grid, like the
+        RegularGridInterpolators this replaces.'''
+
+        iz, tz = bracket(self.Z, Z, 'Z')
+        ia, ta = bracket(self.Age, Age, 'Age')
+        w = np.array([[(1. - tz)*(1. - ta), (1. - tz)*ta], [tz*(1. - ta), tz*ta]])
+
+        return iz, ia, w
+
+    def select(self, wl):
+        '''Returns the slice of the grid wavelengths matching wl, which must be
+        a contiguous section of the grid wavelength array.'''
+
+        i0 = np.searchsorted(self.wl, wl[0])
+        i1 = i0 + len(wl)
+        if i1 > len(self.wl) or self.wl[i0] != wl[0] or self.wl[i1-1] != wl[-1]:
+            raise ValueError("Requested wavelengths are outside the preloaded "\
+                    "model range %.0f-%.0f" % (self.wl[0], self.wl[-1]))
+
+        return slice(i0, i1)
+
+    def __call__(self, Z, Age, cols = None, weights = None, wlsel = None):
+        '''Interpolates the columns cols (an index, a list of indices, or None
+        for all) at (Z, Age). Returns an (ncols, nwl) array, or (nwl,) for a
+        single index. weights can be passed from a previous call to
+        weights() when several grids share the same axes. wlsel restricts
+        the wavelengths, either a slice (see select()) or an index array.'''
+
+        if weights is None:
+            weights = self.weights(Z, Age)
+        iz, ia, w = weights
+        if wlsel is None:
+            wlsel = slice(None)
+
+        values, cols = self.load(cols)
+        sub = take(values[iz:iz+2, ia:ia+2], cols, wlsel)
+
+        return np.tensordot(w.astype(sub.dtype), sub, axes=([0,1],[0,1]))
+
+    def weights_batch(self, Z, Age):
+        '''Vectorized weights() for arrays of Z and Age. Returns the lower
+        bracketing indices (n,) and the bilinear weights (n, 2, 2).'''
+
+        iz, tz = bracket_batch(self.Z, Z, 'Z')
+        ia, ta = bracket_batch(self.Age, Age, 'Age')
+        w = np.empty((len(iz), 2, 2))
+        w[:,0,0] = (1. - tz)*(1. - ta)
+        w[:,0,1] = (1. - tz)*ta
+        w[:,1,0] = tz*(1. - ta)
+        w[:,1,1] = tz*ta
+
+        return iz, ia, w
+
+    def batch(self, Z, Age, cols, weights = None, wlsel = None):
+        '''Interpolates the same columns cols for many (Z, Age) pairs. Returns
+        an (n, ncols, nwl) array. Walkers that share a (Z, Age) grid cell are
+        contracted together against that cell's four models.'''
+
+        if weights is None:
+            weights = self.weights_batch(Z, Age)
+        iz, ia, w = weights
+        if wlsel is None:
+            wlsel = slice(None)
+
+        nwl = len(self.wl[wlsel])
+        values, cols = self.load(cols)
+        out = np.empty((len(iz), len(cols), nwl), dtype = values.dtype)
+        w = w.astype(values.dtype)
+        cells = iz*len(self.Age) + ia
+        for cell in np.unique(cells):
+            group = np.where(cells == cell)[0]
+            i, j = iz[group[0]], ia[group[0]]
+            sub = take(values[i:i+2, j:j+2], cols, wlsel)
+            out[group] = w[group].reshape(-1,4).dot(sub.reshape(4,-1)).reshape(-1,len(cols),nwl)
+
+        return out
+
+    def batch_select(self, Z, Age, cols, weights = None, wlsel = None):
+        '''Interpolates one column per (Z, Age) pair, cols[k] for pair k.
+        Returns an (n, nwl) array. If cols is (n, ncols), the columns
+        cols[k] are interpolated for pair k and an (n, ncols, nwl) array
+        returned.'''
+
+        if weights is None:
+            weights = self.weights_batch(Z, Age)
+        iz, ia, w = weights
+        if wlsel is None:
+            wlsel = slice(None)
+
+        values, cols = self.load(cols)
+        cols = np.asarray(cols)
+        if cols.ndim == 2:
+            dz = np.array([[0,0],[1,1]])[...,None]
+            da = np.array([[0,1],[0,1]])[...,None]
+            if isinstance(wlsel, slice):
+                sub = values[iz[:,None,None,None] + dz, ia[:,None,None,None] + da, \
+                        cols[:,None,None,:], wlsel]
+            else:
+                sub = values[(iz[:,None,None,None] + dz)[...,None], \
+                        (ia[:,None,None,None] + da)[...,None], \
+                        cols[:,None,None,:,None], np.asarray(wlsel)[None,None,None,None,:]]
+
+            return np.einsum('nij,nijkl->nkl', w.astype(sub.dtype), sub)
+
+        dz = np.array([[0,0],[1,1]])
+        da = np.array([[0,1],[0,1]])
+        if isinstance(wlsel, slice):
+            sub = values[iz[:,None,None] + dz, ia[:,None,None] + da, \
+                    cols[:,None,None], wlsel]
+        else:
+            sub = values[(iz[:,None,None] + dz)[...,None], \
+                    (ia[:,None,None] + da)[...,None], \
+                    cols[:,None,None,None], np.asarray(wlsel)[None,None,None,:]]
+
+        return np.einsum('nij,nijl->nl', w.astype(sub.dtype), sub)
+
+class SpectrumCache(object):
+    '''Least-recently-used cache of interpolated model spectra, holding at
+    most maxbytes of arrays. Lookups with (Z, Age) rounded by quantize()
+    share entries; tol = None keeps the exact values, so results are the
+    same as without the cache. Stored arrays are made read-only. The hits,
+    misses and evictions are counted. Lookups are locked, so the cache can
+    be shared by the workers of a thread pool.'''
+
+    def __init__(self, maxbytes = 256*2**20, tol = None):
+        self.maxbytes = maxbytes
+        self.tol = tol
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def quantize(self, x):
+        '''Rounds x (a value or array) to a multiple of tol'''
+
+        if not self.tol:
+            return x
+        if np.ndim(x) == 0:
+            return float(np.round(x / self.tol) * self.tol)
+        return np.round(np.asarray(x) / self.tol) * self.tol
+
+    def get(self, key):
+        '''Returns the entry for key, or None if it is not cached'''
+
+        with self.lock:
+            values = self.entries.pop(key, None)
+            if values is None:
+                self.misses += 1
+                return None
+
+            self.entries[key] = values
+            self.hits += 1
+            return values
+
+    def put(self, key, values):
+        '''Stores the array values under key, evicting the least recently
+        used entries to stay under maxbytes. Returns values.'''
+
+        if values.nbytes > self.maxbytes:
+            return values
+
+        values.setflags(write = False)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            while self.entries and self.nbytes + values.nbytes > self.maxbytes:
+                self.nbytes -= self.entries.popitem(last = False)[1].nbytes
+                self.evictions += 1
+
+            self.entries[key] = values
+            self.nbytes += values.nbytes
+
+        return values
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''Returns a dict of the cache statistics'''
+
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'nbytes': self.nbytes, \
+                'hits': self.hits, 'misses': self.misses, \
+                'evictions': self.evictions, \
+                'hitrate': self.hits / float(lookups) if lookups else 0.}
+
+    def __str__(self):
+        st = self.stats()
+        return "Spectrum cache: %i entries (%.1f MB), %i hits, %i misses "\
+                "(%.1f%% hit rate), %i evictions" % (st['entries'], \
+                st['nbytes'] / 2.**20, st['hits'], st['misses'], \
+                100. * st['hitrate'], st['evictions'])
+
+
+if __name__ == '__main__':
+    # Compile the model cache: python model_grid.py [base]
+    if len(sys.argv) > 1:
+        compile_models(overwrite_base = sys.argv[1].rstrip('/') + '/')
+    else:
+        compile_models()
@@ -0,0 +1,92 @@
+################################################################################
+#   Maximum a posteriori pre-fit for the mcmc programs.
+#   Before sampling, a bounded optimizer is run on lnprob from several starting
+#   points (in parallel over the pool) and the walkers are started in a small
+#   ball around the best solutions instead of spread over the whole prior box,
+#   which cuts most of the burn-in.
+################################################################################
+
+from __future__ import print_function
+
+import time
+import numpy as np
+import scipy.optimize as spo
+from functools import partial
+
+def neg_lnprob(theta, lnprob):
+    '''-lnprob for the optimizer, with -inf (outside the priors or a failed
+    model) replaced by a large finite value'''
+
+    lnp = lnprob(theta)
+    if not np.isfinite(lnp):
+        return 1e300
+    return -lnp
+
+def optimize_start(theta0, lnprob = None, bounds = None, method = 'Nelder-Mead', \
+        maxiter = 2000):
+    '''Maximizes lnprob from theta0 within bounds (a list of (low, high),
+    None for no limit). Returns the best position and its lnprob.'''
+
+    theta0 = np.array(theta0, dtype = float)
+    if bounds is not None:
+        low = np.array([b[0] if b[0] is not None else -np.inf for b in bounds])
+        high = np.array([b[1] if b[1] is not None else np.inf for b in bounds])
+        theta0 = np.clip(theta0, low, high)
+
+    if method == 'Nelder-Mead':
+        options = {'maxiter': maxiter, 'maxfev': maxiter, 'xatol': 1e-4, \
+                'fatol': 1e-3, 'adaptive': len(theta0) > 5}
+    else:
+        options = {'maxiter': maxiter}
+
+    res = spo.minimize(neg_lnprob, theta0, args = (lnprob,), method = method, \
+            bounds = bounds, options = options)
+
+    return res.x, -res.fun
+
+def optimize(lnprob, starts, bounds = None, pool = None, method = 'Nelder-Mead', \
+        maxiter = 2000):
+    '''Runs optimize_start from each of starts, over the pool if one is given
+    (lnprob must then be picklable, e.g. a module level function). Returns
+    the solutions and their lnprob, best first.'''
+
+    t1 = time.time()
+    fn = partial(optimize_start, lnprob = lnprob, bounds = bounds, method = method, \
+            maxiter = maxiter)
+    if pool is None:
+        results = list(map(fn, starts))
+    else:
+        results = pool.map(fn, starts)
+
+    solutions = np.array([res[0] for res in results])
+    lnps = np.array([res[1] for res in results])
+    order = np.argsort(-lnps)
+    print("Pre-fit of %i starts took %.1f minutes, best lnprob %.2f" % \
+            (len(starts), (time.time() - t1) / 60., lnps[order[0]]))
+
+    return solutions[order], lnps[order]
+
+def walker_ball(solutions, lnps, nwalkers, scale, lnprior, dlnp = 5., \
+        ballsize = 0.01, maxtries = 1000):
+    '''Returns nwalkers starting positions in Gaussian balls around the
+    solutions (best first) whose lnprob is within dlnp of the best. scale is
+    the width of each parameter (e.g. the spread of the prior draws) and
+    the balls have sigma ballsize * scale. Positions outside the priors
+    (lnprior is -inf) are drawn again.'''
+
+    keep = solutions[lnps >= lnps[0] - dlnp]
+    print("Starting walkers around %i pre-fit solutions" % (len(keep)))
+    sigma = ballsize * np.asarray(scale, dtype = float)
+
+    pos = []
+    for i in range(nwalkers):
+        centre = keep[i % len(keep)]
+        for k in range(maxtries):
+            theta = centre + sigma * np.random.randn(len(centre))
+            if np.isfinite(lnprior(theta)):
+                break
+        else:
+            theta = np.array(centre)
+        pos.append(theta)
+
+    return np.array(pos)
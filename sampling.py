@@ -0,0 +1,360 @@
+################################################################################
+#   The sampling loop shared by the mcmc programs.
+#   run_chain steps an emcee sampler, writes each step to the chain, prints the
+#   progress, runs the convergence monitor and every checkpointevery steps
+#   saves a checkpoint of the sampler (see chain_io.write_state). A run stopped
+#   part way (e.g. a preempted job) is continued from its checkpoint with
+#   resume_state, appending to the same chain.
+#   make_moves builds the emcee proposal mixture from a short spec (e.g.
+#   'de:0.8,desnooker:0.2') with the acceptance of each move counted, and
+#   TemperedSampler runs parallel tempering over a ladder of temperatures,
+#   standing in for an EnsembleSampler with the cold chain written out.
+################################################################################
+
+from __future__ import print_function
+
+import copy
+import time
+import numpy as np
+import emcee
+from functools import partial
+
+import chain_io as mcio
+
+MOVES = {'stretch': emcee.moves.StretchMove, 'de': emcee.moves.DEMove, \
+        'desnooker': emcee.moves.DESnookerMove, 'kde': emcee.moves.KDEMove, \
+        'walk': emcee.moves.WalkMove}
+
+class CountedMove(object):
+    '''Wraps an emcee move and counts its proposals and accepted proposals'''
+
+    def __init__(self, move, name):
+        self.move = move
+        self.name = name
+        self.nproposed = 0
+        self.naccepted = 0
+
+    def propose(self, model, state):
+        state, accepted = self.move.propose(model, state)
+        self.nproposed += len(accepted)
+        self.naccepted += np.sum(accepted)
+        return state, accepted
+
+    def tune(self, state, accepted):
+        return self.move.tune(state, accepted)
+
+def make_moves(spec = 'stretch'):
+    '''Returns the weighted list of CountedMoves for emcee from spec: a move
+    name from MOVES, 'name:weight,name:weight,...', or a list of names,
+    emcee moves or (name or move, weight) pairs'''
+
+    if isinstance(spec, str):
+        spec = [tuple(part.split(':')) for part in spec.replace(' ', '').split(',')]
+
+    moves = []
+    for entry in spec:
+        if not isinstance(entry, tuple):
+            entry = (entry,)
+        move = entry[0]
+        weight = float(entry[1]) if len(entry) > 1 else 1.
+        if isinstance(move, str):
+            if move.lower() not in MOVES:
+                raise ValueError("Unknown move: %s" % (move))
+            name = move.lower()
+            move = MOVES[name]()
+        elif isinstance(move, CountedMove):
+            name = move.name
+            move = move.move
+        else:
+            name = type(move).__name__
+        moves.append((CountedMove(move, name), weight))
+
+    return moves
+
+def move_stats(moves):
+    '''Returns the proposals, accepted proposals and acceptance fraction of
+    each move of make_moves'''
+
+    stats = {}
+    for move, weight in moves:
+        stats[move.name] = {'weight': weight, 'proposed': int(move.nproposed), \
+                'accepted': int(move.naccepted), \
+                'fraction': move.naccepted / float(max(move.nproposed, 1))}
+
+    return stats
+
+def restore_move_stats(moves, stats):
+    '''Continues the move counts of make_moves from a move_stats dict'''
+
+    for move, weight in moves:
+        if move.name in stats:
+            move.nproposed = stats[move.name]['proposed']
+            move.naccepted = stats[move.name]['accepted']
+
+def print_stats(stats):
+    '''Prints a move_stats or swap_stats dict'''
+
+    print('    ' + '  '.join(['%s: %.3f' % (name, stats[name]['fraction']) \
+            for name in sorted(stats.keys())]))
+
+def temperature_ladder(ntemps, tmax):
+    '''Returns the inverse temperatures of ntemps chains spaced
+    geometrically from 1 to tmax'''
+
+    if ntemps == 1:
+        return np.array([1.])
+    return tmax ** (-np.arange(ntemps) / (ntemps - 1.))
+
+def tempered_lnprob(theta, lnprob = None, beta = 1.):
+    '''lnprob at inverse temperature beta. The priors are flat, so this is the
+    tempered likelihood inside them and -inf outside.'''
+
+    return beta * lnprob(theta)
+
+class TemperedSampler(object):
+    '''Parallel tempering: an emcee EnsembleSampler for each inverse
+    temperature in betas, and after every step a swap of randomly paired
+    walkers between neighbouring temperatures. Each temperature has its own
+    copy of the moves (a make_moves spec), so their acceptance is counted
+    per temperature; moves[0] are the cold chain's. sample() yields the
+    states of the beta = 1 chain, whose steps are kept in backend, so it can
+    be used in place of an EnsembleSampler in run_chain. The other keywords
+    are passed to the EnsembleSamplers.'''
+
+    def __init__(self, nwalkers, ndim, lnprob, betas, moves = 'stretch', **kwargs):
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.betas = np.asarray(betas, dtype = float)
+        self.moves = [make_moves(copy.deepcopy(moves)) for beta in self.betas]
+        self.samplers = [emcee.EnsembleSampler(nwalkers, ndim, \
+                partial(tempered_lnprob, lnprob = lnprob, beta = beta), moves = moves, \
+                **kwargs) for beta, moves in zip(self.betas, self.moves)]
+        self._random = np.random.mtrand.RandomState()
+
+        self.states = None
+        self.nswaps = np.zeros(len(self.betas) - 1)
+        self.naccepted = np.zeros(len(self.betas) - 1)
+
+    @property
+    def backend(self):
+        return self.samplers[0].backend
+
+    def get_autocorr_time(self, **kwargs):
+        return self.samplers[0].get_autocorr_time(**kwargs)
+
+    def get_state(self):
+        '''Returns the states of all temperatures and the swap counts, for the
+        checkpoint'''
+
+        return {'states': self.states, 'random_state': self._random.get_state(), \
+                'nswaps': self.nswaps.tolist(), 'naccepted': self.naccepted.tolist(), \
+                'moves': [move_stats(moves) for moves in self.moves]}
+
+    def move_stats(self):
+        '''Returns the move_stats of each temperature, keyed by temperature'''
+
+        return dict([('T%.3g' % (1. / beta), move_stats(moves)) \
+                for beta, moves in zip(self.betas, self.moves)])
+
+    def swap(self):
+        '''Proposes swapping each walker with a random walker of the next
+        colder temperature, from the hottest down'''
+
+        for k in range(len(self.betas) - 2, -1, -1):
+            cold, hot = self.states[k], self.states[k+1]
+            pairs = self._random.permutation(self.nwalkers)
+            lcold = cold.log_prob / self.betas[k]
+            lhot = hot.log_prob[pairs] / self.betas[k+1]
+            with np.errstate(invalid = 'ignore'):
+                lnalpha = (self.betas[k] - self.betas[k+1]) * (lhot - lcold)
+            swap = np.log(self._random.rand(self.nwalkers)) < lnalpha
+
+            i, j = np.where(swap)[0], pairs[swap]
+            coldcoords = cold.coords[i].copy()
+            cold.coords[i] = hot.coords[j]
+            hot.coords[j] = coldcoords
+            cold.log_prob[i] = self.betas[k] * lhot[swap]
+            hot.log_prob[j] = self.betas[k+1] * lcold[swap]
+
+            self.nswaps[k] += self.nwalkers
+            self.naccepted[k] += np.sum(swap)
+
+    def swap_stats(self):
+        '''Returns the swap acceptance between each pair of temperatures'''
+
+        return dict([('T%.3g-T%.3g' % (1. / self.betas[k], 1. / self.betas[k+1]), \
+                {'proposed': int(self.nswaps[k]), 'accepted': int(self.naccepted[k]), \
+                'fraction': self.naccepted[k] / max(self.nswaps[k], 1.)}) \
+                for k in range(len(self.betas) - 1)])
+
+    def spread(self, coords, scale = 0.01):
+        '''Returns a copy of the (nwalkers, ndim) positions coords for each
+        temperature, the hotter ones moved by Gaussian steps of scale times
+        the walker spread. Swaps between identical copies would leave
+        duplicate walkers in the cold chain, which the DE moves cannot
+        handle.'''
+
+        std = np.std(coords, axis = 0)
+        sigma = scale * np.where(std > 0, std, np.maximum(np.abs(coords[0]), 1.))
+        starts = [coords]
+        for k in range(1, len(self.betas)):
+            starts.append(coords + sigma * self._random.randn(*coords.shape))
+
+        return np.array(starts)
+
+    def sample(self, initial, iterations = 1):
+        '''Advances all temperatures for iterations steps, yielding the cold
+        state. initial is the (ntemps, nwalkers, ndim) walker positions, one
+        set per temperature, the cold positions (spread over the
+        temperatures, see spread()) or a get_state() dict.'''
+
+        if isinstance(initial, dict):
+            self.states = [emcee.State(state) for state in initial['states']]
+            self._random.set_state(initial['random_state'])
+            self.nswaps = np.array(initial['nswaps'])
+            self.naccepted = np.array(initial['naccepted'])
+            for moves, stats in zip(self.moves, initial.get('moves', [])):
+                restore_move_stats(moves, stats)
+        else:
+            coords = np.array(initial.coords if isinstance(initial, emcee.State) \
+                    else initial, dtype = float)
+            if coords.ndim == 2:
+                coords = self.spread(coords)
+            self.states = [emcee.State(coords[k]) for k in range(len(self.betas))]
+
+        backend = self.backend
+        backend.grow(iterations, None)
+        for i in range(iterations):
+            previous = self.states[0].coords.copy()
+            for k, sampler in enumerate(self.samplers):
+                self.states[k] = next(sampler.sample(self.states[k], iterations = 1, \
+                        store = False, skip_initial_state_check = True))
+            self.swap()
+            state = self.states[0]
+            backend.save_step(state, np.any(state.coords != previous, axis = 1))
+
+            yield state
+
+def seed_backend(sampler, chain):
+    '''Puts the (nsteps, nwalkers, ndim+1) steps of an earlier part of the
+    run into the sampler's in-memory chain, so the autocorrelation times
+    cover the whole run'''
+
+    backend = sampler.backend
+    nsteps = chain.shape[0]
+    backend.grow(nsteps, None)
+    backend.chain[:nsteps] = chain[:, :, :-1]
+    backend.log_prob[:nsteps] = chain[:, :, -1]
+    backend.accepted += np.sum(np.any(chain[1:, :, :-1] != chain[:-1, :, :-1], \
+            axis = 2), axis = 0)
+    backend.iteration = nsteps
+
+# do_mcmc arguments fixed by the chain being resumed
+RESUME_FIXED = ['n_iter', 'nwalkers', 'ntemps', 'chainformat']
+
+def resume_args(state, kwargs, fixed = RESUME_FIXED):
+    '''Returns the do_mcmc arguments saved in the checkpoint state updated
+    with kwargs. Raises ValueError if kwargs change one of fixed, which set
+    the shape of the chain that is reopened.'''
+
+    runargs = dict(state['runargs'])
+    changed = [k for k in fixed if (k in kwargs) and (kwargs[k] != runargs.get(k))]
+    if changed:
+        raise ValueError("%s cannot be changed when resuming a chain (it has %s)" % \
+                (', '.join(changed), ', '.join(['%s = %s' % (k, runargs.get(k)) \
+                for k in changed])))
+    runargs.update(kwargs)
+
+    return runargs
+
+def resume_state(fl, sampler, monitor = None, flushevery = 100, moves = None):
+    '''Loads the checkpoint of the chain fl. Returns the reopened writer,
+    the emcee State (or TemperedSampler state) to continue from and the
+    number of steps already in the chain. The monitor history and move
+    counts are restored and, if there is a monitor, the earlier steps are
+    loaded into the sampler.'''
+
+    state = mcio.read_state(fl)
+    writer = mcio.reopen_chain(fl, state, flushevery = flushevery)
+    start = state['chain']['nsteps']
+
+    if monitor is not None:
+        if state.get('autocorr'):
+            monitor.restore(state['autocorr'])
+        seed_backend(sampler, mcio.read_steps(fl, start))
+    if moves and state.get('moves'):
+        restore_move_stats(moves, state['moves'])
+
+    if state.get('tempered'):
+        initial = state['tempered']
+    else:
+        initial = emcee.State(state['coords'], log_prob = state['log_prob'], \
+                blobs = state['blobs'], random_state = state['random_state'])
+    print("Resuming %s at step %i of %i" % (fl, start, state['niter']))
+
+    return writer, initial, start
+
+def run_chain(sampler, initial, writer, n_iter, start = 0, monitor = None, \
+        autostop = False, checkpointevery = 100, runargs = None, moves = None):
+    '''Runs the sampler from initial (positions or an emcee State) until the
+    chain has n_iter steps, start of which are already written. Every
+    checkpointevery steps the chain is synced and the sampler state saved
+    with runargs (the do_mcmc arguments, so the run can be resumed), and
+    the acceptance of the moves (make_moves; for a TemperedSampler the cold
+    chain's, sampler.moves[0]) and temperature swaps is printed and
+    recorded in the chain header, with the acceptance at each temperature
+    under 'tempered_moves'.'''
+
+    t1 = time.time()
+    step = start
+    with writer:
+        for i, result in enumerate(sampler.sample(initial, iterations = n_iter - start)):
+            writer.write(result.coords, result.log_prob)
+            step = start + i + 1
+
+            stopping = False
+            if monitor and monitor.due(step):
+                if monitor.check(sampler, step) and autostop:
+                    monitor.stopped = True
+                writer.update_header({'autocorr': monitor.diagnostics()})
+                stopping = monitor.stopped
+
+            if (step % checkpointevery == 0) or stopping or (step == n_iter):
+                stats = {}
+                if moves:
+                    stats['moves'] = move_stats(moves)
+                if isinstance(sampler, TemperedSampler):
+                    stats['swaps'] = sampler.swap_stats()
+                    stats['tempered_moves'] = sampler.move_stats()
+                if stats:
+                    writer.update_header(stats)
+                writer.checkpoint()
+                mcio.write_state(writer.fl, {'coords': result.coords, \
+                        'log_prob': result.log_prob, 'blobs': result.blobs, \
+                        'random_state': result.random_state, 'iteration': step, \
+                        'niter': n_iter, 'chain': writer.mark(), 'runargs': runargs, \
+                        'autocorr': monitor.diagnostics() if monitor else None, \
+                        'moves': stats.get('moves'), 'tempered': sampler.get_state() \
+                        if isinstance(sampler, TemperedSampler) else None})
+
+            if (i+1) % 100 == 0:
+                ct = time.time() - t1
+                pfinished = step*100. / float(n_iter)
+                left = ct / (i+1.) * (n_iter - step)
+                print(ct / 60., " Minutes")
+                print(pfinished, "% Finished")
+                print(left / 60., "Minutes left")
+                print(left / 3600., "Hours left")
+                if moves:
+                    print("Move acceptance:")
+                    print_stats(move_stats(moves))
+                if isinstance(sampler, TemperedSampler):
+                    print("Swap acceptance:")
+                    print_stats(sampler.swap_stats())
+                print()
+
+            if stopping:
+                print("Stopping at step %i of %i" % (step, n_iter))
+                break
+
+    return step
@@ -0,0 +1,285 @@
+################################################################################
+#   Batch scheduler for the runs of an mcmc inputs file.
+#   Scheduler reads the blocks of an inputs file (mcmc_support.load_mcmc_inputs)
+#   as a queue of jobs, each asking for some cores and memory (the 'cores' and
+#   'memory' keys of the block, in MB), and runs as many at once as fit on the
+#   node. The jobs are forked from this process, so they share the model grid
+#   it preloaded. The state of each job (pending, running, done, failed,
+#   skipped) is kept in a small JSON file next to the inputs file, and jobs
+#   that are done are skipped when the scheduler is run again. Each job writes
+#   its chain under a fixed name, so an interrupted job continues from its
+#   checkpoint. A job holds a lock on its chain while it runs and is ended
+#   with the scheduler, so a chain is never written by two processes.
+################################################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import fcntl
+import signal
+import ctypes
+import hashlib
+import traceback
+import multiprocessing as mp
+import multiprocessing.connection
+
+import mcmc_support as mcsp
+
+def node_memory():
+    '''Returns the available memory of this node in MB (inf if unknown)'''
+
+    try:
+        f = open('/proc/meminfo', 'r')
+        lines = f.readlines()
+        f.close()
+    except IOError:
+        return float('inf')
+
+    for line in lines:
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) / 1024.
+
+    return float('inf')
+
+def block_hash(inputs):
+    '''Returns a short hash of an inputs block, so edited blocks are run again'''
+
+    return hashlib.sha1(json.dumps(inputs, sort_keys = True).encode()).hexdigest()[:8]
+
+def read_jobstate(fl):
+    '''Reads the job state file (an empty state if there is none)'''
+
+    if not os.path.exists(fl):
+        return {}
+    f = open(fl, 'r')
+    state = json.load(f)
+    f.close()
+
+    return state
+
+def write_jobstate(fl, state):
+    '''Writes the job state file, replacing the old one in one step'''
+
+    f = open(fl + '.tmp', 'w')
+    json.dump(state, f, indent = 1, sort_keys = True)
+    f.close()
+    os.rename(fl + '.tmp', fl)
+
+def pid_alive(pid):
+    '''Returns True if a process with this pid exists'''
+
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+def lock_chain(chainname):
+    '''Takes an exclusive lock on chainname.lock, held until the returned
+    file is closed or the process (and any children it forked) ends.
+    Raises a RuntimeError if another process holds it.'''
+
+    f = open(chainname + '.lock', 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        f.close()
+        raise RuntimeError("%s is being run by another process" % (chainname))
+
+    return f
+
+def die_with_parent(parent):
+    '''Ends this process (through SystemExit, so its pool workers are
+    stopped too) when the process parent exits. Linux only, elsewhere the
+    job keeps running.'''
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        # PR_SET_PDEATHSIG = 1
+        ctypes.CDLL(None, use_errno = True).prctl(1, signal.SIGTERM)
+    except (OSError, AttributeError):
+        return
+    if os.getppid() != parent:
+        sys.exit(1)
+
+def run_job(runner, inputs, cores, chainname, logfl, runargs, parent = None):
+    '''Runs one job, with its output going to logfl. parent is the pid of
+    the scheduler when the job is forked from it. A runner that returns
+    None (do_mcmc refused the inputs) counts as a failure.'''
+
+    if parent is not None:
+        die_with_parent(parent)
+    log = open(logfl, 'a', 1)
+    sys.stdout = log
+    sys.stderr = log
+    lock = lock_chain(chainname)
+    try:
+        print("Starting %s at %s" % (chainname, time.strftime("%Y-%m-%d %H:%M:%S")))
+        result = runner(inputs, threads = cores, chainname = chainname, **runargs)
+        if result is None:
+            raise RuntimeError("%s did not run, see the messages above" % (chainname))
+        print("Finished %s at %s" % (chainname, time.strftime("%Y-%m-%d %H:%M:%S")))
+    finally:
+        lock.close()
+        log.flush()
+
+class Scheduler(object):
+    '''Runs the blocks of the inputs file inputfl with runner(inputs, threads,
+    chainname, **runargs), e.g. mcmc_fullindex.run_inputs. Up to cores cores
+    (default all) and memory MB (default the available memory) are in use
+    at once; blocks without 'cores' or 'memory' ask for jobcores and
+    jobmemory. The chains are chaindir/<input name>_<job>, the logs
+    chaindir/logs/ and the job state inputfl.jobs.json. With fork = False the
+    jobs are run one at a time in this process (e.g. under MPI).'''
+
+    def __init__(self, inputfl, runner, chaindir, cores = None, memory = None, \
+            jobcores = 16, jobmemory = 0, fork = True, poll = 60., runargs = None, \
+            suffix = '_fullindex'):
+        self.inputfl = inputfl
+        self.runner = runner
+        self.chaindir = chaindir
+        self.cores = cores if cores else os.cpu_count()
+        self.memory = memory if memory else node_memory()
+        self.fork = fork
+        self.poll = poll
+        self.runargs = runargs if runargs else {}
+        self.statefl = inputfl + '.jobs.json'
+        self.logdir = os.path.join(chaindir, 'logs')
+
+        inputname = os.path.splitext(os.path.basename(inputfl))[0]
+        self.jobs = []
+        for i, inputs in enumerate(mcsp.load_mcmc_inputs(inputfl)):
+            digest = block_hash(inputs)
+            name = '%s_%02d_%s_%s' % (inputname, i, inputs.get('target', 'job'), digest)
+            self.jobs.append({'name': name, 'index': i, 'hash': digest, \
+                    'inputs': inputs, 'skip': inputs.get('skip', 0) == 1, \
+                    'cores': min(int(inputs.get('cores', jobcores)), self.cores), \
+                    'memory': float(inputs.get('memory', jobmemory)), \
+                    'chain': os.path.join(chaindir, name + suffix), \
+                    'log': os.path.join(self.logdir, name + '.log')})
+
+        self.state = read_jobstate(self.statefl)
+
+    def set_status(self, job, status, **info):
+        '''Records the status of job in the state file'''
+
+        entry = self.state.setdefault(job['name'], {'index': job['index'], \
+                'target': job['inputs'].get('target'), 'chain': job['chain'], \
+                'log': job['log'], 'attempts': 0})
+        entry['status'] = status
+        entry['updated'] = time.strftime("%Y-%m-%d %H:%M:%S")
+        entry.update(info)
+        write_jobstate(self.statefl, self.state)
+
+    def pending(self):
+        '''Returns the jobs still to run, marking skipped ones'''
+
+        jobs = []
+        for job in self.jobs:
+            status = self.state.get(job['name'], {}).get('status')
+            pid = self.state.get(job['name'], {}).get('pid')
+            if status == 'done':
+                print("Already done: %s" % (job['name']))
+            elif status == 'running' and pid_alive(pid) and pid != os.getpid():
+                print("Still running as pid %i, not started again: %s" % (pid, \
+                        job['name']))
+            elif job['skip']:
+                print("Skipping: %s" % (job['name']))
+                if status != 'skipped':
+                    self.set_status(job, 'skipped')
+            else:
+                if status in ['running', 'failed']:
+                    print("Running again (was %s): %s" % (status, job['name']))
+                self.set_status(job, 'pending')
+                jobs.append(job)
+
+        return jobs
+
+    def start(self, job):
+        '''Starts job in a forked process, or runs it here without fork'''
+
+        attempts = self.state.get(job['name'], {}).get('attempts', 0) + 1
+        self.set_status(job, 'running', attempts = attempts, pid = None, \
+                started = time.strftime("%Y-%m-%d %H:%M:%S"))
+        print("Starting %s (%i cores, %.0f MB)" % (job['name'], job['cores'], \
+                job['memory']))
+        args = (self.runner, job['inputs'], job['cores'], job['chain'], job['log'], \
+                self.runargs)
+
+        if not self.fork:
+            self.set_status(job, 'running', pid = os.getpid())
+            stdout, stderr = sys.stdout, sys.stderr
+            try:
+                run_job(*args)
+                ok = True
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            sys.stdout, sys.stderr = stdout, stderr
+            self.finish(job, 0 if ok else 1)
+            return None
+
+        proc = mp.get_context('fork').Process(target = run_job, args = args + \
+                (os.getpid(),))
+        proc.start()
+        self.set_status(job, 'running', pid = proc.pid)
+
+        return proc
+
+    def finish(self, job, exitcode):
+        '''Records the end of job'''
+
+        if exitcode == 0:
+            self.set_status(job, 'done', exitcode = 0)
+            print("Done: %s" % (job['name']))
+        else:
+            self.set_status(job, 'failed', exitcode = exitcode)
+            print("Failed: %s (exit code %s, see %s)" % (job['name'], exitcode, job['log']))
+
+    def run(self):
+        '''Runs the pending jobs until all are done or failed. Jobs are
+        started in file order as cores and memory free up, with later jobs
+        that fit started ahead of a larger one that does not.'''
+
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+
+        queue = self.pending()
+        running = {}
+        print("%i jobs to run on %i cores" % (len(queue), self.cores))
+        while queue or running:
+            cores = self.cores - sum([job['cores'] for job, proc in running.values()])
+            memory = self.memory - sum([job['memory'] for job, proc in running.values()])
+            for job in list(queue):
+                if job['cores'] <= cores and (job['memory'] <= memory or not running):
+                    queue.remove(job)
+                    proc = self.start(job)
+                    if proc is not None:
+                        running[job['name']] = (job, proc)
+                        cores -= job['cores']
+                        memory -= job['memory']
+
+            if running:
+                mp.connection.wait([proc.sentinel for job, proc in running.values()], \
+                        timeout = self.poll)
+            for name, (job, proc) in list(running.items()):
+                if not proc.is_alive():
+                    proc.join()
+                    self.finish(job, proc.exitcode)
+                    del running[name]
+
+        counts = {}
+        for job in self.jobs:
+            status = self.state.get(job['name'], {}).get('status')
+            counts[status] = counts.get(status, 0) + 1
+        print("Jobs: " + ', '.join(['%i %s' % (counts[s], s) for s in sorted(counts)]))
+
+        return counts
@@ -0,0 +1,10 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The fitting programs silence np.RankWarning, which numpy 2 moved
+if not hasattr(np, 'RankWarning'):
+    np.RankWarning = np.exceptions.RankWarning
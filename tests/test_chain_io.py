@@ -0,0 +1,35 @@
+from __future__ import print_function
+
+import numpy as np
+
+import chain_io as mcio
+
+def test_dat_chain_info_sidecar(tmpdir):
+    np.random.seed(0)
+    nwalkers, ndim, niter = 4, 2, 6
+    header = {'gal': 'M85', 'fit': 'FullIndex', 'paramnames': ['Age', 'Z'], \
+            'linenames': ['FeH'], 'paramdict': {'Age': None, 'Z': None}, \
+            'comments': 'test'}
+    writer, fl = mcio.open_chain(str(tmpdir.join('run_fullindex')), nwalkers, ndim, \
+            niter, header, chainformat = 'dat', flushevery = 2)
+    with writer:
+        for step in range(niter):
+            writer.write(np.random.rand(nwalkers, ndim), -np.random.rand(nwalkers))
+            writer.update_header({'autocorr': {'tau': [[1.]] * (step + 1)}})
+
+    # The chain holds only the header lines and the steps
+    f = open(fl, 'r')
+    comments = [line for line in f if line[0] == '#']
+    f.close()
+    assert len(comments) == 6
+
+    info = mcio.read_info(fl)
+    assert len(info['autocorr']['tau']) == niter
+    assert mcio.read_dat_header(fl)['autocorr'] == info['autocorr']
+    assert mcio.read_steps(fl, niter).shape == (niter, nwalkers, ndim + 1)
+
+    # A new chain of the same name starts without the old info
+    writer, fl = mcio.open_chain(str(tmpdir.join('run_fullindex')), nwalkers, ndim, \
+            niter, header, chainformat = 'dat')
+    writer.close()
+    assert mcio.read_info(fl) == {}
@@ -0,0 +1,27 @@
+from __future__ import print_function
+
+import time
+
+import executors as exe
+
+def slow_square(x):
+    if x == 0:
+        raise ValueError("bad task")
+    time.sleep(0.05)
+    return x * x
+
+def test_local_pool_recovers_after_failed_task():
+    pool = exe.make_pool('local', processes = 3)
+    try:
+        try:
+            pool.map(slow_square, range(12))
+        except RuntimeError as e:
+            assert 'bad task' in str(e)
+        else:
+            assert False, "the failed task was not reported"
+
+        # Replies of the failed call must not leak into the next one
+        for k in range(3):
+            assert pool.map(slow_square, range(1, 10)) == [x * x for x in range(1, 10)]
+    finally:
+        pool.close()
@@ -0,0 +1,149 @@
+from __future__ import print_function
+
+import numpy as np
+import pytest
+import scipy.interpolate as spi
+
+import model_grid as mg
+import abundance_response as abr
+import mcmc_fullindex as mf
+
+Z = np.array([-1.5, -1.0, -0.5, 0.0, 0.2])
+Age = np.array([1.0, 3.0, 5.0, 7.0, 9.0, 11.0, 13.5])
+
+def synthetic_grid(nwl = 600, seed = 1):
+    '''A small model grid with the shape of the real one: 256 IMF and 34
+    abundance models for each (Z, Age)'''
+
+    rng = np.random.RandomState(seed)
+    wl = np.linspace(8400., 14100., nwl)
+    base = 1. + 0.1*np.sin(wl / 30.)[None,None,None,:] + \
+            0.01*Age[None,:,None,None] + 0.02*Z[:,None,None,None]
+    imf = base * (1. + 0.01*rng.standard_normal((len(Z), len(Age), 256, nwl)))
+    abund = base * (1. + 0.01*rng.standard_normal((len(Z), len(Age), 34, nwl)))
+
+    return {'WL': wl, 'Z': Z, 'Age': Age, 'imf': imf, 'abund': abund}
+
+@pytest.fixture(scope = 'module')
+def grid(tmpdir_factory):
+    '''Installs the synthetic grid as the mcmc_fullindex models, through the
+    binary cache of an empty model directory'''
+
+    base = str(tmpdir_factory.mktemp('models')) + '/'
+    grid = synthetic_grid()
+    mg.write_cache(grid, base)
+    old = mf.vcj
+    mf.vcj = mf.preload_vcj(overwrite_base = base)
+    yield grid
+    mf.vcj = old
+
+def band_data(seed = 2):
+    '''Index definitions and a noisy flat spectrum for each band, with a
+    masked (NaN) pixel'''
+
+    bluelow =  [9855, 10300, 11340, 11667, 11710, 12460, 12240]
+    bluehigh = [9880, 10320, 11370, 11680, 11750, 12495, 12260]
+    linelow =  [9905, 10337, 11372, 11680, 11765, 12505, 12309]
+    linehigh = [9935, 10360, 11415, 11705, 11793, 12545, 12333]
+    redlow =   [9940, 10365, 11417, 11710, 11793, 12555, 12360]
+    redhigh =  [9970, 10390, 11447, 11750, 11810, 12590, 12390]
+    morder = [1]*7
+    names = np.array(['FeH','CaI','NaI','KI_a','KI_b','KI_1.25','NaI123'])
+    linedefs = [np.array([bluelow, bluehigh, linelow, linehigh, redlow, redhigh, \
+            bluelow, redhigh, morder]), names, names]
+
+    rng = np.random.RandomState(seed)
+    wl = [np.arange(low, high, 1.3) for low, high in zip(bluelow, redhigh)]
+    data = [1. + 0.01*rng.standard_normal(len(w)) for w in wl]
+    err = [np.full(len(w), 0.01) for w in wl]
+    data[2][3] = np.nan
+
+    return wl, data, err, linedefs, list(names)
+
+@pytest.mark.parametrize('imf', ['interp', 'snap'])
+@pytest.mark.parametrize('paramnames', [['Age','Z','x1','x2','Na','Fe','VelDisp'], \
+        ['Age','Z','x1','x2','Na','K']])
+def test_plan_matches_direct(grid, paramnames, imf):
+    wl, data, err, linedefs, lineinclude = band_data()
+    paramdict = dict.fromkeys(paramnames)
+    args = (wl, data, err, paramnames, paramdict, lineinclude, linedefs, 230., \
+            False, False)
+
+    p0 = {'Age': 5., 'Z': -0.1, 'x1': 1.7, 'x2': 2.1, 'Na': 0.3, 'Fe': 0.1, \
+            'K': -0.1, 'VelDisp': 250.}
+    rng = np.random.RandomState(3)
+    thetas = np.array([p0[p] for p in paramnames]) * \
+            (1. + 0.03*rng.standard_normal((20, len(paramnames))))
+
+    mf.imfmode = imf
+    try:
+        plan = mf.evaluation_plan(wl, data, err, linedefs, paramnames, paramdict, \
+                lineinclude, 230., False, False)
+        direct = np.array([mf.lnprob(theta, *args) for theta in thetas])
+        planned = np.array([mf.lnprob(theta, *args, plan = plan) for theta in thetas])
+        batch = mf.lnprob_batch(thetas, *args, plan = plan)
+
+        # Exact spectrum cache: a repeated position gives the same value
+        mf.set_model_cache(tol = None)
+        cached = np.array([mf.lnprob(theta, *args, plan = plan) for theta in thetas])
+        again = np.array([mf.lnprob(theta, *args, plan = plan) for theta in thetas])
+    finally:
+        mf.set_model_cache(maxbytes = 0)
+        mf.imfmode = 'interp'
+
+    assert np.all(np.isfinite(direct))
+    # A free VelDisp interpolates the broadening kernels (mcsp.VDSTEP)
+    rtol = 1e-5 if 'VelDisp' in paramnames else 1e-7
+    assert np.allclose(planned, direct, rtol = rtol, atol = 0)
+    assert np.allclose(batch, planned, rtol = 1e-9, atol = 0)
+    assert np.array_equal(cached, planned)
+    assert np.array_equal(again, planned)
+
+def test_grid_interpolator(grid):
+    values = grid['abund']
+    interp = mg.GridInterpolator(Z, Age, grid['WL'], values)
+    ref = spi.RegularGridInterpolator((Z, Age), values)
+
+    rng = np.random.RandomState(4)
+    cols = [0, 3, 17, 33]
+    for z, age in zip(rng.uniform(Z[0], Z[-1], 10), rng.uniform(Age[0], Age[-1], 10)):
+        assert np.allclose(interp(z, age, cols), ref([z, age])[0][cols], \
+                rtol = 1e-12, atol = 0)
+
+    # On a node the model itself comes back
+    assert np.array_equal(interp(Z[3], Age[2], 5), values[3, 2, 5])
+
+    with pytest.raises(ValueError):
+        interp(0.3, 5., cols)
+
+def reference_response(element, x, c):
+    '''The response as the original model_spec built it: the abundance
+    models at each node divided by the solar model, interpolated along the
+    abundance axis (linear, cubic for Na), clamped at the end nodes'''
+
+    solar = c[:,0]
+    if element == 'Na':
+        nodes = [-0.5, -0.3, 0.0, 0.3, 0.6, 0.9]
+        minus = solar + (c[:,2] - solar) * 0.5/0.3
+        models = [minus, c[:,2], solar, c[:,1], c[:,-2], c[:,-1]]
+    else:
+        minus, plus, step, edge = {'Fe': (6, 5, 0.3, 0.5), 'K': (None, 29, 0.3, 0.5), \
+                'C': (8, 7, 0.15, 0.3)}[element]
+        plus = c[:,plus]
+        minus = 2.*solar - plus if minus is None else c[:,minus]
+        nodes = [-edge, -step, 0.0, step, edge]
+        models = [solar + (minus - solar)*edge/step, minus, solar, plus, \
+                solar + (plus - solar)*edge/step]
+    ratios = np.array(models) / solar
+    x = min(max(x, nodes[0]), nodes[-1])
+
+    if element == 'Na':
+        return spi.make_interp_spline(nodes, ratios, k = 3)(x)
+    return np.array([np.interp(x, nodes, r) for r in ratios.T])
+
+@pytest.mark.parametrize('element', ['Na', 'Fe', 'K', 'C'])
+def test_abundance_response(grid, element):
+    c = grid['abund'][3, 2].T
+    for x in [-0.7, -0.5, -0.41, -0.1, 0.0, 0.07, 0.2, 0.45, 0.75, 1.2]:
+        assert np.allclose(abr.response(element, x, c), \
+                reference_response(element, x, c), rtol = 1e-10, atol = 0)
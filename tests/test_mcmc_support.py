@@ -0,0 +1,60 @@
+from __future__ import print_function
+
+import numpy as np
+
+import chain_io as mcio
+import mcmc_support as mcsp
+
+def write_chain(fl, chain, lnprob, header, chainformat):
+    nsteps, nwalkers, ndim = chain.shape
+    writer, fl = mcio.open_chain(fl, nwalkers, ndim, nsteps, header, \
+            chainformat = chainformat, initial = chain[0], flushevery = 3)
+    with writer:
+        for coords, lnp in zip(chain, lnprob):
+            writer.write(coords, lnp)
+
+    return fl
+
+def test_dat_chain_roundtrip(tmpdir):
+    np.random.seed(0)
+    nsteps, nwalkers = 7, 6
+    paramnames = ['Z', 'Age', 'x1']
+    chain = np.random.rand(nsteps, nwalkers, len(paramnames))
+    lnprob = -np.random.rand(nsteps, nwalkers)
+    header = {'gal': 'M85', 'fit': 'FullIndex', 'paramnames': paramnames, \
+            'linenames': ['FeH', 'NaI'], 'paramdict': dict.fromkeys(paramnames), \
+            'comments': 'test'}
+
+    fl = write_chain(str(tmpdir.join('20210101T000000_M85_fullindex')), chain, \
+            lnprob, header, 'dat')
+    assert fl.endswith('.dat')
+    realdata, postprob, infol, lastdata = mcsp.load_mcmc_file(fl)
+
+    # The parameters come back in the standard order (Age, Z, x1)
+    order = [1, 0, 2]
+    assert np.allclose(realdata, chain[:, :, order])
+    assert np.allclose(postprob, lnprob)
+    assert np.allclose(lastdata, chain[-1][:, order])
+
+    # The binary format loads the same
+    binfl = write_chain(str(tmpdir.join('20210101T000000_M85_fullindex')), chain, \
+            lnprob, header, 'npy')
+    binary = mcsp.load_mcmc_file(binfl)
+    assert np.allclose(binary[0], realdata)
+    assert np.allclose(binary[1], postprob)
+
+def test_broadener_kernel_grid():
+    wlm = np.arange(9500., 10500., 0.5)
+    model = 1. + 0.1*np.sin(wlm / 3.)
+    windows = [(9800., 9900.), (10100., 10200.)]
+    exact = mcsp.GaussianBroadener(wlm, windows = windows)
+    grid = mcsp.GaussianBroadener(wlm, windows = windows, vdstep = 1., maxkernels = 4)
+
+    for vd in np.linspace(200., 210., 25):
+        wl, ref = exact(model, vd)
+        wlg, got = grid(model, vd)
+        assert np.allclose(got, ref, rtol = 1e-5)
+
+    # Only the kernels of the last grid nodes are kept
+    assert len(grid.kernels) == 4
+    assert list(grid.kernels.keys()) == [207., 208., 209., 210.]
@@ -0,0 +1,78 @@
+from __future__ import print_function
+
+import numpy as np
+import pytest
+
+import sampling as smp
+
+def lnprob_narrow(theta):
+    '''A target much narrower than the starting positions, so most proposals
+    are rejected and walkers sit still for many steps'''
+
+    if np.any(np.abs(theta) > 10.):
+        return -np.inf
+    return -0.5 * np.sum((theta / 0.01)**2)
+
+def run_tempered(start, ntemps, moves, iterations = 300):
+    sampler = smp.TemperedSampler(start.shape[-2], start.shape[-1], lnprob_narrow, \
+            smp.temperature_ladder(ntemps, 50.), moves = moves)
+    for state in sampler.sample(start, iterations = iterations):
+        assert not np.any(np.isnan(state.coords))
+
+    return sampler, state
+
+def test_tempered_desnooker_from_cold_start():
+    np.random.seed(0)
+    nwalkers, ndim = 32, 4
+    sampler, state = run_tempered(np.random.randn(nwalkers, ndim), 3, 'desnooker')
+
+    assert len(np.unique(state.coords, axis = 0)) == nwalkers
+    assert sampler.backend.iteration == 300
+
+def test_tempered_de_mixture_per_temperature_start():
+    np.random.seed(1)
+    nwalkers, ndim, ntemps = 32, 4, 3
+    sampler, state = run_tempered(np.random.randn(ntemps, nwalkers, ndim), ntemps, \
+            'de:0.8,desnooker:0.2')
+
+    assert len(np.unique(state.coords, axis = 0)) == nwalkers
+
+def test_spread_gives_distinct_copies():
+    np.random.seed(2)
+    sampler = smp.TemperedSampler(8, 2, lnprob_narrow, smp.temperature_ladder(3, 10.))
+    coords = np.random.randn(8, 2)
+    starts = sampler.spread(coords)
+
+    assert starts.shape == (3, 8, 2)
+    assert np.array_equal(starts[0], coords)
+    assert len(np.unique(starts.reshape(-1, 2), axis = 0)) == 24
+
+def test_tempered_moves_counted_per_temperature():
+    np.random.seed(3)
+    nwalkers, ndim, ntemps = 16, 2, 3
+    sampler, state = run_tempered(np.random.randn(ntemps, nwalkers, ndim), ntemps, \
+            'de:0.8,desnooker:0.2', iterations = 100)
+
+    stats = sampler.move_stats()
+    assert len(stats) == ntemps
+    for moves in sampler.moves:
+        assert sum([move.nproposed for move, weight in moves]) == 100 * nwalkers
+    assert stats['T1'] == smp.move_stats(sampler.moves[0])
+
+    restored = smp.TemperedSampler(nwalkers, ndim, lnprob_narrow, sampler.betas, \
+            moves = 'de:0.8,desnooker:0.2')
+    next(restored.sample(sampler.get_state()))
+    for moves in restored.moves:
+        assert sum([move.nproposed for move, weight in moves]) == 101 * nwalkers
+
+def test_resume_rejects_shape_changes():
+    state = {'runargs': {'nwalkers': 32, 'n_iter': 400, 'ntemps': 1, \
+            'threads': 6, 'chainformat': 'npy'}}
+
+    runargs = smp.resume_args(state, {'threads': 2, 'n_iter': 400})
+    assert runargs['threads'] == 2
+    assert state['runargs']['threads'] == 6
+
+    for kwargs in [{'n_iter': 600}, {'nwalkers': 64}, {'ntemps': 4}]:
+        with pytest.raises(ValueError):
+            smp.resume_args(state, kwargs)
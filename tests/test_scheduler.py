@@ -0,0 +1,84 @@
+from __future__ import print_function
+
+import os
+import time
+import signal
+import multiprocessing as mp
+
+import pytest
+
+import scheduler as sched
+
+def write_inputs(fl, targets):
+    f = open(fl, 'w')
+    f.write('\n'.join(['target %s\ncores 1\n' % (target) for target in targets]))
+    f.close()
+
+def refused(inputs, threads = 1, chainname = None):
+    print("Please input filename for WIFIS data")
+    return None
+
+def finished(inputs, threads = 1, chainname = None):
+    return chainname
+
+def sleeper(inputs, threads = 1, chainname = None, pidfl = None):
+    f = open(pidfl, 'w')
+    f.write('%i' % (os.getpid()))
+    f.close()
+    time.sleep(60)
+    return chainname
+
+def run_scheduler(inputfl, chaindir, pidfl):
+    jobs = sched.Scheduler(inputfl, sleeper, chaindir, cores = 1, poll = 0.1, \
+            runargs = {'pidfl': pidfl})
+    jobs.run()
+
+def test_refused_job_fails(tmpdir):
+    inputfl = str(tmpdir.join('inputs.txt'))
+    write_inputs(inputfl, ['A'])
+    counts = sched.Scheduler(inputfl, refused, str(tmpdir), poll = 0.1).run()
+    assert counts == {'failed': 1}
+
+    write_inputs(inputfl, ['A'])
+    counts = sched.Scheduler(inputfl, finished, str(tmpdir), poll = 0.1).run()
+    assert counts == {'done': 1}
+
+def test_running_job_not_started_twice(tmpdir):
+    inputfl = str(tmpdir.join('inputs.txt'))
+    write_inputs(inputfl, ['A'])
+    jobs = sched.Scheduler(inputfl, finished, str(tmpdir))
+    jobs.set_status(jobs.jobs[0], 'running', pid = os.getppid())
+    assert jobs.pending() == []
+
+    jobs.set_status(jobs.jobs[0], 'running', pid = 2**22 + 12345)
+    assert len(jobs.pending()) == 1
+
+def test_chain_lock(tmpdir):
+    chain = str(tmpdir.join('job_fullindex'))
+    lock = sched.lock_chain(chain)
+    with pytest.raises(RuntimeError):
+        sched.lock_chain(chain)
+    lock.close()
+    sched.lock_chain(chain).close()
+
+def test_job_dies_with_scheduler(tmpdir):
+    inputfl = str(tmpdir.join('inputs.txt'))
+    pidfl = str(tmpdir.join('job.pid'))
+    write_inputs(inputfl, ['A'])
+    proc = mp.get_context('fork').Process(target = run_scheduler, \
+            args = (inputfl, str(tmpdir), pidfl))
+    proc.start()
+    for i in range(100):
+        if os.path.exists(pidfl) and os.path.getsize(pidfl) > 0:
+            break
+        time.sleep(0.1)
+    jobpid = int(open(pidfl).read())
+    assert sched.pid_alive(jobpid)
+
+    os.kill(proc.pid, signal.SIGKILL)
+    proc.join()
+    for i in range(50):
+        if not sched.pid_alive(jobpid):
+            break
+        time.sleep(0.1)
+    assert not sched.pid_alive(jobpid)